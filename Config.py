@@ -3,19 +3,82 @@
 # CHAMPION LIST FILE
 K: int = 1000
 CHAMPION_FILE: str = "champion.txt"
+CHAMPION_WORKERS: int = 4  # number of worker processes used to calculate champion lists
 
 # LENGTHS FILE
 LENGTHS_FILE: str = "lengths.txt"
 
+# DOC STORE FILE
+# Where each document is in the input CSV file, so its text can be read again with a single seek
+DOCSTORE_FILE: str = "docstore.txt"
+
+# DATES FILE
+# The doc IDs sorted by the date they were posted, so the docs posted within a date range are found with a search
+DATES_FILE: str = "dates.txt"
+
 # STOP WORDS FILE
 STOP_WORDS_FILE: str = "stopwords.txt"
 
 # POSITIONAL INDICES
 WRITE_POS: bool = True
 
+# PARALLEL TOKENIZATION
+# Number of worker processes that tokenize documents during indexing (1 tokenizes in the main process),
+# and the number of documents sent to a worker at once
+TOKENIZER_WORKERS: int = 4
+TOKENIZER_BATCH_SIZE: int = 32
+
+# STEM CACHE
+# Maximum number of distinct tokens whose stems are remembered (per process), least recently used first out
+STEM_CACHE_SIZE: int = 2 ** 17
+
+# TOKENIZER BACKEND
+# "nltk" splits text with nltk.word_tokenize (Punkt sentence splitting, then Treebank word splitting)
+# "regex" splits text in a single pass of one compiled regex that mimics nltk.word_tokenize, which is much faster
+# Run "python3 Tokenizer.py -i dataset.csv" to see how closely the two agree on a corpus. It exits with status 1
+# if less than TOKENIZER_PARITY_THRESHOLD of the tokens agree (at 1, if any document is tokenized differently)
+TOKENIZER_BACKEND: str = "nltk"
+TOKENIZER_PARITY_THRESHOLD: float = 0.99
+
+# SPIMI INDEXING
+# Instead of holding the whole index in memory, flush sorted partial blocks to disk whenever the in-memory
+# dictionary is estimated to go over the memory budget, then k-way merge the blocks into the final files.
+RUN_SPIMI: bool = False
+SPIMI_MEMORY_BUDGET: int = 512 * 1024 * 1024  # in bytes
+
+# INDEX SEGMENTS
+# "index.py -a" indexes new documents into a new segment instead of rebuilding the index, and searching reads
+# every segment listed in the segments manifest. Once there are more than MAX_SEGMENTS segments, they are merged
+# into one in the background ("index.py -m" merges them on demand).
+SEGMENTS_FILE: str = "segments.json"
+MAX_SEGMENTS: int = 4
+
+# POSTING LIST CACHE
+# Maximum number of bytes of decoded posting lists kept in memory (per process), least recently used first out,
+# so searching never decodes the same posting list twice while it is cached (0 turns the cache off)
+POSTING_LIST_CACHE_BYTES: int = 64 * 1024 * 1024
+
+# RESULT CACHE
+# The server and batch modes remember the results of the last RESULT_CACHE_SIZE queries, by query tokens, relevant
+# docs and every value in this file, and drop them all whenever the index changes. The cache is saved to
+# RESULT_CACHE_FILE on exit and loaded again on startup (None keeps it in memory only).
+RUN_RESULT_CACHE: bool = True
+RESULT_CACHE_SIZE: int = 1024
+RESULT_CACHE_FILE = "result_cache.pickle"
+
 # QUERY EXPANSION
 RUN_QUERY_EXPANSION: bool = True
 THESAURUS_FILENAME: str = "stemmed_thesaurus.pickle"
+# WordNet and the thesaurus are merged into this table when indexing (see ExpansionTable.py), for searching to use
+EXPANSION_TABLE_FILE: str = "expansion_table.pickle"
+# "all" replaces the query with every expansion of its tokens, at full weight
+# "weighted" keeps the query tokens at full weight, and only adds the EXPANSION_BUDGET expansions with the highest
+# weight, i.e. their idf (relative to the highest possible idf) times the weight of where they came from.
+# Their query weights are scaled down by that weight too, so a query reads a bounded number of posting lists.
+QUERY_EXPANSION_MODE: str = "all"
+EXPANSION_BUDGET: int = 20  # in words, each of which is looked up in every zone
+EXPANSION_THESAURUS_WEIGHT: float = 0.5
+EXPANSION_WORDNET_WEIGHT: float = 0.3
 
 # RELEVANCE FEEDBACK
 # Classically, beta is smaller than alpha since the original query should carry a higher weightage.
@@ -24,6 +87,41 @@ THESAURUS_FILENAME: str = "stemmed_thesaurus.pickle"
 RUN_ROCCHIO: bool = True
 ALPHA: float = 0.8  # determined through experimentation
 BETA: float = 1.1
+# Gamma takes the centroid of any known non-relevant documents away from the query (terms can't go below 0)
+GAMMA: float = 0.15
+# When terms outside the query are scored too (i.e. with query pruning), only the terms of the relevant centroid
+# with the highest weights are added, so the query stays small
+ROCCHIO_MAX_TERMS: int = 500
+# ALPHA and BETA were tuned with our own weighting, where a query term in the centroid gets (ALPHA + BETA) times
+# its query weight (see QueryRefinement.run_rocchio). True uses ALPHA * query + BETA * centroid instead,
+# which needs ALPHA and BETA to be tuned again.
+ROCCHIO_STANDARD_FORMULA: bool = False
+
+# PSEUDO-RELEVANCE FEEDBACK
+# When a query comes without relevant docs, a cheap first pass (the unexpanded query, content zone only, top k)
+# picks the docs to take as relevant instead, and Rocchio is run on their centroid for a second pass.
+# The guessed docs are less reliable than given ones, so they get a smaller beta, and only the PRF_MAX_TERMS
+# heaviest terms of their centroid are added (and scored) in the second pass.
+# Both passes together read at most PRF_POSTINGS_BUDGET postings (unless the query alone reads more), decided before
+# each pass runs: the first pass is skipped if it doesn't fit, and feedback terms are only added while they fit.
+# The time each query takes is printed against PRF_LATENCY_BUDGET, to help size the postings budget.
+RUN_PSEUDO_RELEVANCE_FEEDBACK: bool = False
+PRF_FIRST_PASS_TOP_K: int = 10
+PRF_NUM_DOCS: int = 5
+PRF_BETA: float = 0.4
+PRF_MAX_TERMS: int = 50
+PRF_POSTINGS_BUDGET: int = 500000
+PRF_LATENCY_BUDGET: float = 0.5  # in seconds
+
+# DATES IN QUERIES
+# Dates in a query are always searched for as terms in the date zone. On top of that, the docs posted within
+# DATE_RANGE_DAYS days of any date in the query (found with the dates file) can be boosted or filtered:
+# "off" does neither, "boost" adds DATE_BOOST to their (normalized) scores, and "filter" returns only those docs.
+# Either way, MaxScore pruning is not used for queries with dates in them.
+DATE_RANGE_MODE: str = "off"
+DATE_RANGE_DAYS: int = 0
+DATE_BOOST: float = 0.1
+DATE_EXTRACTION_CACHE_SIZE: int = 4096  # in queries
 
 # QUERY PRUNING
 # Remove any terms with weight below the threshold (max_weight/threshold_val) from the query vector
@@ -32,6 +130,12 @@ BETA: float = 1.1
 RUN_QUERY_PRUNING: bool = False  # DISABLED FOR NOW
 PRUNING_THRESHOLD: float = 4
 
+# FREE TEXT RESULTS
+# Only return the top k documents of a free text query (None returns every document that matched any term)
+# With a top k, MaxScore pruning uses the max score of each term to skip documents that cannot make the top k
+FREE_TEXT_TOP_K = None
+RUN_MAX_SCORE: bool = True
+
 # CONTENT PARSING
 PARSING_CONFIG = {
     'NSW Court of Criminal Appeal': {
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+from __future__ import annotations
+
+import getopt
+import os
+import pickle
+import sys
+from typing import List, Optional, Set
+from InputOutput import TermDictionary
+from Segments import get_segment_file, read_segments
+from Tokenizer import stem
+from Types import *
+
+import Config
+
+# EXPANSION TABLE
+# Query expansion used to look up every query token in WordNet, and in the legal thesaurus, while searching.
+# Instead, both are merged offline into a single table of (stemmed) token -> the (stemmed) words it expands to,
+# split by where they came from, keeping only the words that are in the index, since any other word would be
+# dropped from the query anyway.
+# Searching then expands each token with one dictionary lookup, and never loads WordNet.
+# The table only knows the words of the index it was built for, so it is rebuilt after every full build, added
+# segment and merge.
+
+
+def get_index_words(dict_file: str, segments: List[SegmentId]) -> Set[str]:
+    """
+    :param dict_file: The name of the dictionary file (of segment 0)
+    :param segments: The segments to get the words of
+    :return: The set of all words in the dictionaries of the given segments
+    """
+    words: Set[str] = set()
+    for segment in segments:
+        with TermDictionary(get_segment_file(dict_file, segment)) as dictionary:
+            words.update(dictionary.get_word(word_id) for word_id in range(dictionary.get_num_words()))
+    return words
+
+
+def build_expansion_table(dict_file: str,
+                          thesaurus_file: str = Config.THESAURUS_FILENAME,
+                          out_expansion_table: str = Config.EXPANSION_TABLE_FILE,
+                          segments: Optional[List[SegmentId]] = None) -> None:
+    """
+    Builds the expansion table of the live segments of the index (or the given segments), from WordNet and the
+    legal thesaurus.
+    A token expands to the stemmed names of the lemmas (without any spaces) of all its WordNet synsets, and all
+    its related words in the thesaurus, as long as they are in the index. Tokens that could be looked up are the
+    words of the index, the words of the thesaurus and the stemmed WordNet lemma names, since query tokens are
+    always stemmed. If the WordNet corpus is not installed, the table is built from the thesaurus alone.
+    The table is pickled as a Dict[str, ExpansionTuple], i.e. token -> (thesaurus words, WordNet words), where the
+    WordNet words leave out any word already from the thesaurus. Tokens that do not expand to anything are left out.
+    :param dict_file: The name of the dictionary file (of segment 0)
+    :param thesaurus_file: The name of the (stemmed) thesaurus pickle file
+    :param out_expansion_table: The desired name of the output expansion table file
+    :param segments: The segments whose words the table should know, if not the live segments (e.g. when a new
+    segment is about to be added)
+    """
+    print("building expansion table...")
+    index_words = get_index_words(dict_file, read_segments() if segments is None else segments)
+
+    with open(thesaurus_file, "rb") as tf:
+        thesaurus: Dict[str, Set[str]] = pickle.load(tf)
+
+    # only the offline build ever loads WordNet
+    from nltk.corpus import wordnet
+    try:
+        lemma_names = [lemma_name for lemma_name in wordnet.all_lemma_names() if "_" not in lemma_name]
+    except LookupError:
+        print("WordNet corpus not found, building the expansion table from the thesaurus only")
+        wordnet = None
+        lemma_names = []
+
+    tokens = index_words | thesaurus.keys() | {stem(lemma_name) for lemma_name in lemma_names}
+    expansion_table: Dict[str, ExpansionTuple] = {}
+    expansions_seen: Dict[ExpansionTuple, ExpansionTuple] = {}  # so equal expansions are pickled only once
+    for token in tokens:
+        thesaurus_words: Set[str] = set(thesaurus.get(token, set())) & index_words
+        wordnet_words: Set[str] = set()
+        if wordnet is not None:
+            for synset in wordnet.synsets(token):
+                wordnet_words.update(stem(lemma_name) for lemma_name in synset.lemma_names() if "_" not in lemma_name)
+        wordnet_words = (wordnet_words & index_words) - thesaurus_words
+        if thesaurus_words or wordnet_words:
+            expansions = (tuple(sorted(thesaurus_words)), tuple(sorted(wordnet_words)))
+            expansion_table[token] = expansions_seen.setdefault(expansions, expansions)
+
+    # searchers may reload the table at any time (e.g. right after a merge), so it is replaced in one go
+    # the temporary file is per process, since a background merge may be rebuilding the table at the same time
+    temp_file = f"{out_expansion_table}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as ef:
+        pickle.dump(expansion_table, ef)
+    os.replace(temp_file, out_expansion_table)
+    print(f"Wrote expansions of {len(expansion_table)} tokens into the expansion table")
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file [-t thesaurus-file] [-o expansion-table-file]")
+
+
+# python3 ExpansionTable.py -d dictionary.txt
+if __name__ == "__main__":
+    dictionary_file = None
+    thesaurus_filename = Config.THESAURUS_FILENAME
+    expansion_table_file = Config.EXPANSION_TABLE_FILE
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "d:t:o:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-d":
+            dictionary_file = a
+        elif o == "-t":
+            thesaurus_filename = a
+        elif o == "-o":
+            expansion_table_file = a
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file is None:
+        usage()
+        sys.exit(2)
+
+    build_expansion_table(dictionary_file, thesaurus_filename, expansion_table_file)
@@ -1,11 +1,47 @@
 from __future__ import annotations
 
+import csv
+import io
+import os
+import shutil
 import sys
-from typing import List
+import tempfile
+from collections import OrderedDict
+from typing import List, Iterable, Union
 from Types import *
 
+import heapq
+import mmap
 import pickle
-from itertools import chain  # for flattening a nested list quickly
+import struct
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, groupby
+from math import ceil, isqrt, log10
+
+import Config
+
+# max scores are stored in the postings file as integers in units of 1/MAX_SCORE_SCALE
+MAX_SCORE_SCALE: int = 2 ** 20
+
+# posting lists with fewer docs than this don't get skip pointers
+MIN_SKIP_DOC_FREQ: int = 16
+
+# words in the dictionary file are front coded in blocks of this many words
+DICT_BLOCK_SIZE: int = 16
+
+# the dictionary file starts with (num_words)(num_terms)(block_size) as unsigned integers
+DICT_HEADER = struct.Struct("III")
+
+# the lengths file starts with (num_docs), and the champion file with (num_docs)(num_entries)
+LENGTHS_HEADER = struct.Struct("Q")
+CHAMPION_HEADER = struct.Struct("QQ")
+
+# the doc store file starts with (num_docs)(sources_len)
+DOCSTORE_HEADER = struct.Struct("QQ")
+
+# the dates file starts with (num_docs)
+DATES_HEADER = struct.Struct("Q")
 
 
 # === READING ===
@@ -13,18 +49,90 @@ from itertools import chain  # for flattening a nested list quickly
 # (All other methods removed in favor of this new class)
 
 
+class PostingListCache:
+    """
+    A cache of decoded posting lists (see decode_posting_list), shared by every PostingReader in the process,
+    so a posting list read again (by a later query, or another term of the same query) is not decoded again.
+    Holds at most max_bytes bytes of decoded arrays, least recently used first out. Lists are keyed by the postings
+    file (its identity and modification time, so a rewritten file never gives stale lists), the pointer of the list
+    and whether term positions were decoded.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.num_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lists: OrderedDict[Tuple, array] = OrderedDict()
+
+    def get(self, key: Tuple) -> Optional[array]:
+        """
+        :param key: The key of the posting list
+        :return: The decoded posting list, which must not be modified, or None if it is not cached
+        """
+        ints = self._lists.get(key)
+        if ints is None:
+            self.misses += 1
+            return None
+        self._lists.move_to_end(key)
+        self.hits += 1
+        return ints
+
+    def put(self, key: Tuple, ints: array) -> None:
+        """
+        Caches a decoded posting list, unless it is too big to ever fit.
+        :param key: The key of the posting list
+        :param ints: The decoded posting list
+        """
+        list_bytes = ints.itemsize * len(ints)
+        if list_bytes > self.max_bytes or key in self._lists:
+            return
+        self._lists[key] = ints
+        self.num_bytes += list_bytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self._lists.popitem(last=False)
+            self.num_bytes -= evicted.itemsize * len(evicted)
+
+    def clear(self) -> None:
+        self._lists.clear()
+        self.num_bytes = 0
+
+    def format_info(self) -> str:
+        """
+        :return: A one-line summary of the posting list cache statistics
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f"posting list cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{len(self._lists)} lists in {self.num_bytes / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.1f} MiB")
+
+
+# the posting list cache of this process
+POSTING_LIST_CACHE = PostingListCache(Config.POSTING_LIST_CACHE_BYTES)
+
+
 class PostingReader:
     """
     An interface for a posting list reading. Keeps the dictionary within itself, so accessing the posting list of any
     given term is as easy as ".seek_term('term')". Automatically grabs the doc frequency (the first entry) upon
     seeking. Has helper methods like .read_entry(), .is_done(), etc. Should be used with a context manager (i.e.
     'with' blocks) for automatic initialisation and closing of files.
+
+    The postings file is memory-mapped, and seeking to a term decodes its whole posting list in one go
+    into a compact array of integers. read_entry() then just walks through that array.
+    Decoded posting lists are kept in POSTING_LIST_CACHE, unless use_cache is False (e.g. when every list is only
+    read once, like when indexing).
     """
 
-    def __init__(self, file, dct):
+    def __init__(self, file, dct, use_cache: bool = True):
         self._filename: str = file
-        self._dct: Dict[Term, int] = dct  # Term -> pointer
-        self._loc: int = 0
+        self._dct: Union[Dict[TermId, int], TermDictionary] = dct  # term ID -> pointer
+        self._use_cache: bool = use_cache and POSTING_LIST_CACHE.max_bytes > 0
+        self._file_key: Tuple = ()      # identifies the postings file in the posting list cache
+        self._ints: array = array('L')  # decoded posting list of the current term
+        self._loc: int = 0              # index of the next unread integer in self._ints
+        self._write_pos: bool = True    # whether the postings file has term positions (read from its header)
+        self._read_pos: bool = True     # whether the current posting list was decoded with term positions
         self._done: bool = False       # flag for completing the reading of the given posting list
         self._remaining_docs: int = 0  # keeps count of remaining docs in current posting list
         self._remaining_pos: int = 0   # keeps count of remaining term positions left in current doc
@@ -36,86 +144,116 @@ class PostingReader:
         # keeps track of whether it is the first read after seek
         self._is_first_read: bool = False
 
-    def seek_term(self, term: str) -> None:
+    def seek_term(self, term: TermId, read_pos: bool = True) -> None:
         """
         To be used right after entering the context manager!
         Seeks file to the desired term and returns the document frequency.
-        :param term: The desired term
+        If read_pos is False, the term positions are skipped over without being decoded, and read_entry
+        gives a single entry per doc (with term_pos None). Use this when only the term frequencies matter.
+        :param term: The desired term ID
+        :param read_pos: Whether to read the term positions
         """
 
         # we should be checking that terms are in dictionary in process_query
         assert term in self._dct, "Term not found in dictionary!"
 
-        # reset the completion flag and seek to the posting list
+        # reset the completion flag and decode the whole posting list
         self._done = False
-        self._f.seek(self._dct[term], 0)
+        self._read_pos = self._write_pos and read_pos
+        if self._use_cache:
+            cache_key = (self._file_key, self._dct[term], self._read_pos)
+            self._ints = POSTING_LIST_CACHE.get(cache_key)
+            if self._ints is None:
+                self._ints = decode_posting_list(self._mm, self._dct[term], self._write_pos, self._read_pos)
+                POSTING_LIST_CACHE.put(cache_key, self._ints)
+        else:
+            self._ints = decode_posting_list(self._mm, self._dct[term], self._write_pos, self._read_pos)
 
         # get document frequency and update remaining count
-        self._doc_freq = self.read_next_int()
+        self._doc_freq = self._ints[0]
+        self._loc = 2  # skip over the header (doc_freq)(max_score)
 
         # we immediately read the first doc ID, so we start with -1 from remaining docs
         self._remaining_docs = self._doc_freq - 1
+        self._remaining_pos = 0
 
         # set is_first_read
         self._is_first_read = True
 
+    def get_term_info(self, term: TermId) -> Tuple[DocFreq, float]:
+        """
+        Reads just the header of a term's posting list, without decoding the list itself
+        or moving away from the current posting list.
+        :param term: The desired term ID
+        :return: Tuple of the document frequency and max score of the term
+        """
+        assert term in self._dct, "Term not found in dictionary!"
+        doc_freq, ptr = decode_variable_byte(self._mm, self._dct[term])
+        max_score, _ = decode_variable_byte(self._mm, ptr)
+        return doc_freq, decode_max_score(max_score)
+
+    def get_cursor(self, term: TermId) -> PostingCursor:
+        """
+        Gets a cursor over the posting list of a term, for going through it doc by doc (see PostingCursor).
+        Does not affect the posting list being read with seek_term and read_entry.
+        Cursors are only valid until the reader is closed.
+        :param term: The desired term ID
+        :return: The cursor
+        """
+        assert term in self._dct, "Term not found in dictionary!"
+        return PostingCursor(self._mm, self._dct[term], self._write_pos)
+
     def read_next_int(self) -> int:
         """
-        Reads the next integer from the encoded file by decoding the variable byte encoding.
-        :return: Next integer decoded from the file
+        Reads the next integer from the decoded posting list.
+        :return: Next integer in the posting list
         """
-        byte: int
-        new_int: int = 0
-        bits: int = 0
-        counter = 0
-        while True:
-            byte = int.from_bytes(self._f.read(1), sys.byteorder)
-            counter += 1
-            if byte >= 128:
-                new_int += (byte % 128) * 2**bits
-                return new_int
-            else:
-                new_int += byte << bits
-                bits += 7
+        new_int = self._ints[self._loc]
+        self._loc += 1
+        return new_int
 
     def read_entry(self) -> Tuple[DocId, TermFreq, TermPos]:
         """
         Using the current position of the instance's file pointer,
         read the next entry in the posting list and return it as a tuple:
         >> (doc_id, term_freq, term_pos)
+        If term positions were not read, there is one entry per doc and term_pos is None.
         :return: Tuple of document ID, term frequency, term position
         """
         # throw error if we're trying to read a completely read posting list
         assert not self._done, "Reading of posting list is already complete!"
 
-        if self._is_first_read:
-            self._current_doc = self.read_next_int()
-            self._term_freq = self.read_next_int()
-            self._curr_pos += self.read_next_int()
-            self._remaining_pos = self._term_freq - 1
-            self._is_first_read = False
-            if self._remaining_docs == self._remaining_pos == 0:
-                self._done = True
-            return self._current_doc, self._term_freq, self._curr_pos
-
         if self._remaining_pos == 0:
+            # moving on to the next doc
+            if self._is_first_read:
+                self._is_first_read = False
+            else:
+                self._remaining_docs -= 1
             self._current_doc = self.read_next_int()
             self._term_freq = self.read_next_int()
-            self._remaining_docs -= 1
-            self._remaining_pos = self._term_freq
+            self._remaining_pos = self._term_freq if self._read_pos else 1
             self._curr_pos = 0
 
-        self._curr_pos += self.read_next_int()
+        term_pos: Optional[TermPos] = None
+        if self._read_pos:
+            self._curr_pos += self.read_next_int()
+            term_pos = self._curr_pos
         self._remaining_pos -= 1
 
         if self._remaining_docs == self._remaining_pos == 0:
             self._done = True
 
-        return self._current_doc, self._term_freq, self._curr_pos
+        return self._current_doc, self._term_freq, term_pos
 
     def is_done(self):
         return self._done
 
+    def has_positions(self) -> bool:
+        """
+        :return: Whether the postings file has term positions (only known once the file is open)
+        """
+        return self._write_pos
+
     def get_doc_freq(self):
         return self._doc_freq
 
@@ -124,7 +262,7 @@ class PostingReader:
 
     def get_stats(self):
         print("file name:\t", self._filename,
-              "\nfile ptr:\t", self._loc,
+              "\nlist idx:\t", self._loc,
               "\nis done:\t", self._done,
               "\nrem docs:\t", self._remaining_docs,
               "\nrem pos:\t", self._remaining_pos,
@@ -134,12 +272,607 @@ class PostingReader:
 
     def __enter__(self):
         self._f = open(self._filename, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._write_pos = self._mm[0] == 0xFF  # first byte of the file is the header
+        stat = os.fstat(self._f.fileno())
+        self._file_key = (os.path.abspath(self._filename), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # parameters here are required by Python, we won't use them
+        self._mm.close()
+        self._f.close()
+
+
+class TermDictionary:
+    """
+    An interface for the dictionary file written by write_dictionary. Works like a read-only Dict[TermId, int]
+    of term ID -> postings file pointer, i.e. supports 'in', [], len() and iteration (in ascending order of term ID),
+    so it can be handed to a PostingReader. It also keeps the doc frequency of every term.
+    Word IDs are the ranks of the words in sorted order, and get_word_id turns a word back into its word ID.
+
+    The dictionary file is memory-mapped and never loaded as a whole. Looking up a word binary searches the first
+    words of the blocks for the block the word would be in, then decodes just that one block. Looking up a term ID
+    goes straight to its block. The last block decoded is kept, since lookups tend to hit the same word repeatedly.
+    """
+
+    def __init__(self, file: str):
+        self._filename: str = file
+        self._f = open(file, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._num_words, self._num_terms, self._block_size = DICT_HEADER.unpack_from(self._mm, 0)
+        num_blocks = -(-self._num_words // self._block_size)
+        # byte offset of every block, read straight out of the file
+        blocks_start = DICT_HEADER.size + 4 * num_blocks
+        self._block_ptrs = memoryview(self._mm)[DICT_HEADER.size:blocks_start].cast("I")
+        self._cached_block: int = -1
+        self._cached_entries: List[Tuple[bytes, Dict[ZoneId, Tuple[int, DocFreq, int]]]] = []
+
+    def __contains__(self, term_id: TermId) -> bool:
+        return self._get_term_info(term_id) is not None
+
+    def __getitem__(self, term_id: TermId) -> int:
+        term_info = self._get_term_info(term_id)
+        if term_info is None:
+            raise KeyError(term_id)
+        return term_info[0]
+
+    def __len__(self) -> int:
+        return self._num_terms
+
+    def get_num_words(self) -> int:
+        """
+        :return: The number of words in the dictionary, so word IDs go from 0 up to (but not including) this
+        """
+        return self._num_words
+
+    def __iter__(self) -> Iterator[TermId]:
+        for block in range(len(self._block_ptrs)):
+            for i, (_, zones) in enumerate(self._read_block(block)):
+                word_id = block * self._block_size + i
+                for zone in zones:
+                    yield word_id * NUM_ZONES + zone
+
+    def get_doc_freq(self, term_id: TermId) -> DocFreq:
+        """
+        :param term_id: The desired term ID, which must be in the dictionary
+        :return: The document frequency of the term
+        """
+        term_info = self._get_term_info(term_id)
+        assert term_info is not None, "Term not found in dictionary!"
+        return term_info[1]
+
+    def get_word_id(self, word: str) -> Optional[WordId]:
+        """
+        :param word: The desired word
+        :return: The word ID of the word, or None if it is not in the dictionary (in any zone)
+        """
+        word_bytes = word.encode("utf-8")
+
+        # binary search for the last block whose first word is not after the word
+        lo, hi = 0, len(self._block_ptrs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._read_first_word(mid) <= word_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        block = lo - 1
+        if block < 0:
+            return None
+
+        for i, (block_word, _) in enumerate(self._read_block(block)):
+            if block_word == word_bytes:
+                return block * self._block_size + i
+            if block_word > word_bytes:  # words are sorted, so it is not here
+                break
+        return None
+
+    def get_term_id(self, word: str, zone: ZoneId) -> Optional[TermId]:
+        """
+        :param word: The desired word
+        :param zone: The desired zone
+        :return: The term ID of the word in that zone, or None if it is not in the dictionary
+        """
+        word_id = self.get_word_id(word)
+        if word_id is None:
+            return None
+        term_id = word_id * NUM_ZONES + zone
+        return term_id if term_id in self else None
+
+    def get_word(self, word_id: WordId) -> str:
+        """
+        :param word_id: The ID of a word
+        :return: The word with that ID
+        """
+        assert 0 <= word_id < self._num_words, "Word ID out of range!"
+        block, i = divmod(word_id, self._block_size)
+        return self._read_block(block)[i][0].decode("utf-8")
+
+    def get_term(self, term_id: TermId) -> Term:
+        """
+        Turns a term ID back into a readable term, like "title@appeal". Mostly useful for debugging.
+        :param term_id: The ID of a term
+        :return: The term with that ID
+        """
+        word_id, zone = divmod(term_id, NUM_ZONES)
+        return ZONE_NAMES[zone] + "@" + self.get_word(word_id)
+
+    def _get_term_info(self, term_id: TermId) -> Optional[Tuple[int, DocFreq, int]]:
+        """
+        :param term_id: The desired term ID
+        :return: Tuple of the postings file pointer, doc frequency and encoded max score, or None if not found
+        """
+        word_id, zone = divmod(term_id, NUM_ZONES)
+        if not 0 <= word_id < self._num_words:
+            return None
+        block, i = divmod(word_id, self._block_size)
+        return self._read_block(block)[i][1].get(zone)
+
+    def _read_first_word(self, block: int) -> bytes:
+        """
+        :param block: The block number
+        :return: The first word of the block, which is stored in full
+        """
+        _, ptr = decode_variable_byte(self._mm, self._block_ptrs[block])  # prefix_len is always 0
+        word_len, ptr = decode_variable_byte(self._mm, ptr)
+        return self._mm[ptr:ptr + word_len]
+
+    def _read_block(self, block: int) -> List[Tuple[bytes, Dict[ZoneId, Tuple[int, DocFreq, int]]]]:
+        """
+        Decodes the entries of a block, undoing the front coding (see write_dictionary).
+        :param block: The block number
+        :return: List of (word bytes, zone -> (postings file pointer, doc frequency, encoded max score)) tuples
+        """
+        if block == self._cached_block:
+            return self._cached_entries
+
+        entries: List[Tuple[bytes, Dict[ZoneId, Tuple[int, DocFreq, int]]]] = []
+        ptr = self._block_ptrs[block]
+        block_len = min(self._block_size, self._num_words - block * self._block_size)
+        word_bytes = b""
+        for _ in range(block_len):
+            prefix_len, ptr = decode_variable_byte(self._mm, ptr)
+            suffix_len, ptr = decode_variable_byte(self._mm, ptr)
+            word_bytes = word_bytes[:prefix_len] + self._mm[ptr:ptr + suffix_len]
+            ptr += suffix_len
+            zone_mask, ptr = decode_variable_byte(self._mm, ptr)
+            zones: Dict[ZoneId, Tuple[int, DocFreq, int]] = {}
+            for zone in range(NUM_ZONES):
+                if zone_mask & (1 << zone):
+                    postings_ptr, ptr = decode_variable_byte(self._mm, ptr)
+                    doc_freq, ptr = decode_variable_byte(self._mm, ptr)
+                    max_score, ptr = decode_variable_byte(self._mm, ptr)
+                    zones[zone] = postings_ptr, doc_freq, max_score
+            entries.append((word_bytes, zones))
+
+        self._cached_block, self._cached_entries = block, entries
+        return entries
+
+    def close(self) -> None:
+        self._block_ptrs.release()  # the mmap can't be closed while this still points into it
+        self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # parameters here are required by Python, we won't use them
+        self.close()
+
+
+class DocLengths:
+    """
+    An interface for the lengths file written by write_doc_lengths. Works like a read-only Dict[DocId, DocLength]
+    (supporting 'in', [], len() and iteration in ascending order of doc ID).
+    Each doc also has an ordinal, its position in the sorted list of doc IDs. doc_ids and lengths are arrays
+    read straight out of the memory-mapped file, so doc_ids[ordinal] and lengths[ordinal] give a doc's ID and length.
+    """
+
+    def __init__(self, file: str):
+        self._filename: str = file
+        self._f = open(file, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        num_docs, = LENGTHS_HEADER.unpack_from(self._mm, 0)
+        lengths_end = LENGTHS_HEADER.size + 8 * num_docs
+        self.lengths = memoryview(self._mm)[LENGTHS_HEADER.size:lengths_end].cast("d")
+        self.doc_ids = memoryview(self._mm)[lengths_end:lengths_end + 4 * num_docs].cast("I")
+        self._ordinals: Optional[Dict[DocId, int]] = None
+
+    def get_ordinal(self, doc_id: DocId) -> Optional[int]:
+        """
+        :param doc_id: The doc ID
+        :return: The ordinal of the doc, or None if it is not in the collection
+        """
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+    def get_ordinals(self) -> Dict[DocId, int]:
+        """
+        Gets a dictionary of doc ID -> ordinal, for when many docs need to be looked up quickly.
+        It is only built once, on the first call.
+        :return: The dictionary of doc ID -> ordinal
+        """
+        if self._ordinals is None:
+            self._ordinals = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        return self._ordinals
+
+    def __contains__(self, doc_id: DocId) -> bool:
+        return self.get_ordinal(doc_id) is not None
+
+    def __getitem__(self, doc_id: DocId) -> DocLength:
+        i = self.get_ordinal(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        return self.lengths[i]
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> Iterator[DocId]:
+        return iter(self.doc_ids)
+
+    def close(self) -> None:
+        self.lengths.release()  # the mmap can't be closed while these still point into it
+        self.doc_ids.release()
+        self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # parameters here are required by Python, we won't use them
+        self.close()
+
+
+class ChampionLists:
+    """
+    An interface for the champion file written by write_champion_lists. Works like a read-only
+    Dict[DocId, List[Tuple[TermId, TermWeight]]] (supporting 'in' and []), but only the rows of the docs
+    actually asked for are ever read from the memory-mapped file.
+    The weights are normalized tf weights, i.e. without the idf (see SegmentedChampionLists).
+    Each champion list is in ascending order of term ID.
+    """
+
+    def __init__(self, file: str, docs_len: DocLengths):
+        self._filename: str = file
+        self._docs_len: DocLengths = docs_len  # the rows are indexed by the same doc ordinals
+        self._f = open(file, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        num_docs, num_entries = CHAMPION_HEADER.unpack_from(self._mm, 0)
+        offsets_start = CHAMPION_HEADER.size
+        term_ids_start = offsets_start + 4 * (num_docs + 1)
+        weights_start = term_ids_start + 4 * num_entries
+        self._offsets = memoryview(self._mm)[offsets_start:term_ids_start].cast("I")
+        self._term_ids = memoryview(self._mm)[term_ids_start:weights_start].cast("I")
+        self._weights = memoryview(self._mm)[weights_start:weights_start + 4 * num_entries].cast("f")
+
+    def __contains__(self, doc_id: DocId) -> bool:
+        return doc_id in self._docs_len
+
+    def __getitem__(self, doc_id: DocId) -> List[Tuple[TermId, TermWeight]]:
+        i = self._docs_len.get_ordinal(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return list(zip(self._term_ids[start:end], self._weights[start:end]))
+
+    def close(self) -> None:
+        for view in (self._offsets, self._term_ids, self._weights):
+            view.release()  # the mmap can't be closed while these still point into it
+        self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # parameters here are required by Python, we won't use them
+        self.close()
+
+
+class DocStore:
+    """
+    An interface for the doc store file written by write_doc_store. Works like a read-only Dict[DocId, List[str]]
+    of doc ID -> row of the input CSV file (supporting 'in', [], len() and iteration in ascending order of doc ID).
+    The doc store only holds where each row is in the input CSV file, so getting a row is a single seek and read
+    of just that row, and the CSV file must still be where it was when indexing.
+    """
+
+    def __init__(self, file: str):
+        self._filename: str = file
+        self._f = open(file, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        num_docs, sources_len = DOCSTORE_HEADER.unpack_from(self._mm, 0)
+        sources_start = DOCSTORE_HEADER.size
+        self._sources: List[str] = self._mm[sources_start:sources_start + sources_len].decode("utf-8").split("\n")
+        offsets_start = sources_start + -(-sources_len // 8) * 8  # padded, so the offsets are 8-byte aligned
+        doc_ids_start = offsets_start + 8 * num_docs
+        row_lens_start = doc_ids_start + 4 * num_docs
+        source_ids_start = row_lens_start + 4 * num_docs
+        self._offsets = memoryview(self._mm)[offsets_start:doc_ids_start].cast("Q")
+        self.doc_ids = memoryview(self._mm)[doc_ids_start:row_lens_start].cast("I")
+        self._row_lens = memoryview(self._mm)[row_lens_start:source_ids_start].cast("I")
+        self._source_ids = memoryview(self._mm)[source_ids_start:source_ids_start + 4 * num_docs].cast("I")
+        self._source_fps: Dict[int, io.BufferedReader] = {}  # opened on first use
+
+    def get_location(self, doc_id: DocId) -> Optional[Tuple[str, int, int]]:
+        """
+        :param doc_id: The doc ID
+        :return: Tuple of the input CSV file name, and the byte offset and length of the doc's row in it,
+                 or None if the doc is not in the doc store
+        """
+        i = bisect_left(self.doc_ids, doc_id)
+        if i == len(self.doc_ids) or self.doc_ids[i] != doc_id:
+            return None
+        return self._sources[self._source_ids[i]], self._offsets[i], self._row_lens[i]
+
+    def __contains__(self, doc_id: DocId) -> bool:
+        return self.get_location(doc_id) is not None
+
+    def __getitem__(self, doc_id: DocId) -> List[str]:
+        """
+        :param doc_id: The doc ID
+        :return: The doc's row of the input CSV file, i.e. [doc_id, title, content, date_posted, court]
+        """
+        location = self.get_location(doc_id)
+        if location is None:
+            raise KeyError(doc_id)
+        source, offset, row_len = location
+        if source not in self._source_fps:
+            self._source_fps[source] = open(source, "rb")
+        source_fp = self._source_fps[source]
+        source_fp.seek(offset)
+        row_text = source_fp.read(row_len).decode("utf-8")
+        return next(csv.reader(io.StringIO(row_text, newline="")))
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> Iterator[DocId]:
+        return iter(self.doc_ids)
+
+    def close(self) -> None:
+        for view in (self._offsets, self.doc_ids, self._row_lens, self._source_ids):
+            view.release()  # the mmap can't be closed while these still point into it
+        self._mm.close()
+        self._f.close()
+        for source_fp in self._source_fps.values():
+            source_fp.close()
+
+    def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         # parameters here are required by Python, we won't use them
+        self.close()
+
+
+class DateIndex:
+    """
+    An interface for the dates file written by write_date_index, i.e. the docs sorted by the date they were posted.
+    dates and doc_ids are arrays read straight out of the memory-mapped file, so the docs posted within any date
+    range are a single slice of doc_ids, found with a binary search. Dates are proleptic Gregorian ordinals
+    (see date.toordinal). Iterating over it gives (date, doc ID) pairs, in ascending order of date.
+    """
+
+    def __init__(self, file: str):
+        self._filename: str = file
+        self._f = open(file, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        num_docs, = DATES_HEADER.unpack_from(self._mm, 0)
+        dates_end = DATES_HEADER.size + 4 * num_docs
+        self.dates = memoryview(self._mm)[DATES_HEADER.size:dates_end].cast("I")
+        self.doc_ids = memoryview(self._mm)[dates_end:dates_end + 4 * num_docs].cast("I")
+
+    def get_doc_ids(self, start_date: int, end_date: int) -> memoryview:
+        """
+        :param start_date: The first date of the range, as an ordinal
+        :param end_date: The last date of the range (inclusive), as an ordinal
+        :return: The doc IDs of the docs posted within the range, in ascending order of date
+        """
+        return self.doc_ids[bisect_left(self.dates, start_date):bisect_left(self.dates, end_date + 1)]
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> Iterator[Tuple[int, DocId]]:
+        return zip(self.dates, self.doc_ids)
+
+    def close(self) -> None:
+        self.dates.release()  # the mmap can't be closed while these still point into it
+        self.doc_ids.release()
+        self._mm.close()
         self._f.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # parameters here are required by Python, we won't use them
+        self.close()
+
+
+class PostingCursor:
+    """
+    A cursor over a single posting list, for going through it one doc at a time in ascending order of doc ID
+    (e.g. to intersect posting lists for boolean and phrasal queries). Reads straight from the postings file,
+    so the posting list is never decoded as a whole. Term positions are only decoded when asked for, and
+    .skip_to() uses the skip pointers to jump over whole blocks of docs.
+    Get one from PostingReader.get_cursor(), or make one directly over any bytes-like object.
+    """
+
+    def __init__(self, buf, ptr: int, write_pos: bool):
+        self._buf = buf
+        self._write_pos: bool = write_pos
+        self._doc_freq, ptr = decode_variable_byte(buf, ptr)
+        _, ptr = decode_variable_byte(buf, ptr)  # max score
+        num_skips, ptr = decode_variable_byte(buf, ptr)
+
+        # skip pointer i jumps to the start of block i + 1, and holds the last doc ID before that block
+        # along with the byte offset of the block (from the start of the doc entries)
+        self._skip_docs: List[DocId] = []
+        self._skip_offsets: List[int] = []
+        for _ in range(num_skips):
+            skip_doc, ptr = decode_variable_byte(buf, ptr)
+            skip_offset, ptr = decode_variable_byte(buf, ptr)
+            self._skip_docs.append(skip_doc)
+            self._skip_offsets.append(skip_offset)
+        self._skip_interval: int = get_skip_interval(self._doc_freq)
+
+        self._start: int = ptr          # byte offset of the first doc entry
+        self._ptr: int = ptr            # byte offset of the next doc entry
+        self._doc_idx: int = -1         # index of the current doc in the posting list
+        self._doc: Optional[DocId] = 0  # current doc ID, or None once we run out of docs
+        self._term_freq: TermFreq = 0   # term frequency of the current doc
+        self._pos_ptr: int = 0          # byte offset of the term positions of the current doc
+        self._pos_bytes: int = 0        # number of bytes taken up by the term positions of the current doc
+        self.next()
+
+    def doc(self) -> Optional[DocId]:
+        """
+        :return: The current doc ID, or None if there are no docs left
+        """
+        return self._doc
+
+    def term_freq(self) -> TermFreq:
+        """
+        :return: The term frequency of the current doc
+        """
+        return self._term_freq
+
+    def get_doc_freq(self) -> DocFreq:
+        return self._doc_freq
+
+    def next(self) -> Optional[DocId]:
+        """
+        Moves on to the next doc.
+        :return: The new current doc ID, or None if there are no docs left
+        """
+        self._doc_idx += 1
+        if self._doc_idx >= self._doc_freq:
+            self._doc = None
+            return None
+        doc_gap, self._ptr = decode_variable_byte(self._buf, self._ptr)
+        self._term_freq, self._ptr = decode_variable_byte(self._buf, self._ptr)
+        self._doc += doc_gap  # undo gap encoding
+        if self._write_pos:
+            self._pos_bytes, self._pos_ptr = decode_variable_byte(self._buf, self._ptr)
+            self._ptr = self._pos_ptr + self._pos_bytes  # jump over the term positions
+        return self._doc
+
+    def skip_to(self, target: DocId) -> Optional[DocId]:
+        """
+        Moves forward to the first doc with an ID of at least target (or stays put, if already there).
+        :param target: The doc ID to skip to
+        :return: The new current doc ID, or None if there are no such docs
+        """
+        if self._doc is None or self._doc >= target:
+            return self._doc
+
+        # every doc before block i + 1 is at most self._skip_docs[i], so if that is still smaller than
+        # the target, we can jump straight to the start of block i + 1 (only if that is ahead of us)
+        i = bisect_left(self._skip_docs, target) - 1
+        if i >= 0 and (i + 1) * self._skip_interval > self._doc_idx:
+            self._ptr = self._start + self._skip_offsets[i]
+            self._doc = self._skip_docs[i]
+            self._doc_idx = (i + 1) * self._skip_interval - 1
+            self.next()
+
+        while self._doc is not None and self._doc < target:
+            self.next()
+        return self._doc
+
+    def positions(self) -> array:
+        """
+        Decodes the term positions of the current doc.
+        :return: The sorted array of term positions
+        """
+        assert self._write_pos, "Postings file has no term positions!"
+        term_pos_gaps = decode_variable_bytes(self._buf[self._pos_ptr:self._pos_ptr + self._pos_bytes])
+        return array('L', accumulate(term_pos_gaps))  # undo gap encoding
+
+
+def decode_posting_list(buf, ptr: int, write_pos: bool, read_pos: bool = True) -> array:
+    """
+    Decodes a whole posting list (in the format described in serialize_posting) starting from
+    byte ptr of buf, into a flat array of integers:
+        (doc_freq)(max_score)(doc_id)(term_freq)(tp_1)...(tp_m)(doc_id)(term_freq)...
+    Doc IDs are turned back from gaps into actual doc IDs, the skip pointers are left out, and
+    term positions are left gap encoded. If read_pos is False, the term positions are jumped over
+    without being decoded, giving just:
+        (doc_freq)(max_score)(doc_id)(term_freq)(doc_id)(term_freq)...
+    :param buf: The bytes-like object (e.g. a memory-mapped postings file) to decode from
+    :param ptr: The byte offset of the posting list
+    :param write_pos: Whether the posting list has term positions
+    :param read_pos: Whether to decode the term positions
+    :return: The array of decoded integers
+    """
+    ints = array('L')
+    doc_freq, ptr = decode_variable_byte(buf, ptr)
+    max_score, ptr = decode_variable_byte(buf, ptr)
+    num_skips, ptr = decode_variable_byte(buf, ptr)
+    for _ in range(2 * num_skips):  # we read the whole list anyway, so the skip pointers are not needed
+        _, ptr = decode_variable_byte(buf, ptr)
+    ints.append(doc_freq)
+    ints.append(max_score)
+    doc_id = 0
+    for _ in range(doc_freq):
+        doc_gap, ptr = decode_variable_byte(buf, ptr)
+        term_freq, ptr = decode_variable_byte(buf, ptr)
+        doc_id += doc_gap  # undo gap encoding
+        ints.append(doc_id)
+        ints.append(term_freq)
+        if write_pos:
+            pos_bytes, ptr = decode_variable_byte(buf, ptr)
+            if read_pos:
+                ints.extend(decode_variable_bytes(buf[ptr:ptr + pos_bytes]))
+            ptr += pos_bytes
+    return ints
+
+
+def decode_variable_byte(buf, ptr: int) -> Tuple[int, int]:
+    """
+    Decodes the single variable byte encoded integer starting from byte ptr of buf.
+    :param buf: The bytes-like object to decode from
+    :param ptr: The byte offset of the integer
+    :return: Tuple of the decoded integer and the byte offset right after it
+    """
+    new_int = 0
+    bits = 0
+    while True:
+        byte = buf[ptr]
+        ptr += 1
+        if byte >= 128:
+            return new_int + ((byte - 128) << bits), ptr
+        new_int += byte << bits
+        bits += 7
+
+
+def decode_variable_bytes(data: bytes) -> List[int]:
+    """
+    Decodes every variable byte encoded integer in data, in one pass.
+    Used when we know the exact byte extent of a run of integers, like the term positions of a doc.
+    :param data: The bytes to decode
+    :return: The list of decoded integers
+    """
+    ints = []
+    new_int = 0
+    bits = 0
+    for byte in data:
+        if byte >= 128:
+            ints.append(new_int + ((byte - 128) << bits))
+            new_int = 0
+            bits = 0
+        else:
+            new_int += byte << bits
+            bits += 7
+    return ints
+
 
 def unpickle_file(filename):
     """
@@ -149,44 +882,50 @@ def unpickle_file(filename):
 
 
 # === WRITING ===
-# write_block -> Writes in-memory dictionary into a block (dictionary + posting files)
+# write_postings -> Writes (term, posting list) pairs into the dictionary + postings files
+# write_doc_lengths -> Writes the doc lengths into their own file
+# write_champion_chunk -> Writes the champion lists of a range of docs to disk, to be joined later
+# write_champion_lists -> Joins champion chunks into the champion file
+# write_doc_store -> Writes where each doc is in the input CSV file
+# write_date_index -> Writes the doc IDs sorted by the date each doc was posted
+# write_partial_block -> Writes a SPIMI partial block to disk, to be merged later
 # serialize_posting -> Turns a posting list into a formatted string
 
 
-def write_block(dictionary: Dict[Term, Dict[DocId, List[TermPos]]],
-                docs_len_dct: Dict[DocId, DocLength],
-                champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]],
-                out_dict: str,
-                out_postings: str,
-                out_lengths: str,
-                out_champion: str,
-                write_pos: bool = False) -> None:
+def write_postings(term_postings: Iterable[Tuple[TermId, Dict[DocId, List[TermPos]]]],
+                   words: List[str],
+                   docs_len_dct: Dict[DocId, DocLength],
+                   out_dict: str,
+                   out_postings: str,
+                   write_pos: bool = False) -> Dict[TermId, int]:
     """
-    For each (term, posting list) pair in the dictionary...
+    For each (term ID, posting list) pair in term_postings...
 
-    Each posting list is in the following format: [Dict[doc_id -> [term_pos1, ...]], doc_length]
-    We extract the Dict and pass it to serialize_posting, which returns a bytearray.
+    Each posting list is in the following format: Dict[doc_id -> [term_pos1, ...]]
+    We pass it to serialize_posting, which returns a bytearray.
     The serialized posting list is written into the postings file.
     We count the number of characters written so far as cumulative_ptr.
 
-    As each term is written, we write the (term -> cumulative_ptr) pair into final_dict.
+    The word IDs used while indexing follow the order the words first appeared in. In the final files, words
+    are numbered by their rank in sorted order instead (see get_word_ranks), so every term ID is renumbered.
+    As each term is written, we write the (final term ID -> cumulative_ptr) pair into final_dict.
     The cumulative_ptr can be used to directly grab a posting list from the postings file.
+    The pointers are written into the dictionary file (see write_dictionary), along with the doc frequency and
+    max score of each term, taken from the header of its posting list.
 
-    The dictionary mapping doc_id to doc_length is made in the top-level index.py entry method,
-    and is passed in here via docs_len_dct.
-
-    The (final_dict, docs_len_dct) tuple is written into the dictionary file using pickle.
-    :param dictionary: The dictionary of terms to posting lists
+    Since we only need one posting list at a time, term_postings can be a generator, which is
+    how the SPIMI merge streams its output through here without holding the whole index in memory.
+    :param term_postings: An iterable of (term ID, posting list) pairs
+    :param words: The list of words, indexed by the word IDs used in term_postings
     :param docs_len_dct: The dictionary containing the length of documents
-    :param champion_dct: The dictionary containing the top K terms for each document
     :param out_dict: The desired name of the output dictionary file
     :param out_postings: The desired name of the output postings file
-    :param out_lengths: The desired name of the output lengths file
-    :param out_champion: The desired name of the output champions file
     :param write_pos: Whether to write positional indices into the postings file
-    :return: None
+    :return: The final dictionary of (final) term ID -> postings file pointer
     """
     final_dict = dict()
+    dict_entries: List[Tuple[TermId, int, DocFreq, int]] = []
+    word_ranks = get_word_ranks(words)
 
     with open(out_postings, "wb") as postings_fp:
         if write_pos:  # write postings file header
@@ -195,85 +934,419 @@ def write_block(dictionary: Dict[Term, Dict[DocId, List[TermPos]]],
             postings_fp.write(b"\x00")
         cumulative_ptr = 1  # we have already written 1 byte for the header
 
-        for term, posting_list in dictionary.items():
+        for term, posting_list in term_postings:
             posting_list_serialized: bytes
-            posting_list_serialized = serialize_posting(posting_list, write_pos)
+            posting_list_serialized = serialize_posting(posting_list, docs_len_dct, write_pos)
+
+            word_id, zone = divmod(term, NUM_ZONES)
+            term = word_ranks[word_id] * NUM_ZONES + zone
 
             # cumulative_ptr stores the number of bytes from the start of the file to the current entry
             # this lets us seek directly to the entry of the term we want
             final_dict[term] = cumulative_ptr
+            doc_freq, ptr = decode_variable_byte(posting_list_serialized, 0)
+            max_score, _ = decode_variable_byte(posting_list_serialized, ptr)
+            dict_entries.append((term, cumulative_ptr, doc_freq, max_score))
             cumulative_ptr += len(posting_list_serialized)
             postings_fp.write(posting_list_serialized)
 
-    pickle.dump(final_dict, open(out_dict, "wb"))
-    pickle.dump(docs_len_dct, open(out_lengths, "wb"))
-    pickle.dump(champion_dct, open(out_champion, "wb"))
+    sorted_words = [""] * len(words)
+    for word_id, word in enumerate(words):
+        sorted_words[word_ranks[word_id]] = word
+    write_dictionary(dict_entries, sorted_words, out_dict)
+
+    return final_dict
+
+
+def get_word_ranks(words: List[str]) -> List[WordId]:
+    """
+    Gets the rank of every word when sorted by UTF-8 bytes, which is its word ID in the final files.
+    :param words: The list of words, in any order
+    :return: The list of ranks, in the same order as the words
+    """
+    order = sorted(range(len(words)), key=lambda word_id: words[word_id].encode("utf-8"))
+    word_ranks = [0] * len(words)
+    for rank, word_id in enumerate(order):
+        word_ranks[word_id] = rank
+    return word_ranks
+
 
-    print(f"Wrote {len(dictionary)} terms into final files")
+def write_dictionary(dict_entries: List[Tuple[TermId, int, DocFreq, int]],
+                     sorted_words: List[str],
+                     out_dict: str) -> None:
+    """
+    Writes the dictionary file, to be read with TermDictionary. The byte format is:
+        (num_words)(num_terms)(block_size)[block_ptr_1][...][block_ptr_b][block_1][...][block_b]
+    The header and block pointers are unsigned integers in the machine's own format (like in an array('I')), so
+    they can be read straight out of the memory-mapped file. Each block_ptr is the byte offset of its block.
+    Words are in sorted order (by their UTF-8 bytes), so word IDs are their ranks, and they are split into blocks
+    of block_size words. Each block is front coded, so each word only stores what it doesn't share with the word
+    before it (the first word of a block is stored in full). Each [block_x] above is short for block_size entries of:
+        (prefix_len)(suffix_len)(suffix_bytes)(zone_mask)[zone_1][...][zone_z]
+    zone_mask has bit i set if the word appears in the zone with zone ID i, and there is one [zone_x] for each
+    such zone, in ascending order of zone ID:
+        (postings_ptr)(doc_freq)(max_score)
+    All of these are integers encoded using variable byte encoding, except suffix_bytes, which is the rest of
+    the UTF-8 encoded word after the prefix_len bytes shared with the word before it.
+    Every word is only stored once for all its zones, and all the zones of a word are found in one lookup.
+    :param dict_entries: List of (term ID, postings file pointer, doc frequency, encoded max score) tuples
+    :param sorted_words: The sorted list of words, so sorted_words[word_id] is the word
+    :param out_dict: The desired name of the output dictionary file
+    :return: None
+    """
+    # group the entries by word
+    word_entries: List[List[Tuple[ZoneId, int, DocFreq, int]]] = [[] for _ in sorted_words]
+    for term, ptr, doc_freq, max_score in dict_entries:
+        word_id, zone = divmod(term, NUM_ZONES)
+        word_entries[word_id].append((zone, ptr, doc_freq, max_score))
+
+    blocks: List[bytes] = []
+    for start in range(0, len(sorted_words), DICT_BLOCK_SIZE):
+        block = bytearray()
+        prev_word = b""
+        for word_id in range(start, min(start + DICT_BLOCK_SIZE, len(sorted_words))):
+            word_bytes = sorted_words[word_id].encode("utf-8")
+            prefix_len = 0
+            max_prefix_len = min(len(prev_word), len(word_bytes))
+            while prefix_len < max_prefix_len and prev_word[prefix_len] == word_bytes[prefix_len]:
+                prefix_len += 1
+            block += variable_byte_encode(prefix_len) + variable_byte_encode(len(word_bytes) - prefix_len)
+            block += word_bytes[prefix_len:]
+
+            zone_mask = 0
+            zone_info: List[int] = []
+            for zone, ptr, doc_freq, max_score in sorted(word_entries[word_id]):
+                zone_mask |= 1 << zone
+                zone_info += [ptr, doc_freq, max_score]
+            block += b"".join(map(variable_byte_encode, [zone_mask] + zone_info))
+            prev_word = word_bytes
+        blocks.append(bytes(block))
+
+    block_ptrs = array("I")
+    cumulative_ptr = DICT_HEADER.size + block_ptrs.itemsize * len(blocks)
+    for block in blocks:
+        block_ptrs.append(cumulative_ptr)
+        cumulative_ptr += len(block)
+
+    with open(out_dict, "wb") as dict_fp:
+        dict_fp.write(DICT_HEADER.pack(len(sorted_words), len(dict_entries), DICT_BLOCK_SIZE))
+        dict_fp.write(block_ptrs.tobytes())
+        for block in blocks:
+            dict_fp.write(block)
+
+
+def write_doc_lengths(docs_len_dct: Dict[DocId, DocLength], out_lengths: str) -> None:
+    """
+    Writes the doc lengths into their own file, as flat arrays that can be memory-mapped by DocLengths.
+    Docs are numbered by their ordinal, i.e. their position in the sorted list of doc IDs.
+    The byte format of the lengths file is:
+        (num_docs)[length_1][...][length_n][doc_id_1][...][doc_id_n]
+    Lengths are 8-byte floats and everything else is an unsigned integer, all in the machine's own format
+    (like in an array).
+    :param docs_len_dct: The dictionary containing the length of documents
+    :param out_lengths: The desired name of the output lengths file
+    :return: None
+    """
+    doc_ids = sorted(docs_len_dct.keys())
+
+    with open(out_lengths, "wb") as lengths_fp:
+        lengths_fp.write(LENGTHS_HEADER.pack(len(doc_ids)))
+        lengths_fp.write(array("d", (docs_len_dct[doc_id] for doc_id in doc_ids)).tobytes())
+        lengths_fp.write(array("I", doc_ids).tobytes())
+
+
+def write_champion_chunk(champion_rows: List[Tuple[DocId, List[Tuple[TermId, TermWeight]]]], out_chunk: str) -> None:
+    """
+    Writes the champion lists of a range of docs to a chunk file, to be joined with the other chunks later by
+    write_champion_lists. A chunk file has the same byte format as the champion file itself (see write_champion_lists),
+    with the docs numbered from 0 within the chunk.
+    :param champion_rows: The (doc ID, list of (term ID, tf weight) tuples sorted by term ID) pairs, sorted by doc ID
+    :param out_chunk: The desired name of the output chunk file
+    :return: None
+    """
+    offsets = array("I", [0])
+    champion_term_ids = array("I")
+    weights = array("f")
+    for _, champion_list in champion_rows:
+        for term, weight in champion_list:
+            champion_term_ids.append(term)
+            weights.append(weight)
+        offsets.append(len(champion_term_ids))
+
+    with open(out_chunk, "wb") as chunk_fp:
+        chunk_fp.write(CHAMPION_HEADER.pack(len(champion_rows), len(champion_term_ids)))
+        chunk_fp.write(offsets.tobytes())
+        chunk_fp.write(champion_term_ids.tobytes())
+        chunk_fp.write(weights.tobytes())
+
+
+def write_champion_lists(in_chunks: Iterable[str], num_docs: int, out_champion: str) -> None:
+    """
+    Joins chunk files written by write_champion_chunk into the champion file, as flat arrays that can be
+    memory-mapped by ChampionLists. Docs are numbered by their ordinal, i.e. their position in the sorted list of
+    doc IDs, so the chunks must come in ascending order of doc ID and cover every doc between them.
+    The byte format of the champion file is:
+        (num_docs)(num_entries)[offset_1][...][offset_n+1][term_id_1][...][term_id_m][weight_1][...][weight_m]
+    The champion list of the doc with ordinal i is the entries from offset_i up to (but not including)
+    offset_i+1. The weights are normalized tf weights, (1 + log(tf)) / doc_length, and the idf is only applied
+    when searching, so that it can take every segment of the index into account.
+    Weights are 4-byte floats, and everything else is an unsigned integer, all in the machine's own format
+    (like in an array).
+    Only one chunk is read into memory at a time: the term IDs go straight into the champion file, and the
+    weights go into a temporary file that is appended once all the term IDs are in. Only the offsets are kept
+    in memory, and are written (along with the header) at the end.
+    :param in_chunks: The names of the chunk files, in ascending order of doc ID
+    :param num_docs: The total number of docs in the chunks
+    :param out_champion: The desired name of the output champion file
+    :return: None
+    """
+    offsets = array("I", [0])
+    champion_dir = os.path.dirname(os.path.abspath(out_champion))
+    with open(out_champion, "wb") as champion_fp, tempfile.TemporaryFile(dir=champion_dir) as weights_fp:
+        champion_fp.seek(CHAMPION_HEADER.size + 4 * (num_docs + 1))  # leave space for the header and offsets
+        for in_chunk in in_chunks:
+            with open(in_chunk, "rb") as chunk_fp:
+                chunk_docs, chunk_entries = CHAMPION_HEADER.unpack(chunk_fp.read(CHAMPION_HEADER.size))
+                chunk_offsets = array("I")
+                chunk_offsets.fromfile(chunk_fp, chunk_docs + 1)
+                last_offset = offsets[-1]
+                offsets.extend(last_offset + offset for offset in chunk_offsets[1:])
+                champion_fp.write(chunk_fp.read(4 * chunk_entries))
+                weights_fp.write(chunk_fp.read(4 * chunk_entries))
+        assert len(offsets) == num_docs + 1, "Champion chunks do not cover every doc!"
+
+        weights_fp.seek(0)
+        shutil.copyfileobj(weights_fp, champion_fp)
+        champion_fp.seek(0)
+        champion_fp.write(CHAMPION_HEADER.pack(num_docs, offsets[-1]))
+        champion_fp.write(offsets.tobytes())
+
+
+def write_doc_store(doc_locations: Dict[DocId, Tuple[str, int, int]], out_docstore: str) -> None:
+    """
+    Writes the doc store file, to be read with DocStore. Instead of a copy of each doc, it holds where each doc's row
+    is in the input CSV file(s), so a doc can be read again with a single seek. The byte format is:
+        (num_docs)(sources_len)[sources][padding][offset_1][...][offset_n][doc_id_1][...][doc_id_n]
+        [row_len_1][...][row_len_n][source_id_1][...][source_id_n]
+    sources is the UTF-8 encoded, newline separated list of the (absolute) names of the input CSV files, taking up
+    sources_len bytes, and it is padded with zero bytes to a multiple of 8 bytes. Docs are in ascending order of
+    doc ID, and doc i is the row_len_i bytes starting from byte offset_i of the input CSV file numbered source_id_i.
+    Offsets are 8-byte unsigned integers, and everything else is a 4-byte unsigned integer, all in the
+    machine's own format (like in an array).
+    :param doc_locations: The dictionary of doc ID -> (input CSV file name, byte offset, byte length) of its row
+    :param out_docstore: The desired name of the output doc store file
+    :return: None
+    """
+    doc_ids = sorted(doc_locations.keys())
+
+    source_ids: Dict[str, int] = {}
+    for doc_id in doc_ids:
+        source_ids.setdefault(os.path.abspath(doc_locations[doc_id][0]), len(source_ids))
+    sources = "\n".join(source_ids.keys()).encode("utf-8")
+
+    with open(out_docstore, "wb") as docstore_fp:
+        docstore_fp.write(DOCSTORE_HEADER.pack(len(doc_ids), len(sources)))
+        docstore_fp.write(sources + bytes(-len(sources) % 8))
+        docstore_fp.write(array("Q", (doc_locations[doc_id][1] for doc_id in doc_ids)).tobytes())
+        docstore_fp.write(array("I", doc_ids).tobytes())
+        docstore_fp.write(array("I", (doc_locations[doc_id][2] for doc_id in doc_ids)).tobytes())
+        docstore_fp.write(array("I", (source_ids[os.path.abspath(doc_locations[doc_id][0])]
+                                      for doc_id in doc_ids)).tobytes())
+
+
+def write_date_index(doc_dates: Dict[DocId, int], out_dates: str) -> None:
+    """
+    Writes the dates file, to be read with DateIndex. The byte format is:
+        (num_docs)[date_1][...][date_n][doc_id_1][...][doc_id_n]
+    Docs are in ascending order of the date they were posted (then of doc ID), and dates are proleptic Gregorian
+    ordinals (see date.toordinal). Docs without a date are left out. Dates and doc IDs are 4-byte unsigned
+    integers, all in the machine's own format (like in an array).
+    :param doc_dates: The dictionary of doc ID -> the date it was posted, as an ordinal
+    :param out_dates: The desired name of the output dates file
+    :return: None
+    """
+    date_docs = sorted((date, doc_id) for doc_id, date in doc_dates.items())
+    with open(out_dates, "wb") as dates_fp:
+        dates_fp.write(DATES_HEADER.pack(len(date_docs)))
+        dates_fp.write(array("I", (date for date, _ in date_docs)).tobytes())
+        dates_fp.write(array("I", (doc_id for _, doc_id in date_docs)).tobytes())
+
+
+def write_partial_block(dictionary: Dict[TermId, Dict[DocId, List[TermPos]]],
+                        docs_len_dct: Dict[DocId, DocLength],
+                        out_block: str) -> None:
+    """
+    Writes an in-memory SPIMI block to disk, sorted by term ID so that blocks can be k-way merged later.
+    Word IDs are handed out for the whole indexing run, so a term has the same term ID in every block.
+    Each entry in the block file is in the following format:
+        (term_id)(posting_len)[serialized posting list]
+    term_id and posting_len are variable byte encoded, and the posting list is serialized (with term positions)
+    exactly like in the final postings file, taking up posting_len bytes.
+    :param dictionary: The dictionary of term IDs to posting lists for this block
+    :param docs_len_dct: The dictionary containing the length of documents (at least those in this block)
+    :param out_block: The desired name of the output block file
+    :return: None
+    """
+    with open(out_block, "wb") as block_fp:
+        for term in sorted(dictionary):
+            block_fp.write(variable_byte_encode(term))
+            posting_list_serialized = serialize_posting(dictionary[term], docs_len_dct, True)
+            block_fp.write(variable_byte_encode(len(posting_list_serialized)))
+            block_fp.write(posting_list_serialized)
+
+
+def make_block_read_generator(in_block: str) -> Iterator[Tuple[TermId, Dict[DocId, List[TermPos]]]]:
+    """
+    Generator function for the next (term ID, posting list) pair in a block file written by write_partial_block.
+    Pairs come out in ascending order of term ID.
+    :param in_block: The name of the block file
+    :return: A generator object for the (term ID, posting list) pairs
+    """
+    with open(in_block, "rb") as block_fp:
+        while True:
+            if not block_fp.peek(1):  # end of block
+                return
+            term = variable_byte_decode(block_fp)
+
+            posting_len = variable_byte_decode(block_fp)
+            cursor = PostingCursor(block_fp.read(posting_len), 0, True)
+
+            posting_list: Dict[DocId, List[TermPos]] = dict()
+            while cursor.doc() is not None:
+                posting_list[cursor.doc()] = cursor.positions()
+                cursor.next()
+            yield term, posting_list
+
+
+def merge_blocks(in_blocks: List[str]) -> Iterator[Tuple[TermId, Dict[DocId, List[TermPos]]]]:
+    """
+    K-way merges the given SPIMI block files into a single stream of (term ID, posting list) pairs,
+    in ascending order of term ID. Only one entry per block is held in memory at any time (plus the
+    posting lists of the term currently being merged).
+    Blocks are flushed between documents, so the same doc ID never appears in two blocks and
+    merging the posting lists of a term is just a union of the per-block dictionaries.
+    :param in_blocks: The names of the block files
+    :return: A generator object for the merged (term ID, posting list) pairs
+    """
+    block_generators = [make_block_read_generator(block) for block in in_blocks]
+    merged = heapq.merge(*block_generators, key=lambda entry: entry[0])
+    for term, entries in groupby(merged, key=lambda entry: entry[0]):
+        posting_list: Dict[DocId, List[TermPos]] = dict()
+        for _, block_posting_list in entries:
+            posting_list.update(block_posting_list)
+        yield term, posting_list
 
 
 def serialize_posting(posting_list: Dict[DocId, List[TermPos]],
+                      docs_len_dct: Dict[DocId, DocLength],
                       write_pos: bool) -> bytes:
     """
     Turns a posting list into a bytearray, and returns the bytearray.
     The byte format is:
-        (doc_freq)[doc_1][doc_2][...][doc_n]
-    If term positions are to be stored, each [doc_x] above is short for the following:
-        (doc_id)(term_freq)(tp_1)(tp_2)(...)(tp_m)
+        (doc_freq)(max_score)(num_skips)[skip_1][...][skip_s][doc_1][doc_2][...][doc_n]
+    max_score is an upper bound on the normalized tf weight, (1 + log(tf)) / doc_length, of the term
+    in any doc, stored as an integer (see encode_max_score). Searching uses it to skip documents
+    that cannot make it into the top k.
+    Docs are in ascending order of doc ID. If term positions are to be stored, each [doc_x] above is short for:
+        (doc_gap)(term_freq)(pos_bytes)(tp_1)(tp_2)(...)(tp_m)
     Otherwise, each [doc_x] above is for the following:
-        (doc_id)(term_freq)
+        (doc_gap)(term_freq)
     All items in the byte format, when fully expanded, are integers encoded using variable byte encoding.
-    The term positions are encoded using gap encoding (before variable byte encoding).
+    The doc IDs and the term positions are encoded using gap encoding (before variable byte encoding).
+    pos_bytes is the number of bytes taken up by (tp_1)...(tp_m), so readers that only need the
+    term frequencies (i.e. free text scoring) can jump straight over the positions without decoding them.
+
+    The docs are split into blocks of get_skip_interval(doc_freq) docs, and each [skip_x] is a skip pointer
+    to the start of block x (block 0 needs none):
+        (last_doc_id)(byte_offset)
+    last_doc_id is the (actual) ID of the last doc before the block, which is also what the first doc gap
+    of the block is relative to. byte_offset is where the block starts, counted from the start of [doc_1].
     Delimiters are unnecessary as we encode the exact number of entries to expect.
     :param posting_list: The posting list to be serialized
+    :param docs_len_dct: The dictionary containing the length of documents
     :param write_pos: Whether to write positional indices into the postings file serialization
     :returns: Bytearray representing the serialized posting list
     """
 
-    # convert the dictionary into a list of tuples (doc_id, [term_pos])
-    posting_list = list(posting_list.items())
+    # convert the dictionary into a list of tuples (doc_id, [term_pos]), sorted by doc ID
+    posting_list = sorted(posting_list.items())
     doc_freq = len(posting_list)
+    max_score = max((1 + log10(len(term_pos_list))) / docs_len_dct[doc_id]
+                    for doc_id, term_pos_list in posting_list)
 
-    # we take the 2nd element (term_freq) to sort by descending term frequency
-    posting_list = sorted(posting_list, key=lambda x: -len(x[1]))
-
-    # the prepare_entry method gives us a list of integers
-    # by running it on each item in the posting list, we get a nested list of integers
-    # we flatten that to get our final list of integers
-    def flatten(arr): return list(chain.from_iterable(arr))
-    prepared_entries: List[int]
+    # the prepare_entry method gives us the serialized [doc_x] of each item in the posting list
+    serialized_entries: List[bytes] = []
+    prev_doc = 0
+    for doc_id, term_pos_list in posting_list:
+        if write_pos:
+            serialized_entries.append(prepare_entry(doc_id - prev_doc, term_pos_list))
+        else:
+            serialized_entries.append(variable_byte_encode(doc_id - prev_doc)
+                                      + variable_byte_encode(len(term_pos_list)))
+        prev_doc = doc_id
 
-    if write_pos:
-        nested_entries = [prepare_entry(doc_id, term_pos_list) for doc_id, term_pos_list in posting_list]
-    else:
-        nested_entries = [(doc_id, len(term_pos_list)) for doc_id, term_pos_list in posting_list]
-        nested_entries = sorted(nested_entries, key=lambda x: -x[1])
-    prepared_entries = flatten(nested_entries)
+    # make a skip pointer at the start of every block (except the first)
+    skip_interval = get_skip_interval(doc_freq)
+    skips: List[int] = []
+    byte_offset = 0
+    for i, serialized_entry in enumerate(serialized_entries):
+        if i > 0 and i % skip_interval == 0:
+            skips += [posting_list[i - 1][0], byte_offset]
+        byte_offset += len(serialized_entry)
 
     # add in the header as described in the docstring
-    header = [doc_freq]
-    final_entries = header + prepared_entries
+    header = [doc_freq, encode_max_score(max_score), len(skips) // 2] + skips
+    serialized_header = b"".join(map(variable_byte_encode, header))
+
+    return serialized_header + b"".join(serialized_entries)  # flatten (using different method for an iterable of bytearrays)
+
 
-    # variable-byte encode everything in the list of final entries, then return the bytearray
-    serialized_list = map(variable_byte_encode, final_entries)
-    return b"".join(serialized_list)  # flatten (using different method for an iterable of bytearrays)
+def get_skip_interval(doc_freq: DocFreq) -> int:
+    """
+    Gets the number of docs between skip pointers for a posting list.
+    We use the usual sqrt(doc_freq) heuristic, and leave short posting lists without skip pointers.
+    :param doc_freq: The doc frequency of the posting list
+    :return: The number of docs in each block
+    """
+    if doc_freq < MIN_SKIP_DOC_FREQ:
+        return doc_freq + 1  # a single block, so no skip pointers
+    return isqrt(doc_freq)
 
 
-def prepare_entry(doc_id: DocId, term_pos_list: List[TermPos]) -> List[int]:
+def prepare_entry(doc_gap: int, term_pos_list: List[TermPos]) -> bytes:
     """
-    Performs gap encoding on the term positions list.
-    Generates a list of integers following the following format:
-        `(doc_id)(num_tp)(tp_1)(tp_2)(...)(tp_m)`
-    :param doc_id: The document ID
+    Performs gap encoding on the term positions list, then variable byte encodes everything in the following format:
+        `(doc_gap)(num_tp)(pos_bytes)(tp_1)(tp_2)(...)(tp_m)`
+    :param doc_gap: The document ID, minus the ID of the document before it
     :param term_pos_list: The list of associated term positions
-    :return: List of integers in the specified format
+    :return: The serialized entry
     """
 
-    term_pos_list = gap_encode(term_pos_list)
-    header = [doc_id, len(term_pos_list)]
+    serialized_pos = b"".join(map(variable_byte_encode, gap_encode(term_pos_list)))
+
+    # we add in the number of term pos entries, so we know how long the list is,
+    # and the number of bytes they take up, so we know how far to jump to skip them
+    header = [doc_gap, len(term_pos_list), len(serialized_pos)]
+    return b"".join(map(variable_byte_encode, header)) + serialized_pos
 
-    # we add in the number of term pos entries, so we know how long the list is
-    return header + term_pos_list
+
+def encode_max_score(max_score: float) -> int:
+    """
+    Turns a max score into an integer, so it can be variable byte encoded like everything else.
+    We round UP, so the decoded value is still an upper bound on the real one.
+    :param max_score: The max score
+    :return: The encoded max score
+    """
+    return ceil(max_score * MAX_SCORE_SCALE)
+
+
+def decode_max_score(encoded: int) -> float:
+    """
+    Reverse of encode_max_score.
+    :param encoded: The encoded max score
+    :return: The max score (which is slightly higher than the original)
+    """
+    return encoded / MAX_SCORE_SCALE
 
 
 def gap_encode(lst: List[int]) -> List[int]:
@@ -309,3 +1382,20 @@ def variable_byte_encode(num: int) -> bytes:
         new_num |= new_part << (8 * byte_count)
         byte_count += 1
     return new_num.to_bytes(byte_count, sys.byteorder)
+
+
+def variable_byte_decode(f) -> int:
+    """
+    Reads the next variable byte encoded integer from the given binary file object.
+    This is the reverse of variable_byte_encode.
+    :param f: The binary file object to read from
+    :return: The decoded integer
+    """
+    new_int: int = 0
+    bits: int = 0
+    while True:
+        byte = int.from_bytes(f.read(1), sys.byteorder)
+        if byte >= 128:
+            return new_int + ((byte - 128) << bits)
+        new_int += byte << bits
+        bits += 7
@@ -1,104 +1,285 @@
 #!/usr/bin/python3
-from typing import List, Set
+import re
+from datetime import date, datetime
+from functools import lru_cache
+from typing import List, Sequence, Set
 from Types import *
-from nltk.corpus import wordnet
+from Segments import SegmentedChampionLists, SegmentedDictionary
+from SparseVector import SparseVector
+from math import log10
 import dateutil.parser as parser
 
+import Config
+
 # QUERY REFINEMENT
 # Includes both query expansion and relevance feedback
 
+# DATE EXTRACTION
+# Dates in queries are found with these patterns first, and only queries with a year in them that none of the
+# patterns match are handed to dateutil (which is slow on long queries, and raises for most queries anyway)
+MONTHS: Dict[str, int] = {name: i + 1 for i, names in enumerate([
+    ("january", "jan"), ("february", "feb"), ("march", "mar"), ("april", "apr"), ("may",), ("june", "jun"),
+    ("july", "jul"), ("august", "aug"), ("september", "sep", "sept"), ("october", "oct"), ("november", "nov"),
+    ("december", "dec")]) for name in names}
+MONTH_PATTERN = "(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?"
+DAY_PATTERN = r"(\d{1,2})(?:st|nd|rd|th)?"
+ISO_DATE_REGEX = re.compile(r"\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b")
+NUMERIC_DATE_REGEX = re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b")
+DAY_MONTH_DATE_REGEX = re.compile(r"\b" + DAY_PATTERN + r"(?:\s+of)?\s+" + MONTH_PATTERN + r",?\s+(\d{4})\b",
+                                  re.IGNORECASE)
+MONTH_DAY_DATE_REGEX = re.compile(r"\b" + MONTH_PATTERN + r"\s+" + DAY_PATTERN + r",?\s+(\d{4})\b", re.IGNORECASE)
+YEAR_REGEX = re.compile(r"\b\d{4}\b")
+DATEUTIL_DEFAULTS = (datetime(2000, 1, 1), datetime(2001, 2, 2))
+
 
-def calc_centroid(champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]],
-                  in_query_relevant_docs: List[DocId]) -> Vector:
+def calc_centroid(champion_dct: SegmentedChampionLists,
+                  in_query_relevant_docs: List[DocId]) -> SparseVector:
     """
     Calculates the centroid of the relevant documents based on term weights.
-    :param champion_dct: Dictionary of doc ID to list of tuples e.g [(Term, TermWeight), ....]
+    Docs without a champion list still count towards the number of docs averaged over.
+    :param champion_dct: Champion lists, i.e. doc ID -> list of tuples e.g [(TermId, TermWeight), ....]
     :param in_query_relevant_docs: List of identified (relevant) Doc IDs
-    :return: centroid 
+    :return: centroid
     """
-    centroid: Vector = {}
-
-    for relevant_doc_id in in_query_relevant_docs:
-        if relevant_doc_id not in champion_dct:
-            continue
-        term_weights = champion_dct[relevant_doc_id]
-        for (term, weight) in term_weights:
-            centroid[term] = centroid.get(term, 0) + weight
-
-    for term in centroid.keys():
-        centroid[term] /= len(in_query_relevant_docs)
-
-    return centroid
+    champion_vectors = [champion_dct.get_vector(doc_id) for doc_id in in_query_relevant_docs
+                        if doc_id in champion_dct]
+    return SparseVector.mean(champion_vectors, len(in_query_relevant_docs))
 
 
 def run_rocchio(alpha: float,
                 beta: float,
-                champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]],
+                champion_dct: SegmentedChampionLists,
                 in_query_relevant_docs: List[DocId],
-                query_vector: Dict[Term, float]) -> Dict[Term, float]:
+                query_vector: SparseVector,
+                gamma: float = 0.,
+                in_query_non_relevant_docs: Optional[List[DocId]] = None,
+                max_terms: Optional[int] = None,
+                centroid_terms: Optional[Sequence[TermId]] = None,
+                standard_formula: bool = False) -> SparseVector:
     """
-    Implements Rocchio algo to update query vector based on provided relevant documents
+    Implements Rocchio algo to update query vector based on provided relevant (and non-relevant) documents.
+    By default, this is the weighting ALPHA and BETA were tuned with: a query term in the relevant centroid gets
+    (alpha + beta) * its query weight, a centroid term not in the query gets beta * its centroid weight, and
+    every other query term is left as it is. With standard_formula, it is the textbook
+        alpha * query + beta * centroid of relevant docs
+    Either way, gamma * the centroid of any non-relevant docs is then taken away, and terms left with a weight
+    of 0 or less are dropped, so the non-relevant docs can only take weight away from the query.
+    The relevant centroid is cut down first: to centroid_terms if given (e.g. the query terms, when only those
+    are scored), otherwise to its max_terms heaviest terms if given, so the query never grows by thousands of terms.
     :param alpha: Alpha coefficient for Rocchio Algorithm (Original Query)
     :param beta: Beta coefficient for Rocchio Algorithm (Relevant Documents)
-    :param champion_dct: List of Tuples e.g [(Term, TermWeight), ....]
+    :param champion_dct: Champion lists, i.e. doc ID -> list of tuples e.g [(TermId, TermWeight), ....]
     :param in_query_relevant_docs: List of identified (relevant) Doc IDs
-    :param query_vector: Dict of token-score k-v pairs
+    :param query_vector: The query vector
+    :param gamma: Gamma coefficient for Rocchio Algorithm (Non-Relevant Documents)
+    :param in_query_non_relevant_docs: List of identified non-relevant Doc IDs, if any
+    :param max_terms: The maximum number of terms of the relevant centroid to add to the query
+    :param centroid_terms: If given, the only terms of the relevant centroid to use
+    :param standard_formula: Whether to use the textbook formula, rather than the one the weights were tuned with
     :return: Updated query_vector after rocchio
     """
-    centroid = calc_centroid(champion_dct, in_query_relevant_docs)
+    refined_vector = query_vector
+    if in_query_relevant_docs:
+        centroid = calc_centroid(champion_dct, in_query_relevant_docs)
+        if centroid_terms is not None:
+            centroid = centroid.restrict(centroid_terms)
+        elif max_terms is not None:
+            centroid = centroid.top_n(max_terms)
+        if standard_formula:
+            refined_vector = query_vector.scale(alpha).add(centroid, beta)
+        else:
+            refined_vector = apply_tuned_rocchio(alpha, beta, query_vector, centroid)
+    if gamma and in_query_non_relevant_docs:
+        non_relevant_centroid = calc_centroid(champion_dct, in_query_non_relevant_docs)
+        refined_vector = refined_vector.add(non_relevant_centroid, -gamma).drop_non_positive()
+    return refined_vector
+
 
-    for term in centroid.keys():
-        if term not in query_vector:
-            modified_centroid_score = centroid[term] * beta
+def apply_tuned_rocchio(alpha: float,
+                        beta: float,
+                        query_vector: SparseVector,
+                        centroid: SparseVector) -> SparseVector:
+    """
+    Combines the query vector and the relevant centroid the way ALPHA and BETA were tuned with (see run_rocchio),
+    in a single linear merge of the two.
+    :param alpha: Alpha coefficient for Rocchio Algorithm (Original Query)
+    :param beta: Beta coefficient for Rocchio Algorithm (Relevant Documents)
+    :param query_vector: The query vector
+    :param centroid: The centroid of the relevant docs
+    :return: Updated query_vector after rocchio
+    """
+    pairs: List[Tuple[TermId, TermWeight]] = []
+    query_pairs, centroid_pairs = iter(query_vector), iter(centroid)
+    query_pair, centroid_pair = next(query_pairs, None), next(centroid_pairs, None)
+    while query_pair is not None or centroid_pair is not None:
+        if centroid_pair is None or (query_pair is not None and query_pair[0] < centroid_pair[0]):
+            pairs.append(query_pair)
+            query_pair = next(query_pairs, None)
+        elif query_pair is None or centroid_pair[0] < query_pair[0]:
+            pairs.append((centroid_pair[0], centroid_pair[1] * beta))
+            centroid_pair = next(centroid_pairs, None)
         else:
-            modified_centroid_score = alpha * query_vector[term] + beta * query_vector[term]
-        query_vector[term] = modified_centroid_score
-    return query_vector
+            term, query_weight = query_pair
+            pairs.append((term, alpha * query_weight + beta * query_weight))
+            query_pair, centroid_pair = next(query_pairs, None), next(centroid_pairs, None)
+    return SparseVector.from_pairs(pairs, is_sorted=True)
 
 
 def expand_query(tokens: List[str],
-                 thesaurus: Dict[str, Set[str]]) -> List[str]:
+                 expansion_table: Dict[str, ExpansionTuple]) -> List[str]:
     """
-    Expands a query token to include related terms using the given thesaurus.
+    Expands a query token to include related terms (WordNet synonyms and thesaurus terms) using the given
+    expansion table, which is built offline (see ExpansionTable.py).
     :param tokens: List of tokens
-    :param thesaurus: Thesaurus in dictionary form, with both key and value pre-stemmed
+    :param expansion_table: Expansion table in dictionary form, with both key and value pre-stemmed
     :return: A set of new tokens expanded from the input list
     """
     synonyms = set()
     for token in tokens:
-        for synset in wordnet.synsets(token):
-            for l in synset.lemma_names():
-                if "_" not in l:
-                    synonyms.add(l)
-        for synonym in thesaurus.get(token, set()):
-            synonyms.add(synonym)
+        thesaurus_words, wordnet_words = expansion_table.get(token, ((), ()))
+        synonyms.update(thesaurus_words)
+        synonyms.update(wordnet_words)
     return list(synonyms)
 
 
-def tag_query_with_zones(tokens: List[str]) -> List[List[str]]:
+def expand_query_weighted(tokens: List[str],
+                          expansion_table: Dict[str, ExpansionTuple],
+                          pointer_dct: SegmentedDictionary,
+                          n: int,
+                          budget: int,
+                          thesaurus_weight: float,
+                          wordnet_weight: float) -> Dict[str, float]:
+    """
+    Expands a query with at most budget related terms, each with a weight that scales down its query weight.
+    The query tokens themselves are always kept, at full weight (1). Every expansion gets the weight of where it came
+    from (thesaurus_weight or wordnet_weight, taking the higher one if it came from both), times its idf relative
+    to the highest idf possible, so rare (i.e. specific) words count the most and common words the least. Only the
+    budget expansions with the highest weights are kept, which bounds the number of posting lists a query reads.
+    The idf of a word is worked out from its doc frequency in the zone it is most common in.
+    :param tokens: List of tokens
+    :param expansion_table: Expansion table in dictionary form, with both key and value pre-stemmed
+    :param pointer_dct: The term dictionary
+    :param n: The total number of documents
+    :param budget: The maximum number of expansions to add
+    :param thesaurus_weight: The weight of an expansion from the thesaurus
+    :param wordnet_weight: The weight of an expansion from WordNet
+    :return: Dictionary of token -> weight, with the query tokens and the expansions kept
+    """
+    token_set = set(tokens)
+    source_weights: Dict[str, float] = {}
+    for token in tokens:
+        thesaurus_words, wordnet_words = expansion_table.get(token, ((), ()))
+        for words, source_weight in ((thesaurus_words, thesaurus_weight), (wordnet_words, wordnet_weight)):
+            for word in words:
+                source_weights[word] = max(source_weights.get(word, 0.), source_weight)
+
+    max_idf = log10(n) if n > 1 else 1.
+    candidates: List[Tuple[float, str]] = []
+    for word, source_weight in source_weights.items():
+        if word in token_set:
+            continue
+        word_id = pointer_dct.get_word_id(word)
+        if word_id is None:
+            continue
+        term_ids = [word_id * NUM_ZONES + zone for zone in
+                    (CONTENT_ZONE, TITLE_ZONE, PARTIES_ZONE, SECTION_ZONE, COURT_ZONE)]
+        doc_freqs = [pointer_dct.get_doc_freq(term) for term in term_ids if term in pointer_dct]
+        if not doc_freqs:
+            continue
+        candidates.append((source_weight * log10(n / max(doc_freqs)) / max_idf, word))
+
+    # highest weight first, tie-broken by the word itself so the expansion never depends on set order
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+    token_weights: Dict[str, float] = {token: 1. for token in tokens}
+    for weight, word in candidates[:budget]:
+        if weight > 0:
+            token_weights[word] = weight
+    return token_weights
+
+
+def tag_query_with_zones(tokens: List[str],
+                         pointer_dct: SegmentedDictionary) -> List[List[TermId]]:
     """
     Tag each token with 5 zones, so we will have 5 versions of each token.
+    Each word is only looked up once, and the term IDs of its zones are worked out from its word ID.
+    Tokens that are not in the dictionary at all are dropped.
     :param tokens: List of tokens
-    :return: List of tokens tagged with zones
+    :param pointer_dct: The term dictionary
+    :return: List of term IDs for each zone
     """
-    content_query_tokens = ["content@" + tok for tok in tokens]
-    title_query_tokens = ["title@" + tok for tok in tokens]
-    court_query_tokens = ["court@" + tok for tok in tokens]
-    parties_query_tokens = ["parties@" + tok for tok in tokens]
-    section_query_tokens = ["section@" + tok for tok in tokens]
+    word_ids = [pointer_dct.get_word_id(tok) for tok in tokens]
+    word_ids = [word_id for word_id in word_ids if word_id is not None]
 
-    return [content_query_tokens, title_query_tokens, parties_query_tokens,
-            section_query_tokens, court_query_tokens]
+    return [[word_id * NUM_ZONES + zone for word_id in word_ids]
+            for zone in (CONTENT_ZONE, TITLE_ZONE, PARTIES_ZONE, SECTION_ZONE, COURT_ZONE)]
 
 
 def extract_date(query: str) -> List[str]:
     """
-    Given a query string, try to extract a date. Return empty list if it fails.
+    Given a query string, extract the dates in it, e.g. 2015-03-12, 12/3/2015, 12th March 2015 or March 12, 2015.
+    Numeric dates are month first (like dateutil), unless the first number can only be a day.
+    If none of these are found, but the query has a year in it, dateutil has a go at the whole query, and its date
+    is only used if it found the year, month and day all in the query (so "May 2015" gives no date).
+    Results are cached, as the same query is often searched again.
     :param query: The query string
-    :return: A list containing either the formatted extracted date or nothing
+    :return: A list of the extracted dates, formatted as YYYY-MM-DD, in the order they appear in the query
+    """
+    return list(extract_date_cached(query))
+
+
+@lru_cache(maxsize=Config.DATE_EXTRACTION_CACHE_SIZE)
+def extract_date_cached(query: str) -> Tuple[str, ...]:
+    found: List[Tuple[int, date]] = []
+    for match in ISO_DATE_REGEX.finditer(query):
+        year, month, day = map(int, match.groups())
+        found.append((match.start(), make_date(year, month, day)))
+    for match in NUMERIC_DATE_REGEX.finditer(query):
+        month, day, year = map(int, match.groups())
+        if month > 12:
+            month, day = day, month
+        found.append((match.start(), make_date(year, month, day)))
+    for match in DAY_MONTH_DATE_REGEX.finditer(query):
+        day, month_name, year = match.groups()
+        found.append((match.start(), make_date(int(year), MONTHS[month_name.lower()], int(day))))
+    for match in MONTH_DAY_DATE_REGEX.finditer(query):
+        month_name, day, year = match.groups()
+        found.append((match.start(), make_date(int(year), MONTHS[month_name.lower()], int(day))))
+
+    dates: List[str] = []
+    for _, found_date in sorted(found, key=lambda x: x[0]):
+        if found_date is not None and found_date.isoformat() not in dates:
+            dates.append(found_date.isoformat())
+    if dates or found or not YEAR_REGEX.search(query):
+        return tuple(dates)
+
+    # dateutil fills in whatever it doesn't find (e.g. the day of "May 2015") from a default date, so the query
+    # is parsed with two defaults that differ in every part, and the date is only kept if both agree
+    try:
+        parsed_dates = {parser.parse(query, fuzzy=True, default=default).date() for default in DATEUTIL_DEFAULTS}
+    except (ValueError, OverflowError):
+        return ()
+    if len(parsed_dates) != 1:
+        return ()
+    return (parsed_dates.pop().isoformat(),)
+
+
+def make_date(year: int, month: int, day: int) -> Optional[date]:
+    """
+    :return: The date, or None if there is no such date
     """
     try:
-        datetime = parser.parse(query, fuzzy=True)
-        return [datetime.strftime("%Y-%m-%d")]
-    except:
-        return []
\ No newline at end of file
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def get_date_ordinal(date_str: str) -> Optional[int]:
+    """
+    :param date_str: A date formatted as YYYY-MM-DD (as indexed in the date zone, or given by extract_date)
+    :return: The proleptic Gregorian ordinal of the date (see date.toordinal), or None if it is not such a date
+    """
+    match = ISO_DATE_REGEX.fullmatch(date_str)
+    if match is None:
+        return None
+    found_date = make_date(*map(int, match.groups()))
+    return found_date.toordinal() if found_date is not None else None
\ No newline at end of file
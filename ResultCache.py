@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+from array import array
+from collections import OrderedDict
+from typing import Any, List
+from Segments import get_segment_file
+from Types import *
+
+import Config
+
+# RESULT CACHE
+# Remembers the results of recent queries, so a query that comes again (with the same relevant docs) skips expansion,
+# zone tagging, Rocchio and scoring altogether. A cached result is only reused if every Config value is the same,
+# and the whole cache is dropped as soon as the index changes, i.e. the postings file of any segment is rewritten
+# or the live segments are not the same anymore. The cache is checked against the version of the index the searcher
+# actually has loaded (see search.load_search_data), never just what is on disk, so results found with an older
+# index are never cached as results of a newer one.
+
+# bump this whenever the format of the saved cache changes, so old cache files are ignored
+CACHE_FILE_VERSION: int = 1
+
+CacheKey = Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[DocId, ...], str]
+IndexVersion = Tuple[Tuple[SegmentId, int, int], ...]
+
+
+def get_index_version(postings_file: str, segments: List[SegmentId]) -> IndexVersion:
+    """
+    Gets something that changes whenever the index does: the size and modification time of the postings file
+    of every live segment. Checking it only takes a stat of each postings file.
+    :param postings_file: The name of the postings file (of segment 0)
+    :param segments: The live segments
+    :return: The index version
+    """
+    index_version = []
+    for segment in segments:
+        stat = os.stat(get_segment_file(postings_file, segment))
+        index_version.append((segment, stat.st_size, stat.st_mtime_ns))
+    return tuple(index_version)
+
+
+def get_config_key() -> str:
+    """
+    :return: A digest of every Config value, so results are never reused after a setting changes
+    """
+    config_values = sorted((name, repr(value)) for name, value in vars(Config).items() if name.isupper())
+    return hashlib.sha1(repr(config_values).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    A cache of query -> results, holding at most max_entries queries, least recently used first out.
+    Results are stored as arrays of doc IDs, and a copy is handed out on every hit.
+    If a cache file is given, the cache is loaded from it (if it exists) and written back to it by save().
+    """
+
+    def __init__(self, max_entries: int, cache_file: Optional[str] = None):
+        self._max_entries: int = max_entries
+        self._cache_file: Optional[str] = cache_file
+        self._entries: OrderedDict[CacheKey, array] = OrderedDict()
+        self._index_version: Optional[IndexVersion] = None
+        self.hits: int = 0
+        self.misses: int = 0
+        if cache_file is not None and os.path.exists(cache_file):
+            self._load(cache_file)
+
+    @staticmethod
+    def make_key(query_tokens: List[str], extracted_dates: List[str], relevant_docs: List[DocId]) -> CacheKey:
+        """
+        :param query_tokens: The tokens of the query (see Tokenizer.tokenize_query), which are already normalized
+        :param extracted_dates: The dates extracted from the query
+        :param relevant_docs: The relevant doc IDs given with the query
+        :return: The cache key of the query
+        """
+        return tuple(query_tokens), tuple(extracted_dates), tuple(relevant_docs), get_config_key()
+
+    def check_index_version(self, index_version: IndexVersion) -> None:
+        """
+        Drops every cached result if the index has changed since they were cached.
+        :param index_version: The current index version (see get_index_version)
+        """
+        if index_version != self._index_version:
+            if self._entries:
+                print(f"index changed, dropping {len(self._entries)} cached results")
+            self._entries.clear()
+            self._index_version = index_version
+
+    def is_index_version(self, index_version: IndexVersion) -> bool:
+        """
+        :param index_version: The version of the index some results were found with
+        :return: Whether the cache is for that version, i.e. whether those results can be put in it
+        """
+        return index_version == self._index_version
+
+    def get(self, key: CacheKey) -> Optional[List[DocId]]:
+        """
+        :param key: The cache key of the query
+        :return: The cached results of the query, or None if they are not cached
+        """
+        results = self._entries.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return results.tolist()
+
+    def put(self, key: CacheKey, results: List[DocId]) -> None:
+        """
+        :param key: The cache key of the query
+        :param results: The results of the query
+        """
+        self._entries[key] = array("I", results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _load(self, cache_file: str) -> None:
+        try:
+            with open(cache_file, "rb") as cf:
+                saved: Dict[str, Any] = pickle.load(cf)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            print("could not read the result cache file, starting with an empty cache")
+            return
+        if saved.get("version") != CACHE_FILE_VERSION:
+            return
+        self._index_version = saved["index_version"]
+        self._entries = saved["entries"]
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        """
+        Writes the cache to its cache file, if it has one. The file is replaced in one go, so a reader never sees
+        a half-written cache.
+        """
+        if self._cache_file is None:
+            return
+        saved = {"version": CACHE_FILE_VERSION, "index_version": self._index_version, "entries": self._entries}
+        temp_file = self._cache_file + ".tmp"
+        with open(temp_file, "wb") as cf:
+            pickle.dump(saved, cf)
+        os.replace(temp_file, self._cache_file)
+
+    def format_info(self) -> str:
+        """
+        :return: A one-line summary of how well the cache is doing
+        """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.
+        return (f"result cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{len(self._entries)}/{self._max_entries} queries cached")
+
+
+def make_result_cache() -> Optional[ResultCache]:
+    """
+    :return: The result cache as set up in Config, or None if it is turned off
+    """
+    if not Config.RUN_RESULT_CACHE:
+        return None
+    return ResultCache(Config.RESULT_CACHE_SIZE, Config.RESULT_CACHE_FILE)
@@ -1,21 +1,34 @@
 from __future__ import annotations
 
-from InputOutput import PostingReader
+import heapq
+import time
+from array import array
+from InputOutput import PostingCursor
+from Segments import SegmentedDictionary, SegmentedPostingReader, SegmentedDocLengths, SegmentedChampionLists
 from QueryRefinement import run_rocchio
+from SparseVector import SparseVector
 from math import log10
-from typing import List, Set
+from typing import List, Sequence, Set, Union
 from Types import *
 
 import Config
 
+# every zone a word can appear in, other than dates
+ZONES = (CONTENT_ZONE, TITLE_ZONE, COURT_ZONE, PARTIES_ZONE, SECTION_ZONE)
+
+# relative padding on the sum of max scores, so floating point error never lets us prune a doc that should be kept
+MAX_SCORE_EPSILON: float = 1e-9
+
 
 def search_boolean_query(query_tokens: List[str],
-                         pointer_dct: Dict[Term, int],
+                         pointer_dct: SegmentedDictionary,
                          postings_file: str) -> List[DocId]:
     """
     Perform a boolean query based on the given query tokens.
     Will try to find a perfect match, but failing that, will return the last best result
     Return a list of relevant document IDs.
+    Posting lists are never loaded as a whole. The results so far are intersected with each subquery
+    by skipping ahead through its posting lists, and we stop as soon as an intersection comes up empty.
     :param query_tokens: List of query tokens
     :param pointer_dct: Dictionary of term -> postings list pointer
     :param postings_file: Name of the postings list file
@@ -25,46 +38,35 @@ def search_boolean_query(query_tokens: List[str],
     subqueries = [subquery for subquery in query_tokens if not subquery == 'AND']
 
     all_search_outputs: List[DocId] = []
-    for subquery in subqueries:
-        # PERFORM PHRASAL QUERY SEARCH FOR CURRENT SUBQUERY
-        if " " in subquery:  # MULTI-WORD PHRASAL QUERY
-            intermediate_search_outputs = search_phrasal_query(subquery, pointer_dct, postings_file)
-        else:  # SINGLE WORD PHRASAL QUERY
-            query_word = subquery
-            posting_list = {}
-            for zone in ("content@", "title@", "court@", "parties@", "section@"):
-                temp_word = zone + query_word
-                if temp_word in pointer_dct:
-                    posting_list.update(get_posting_list(postings_file, pointer_dct, temp_word))
-
-            if posting_list:  # if term exists in corpus,
-                intermediate_search_outputs = [doc_id for doc_id in posting_list.keys()]
-            else:  # if term does not exist in corpus,
+    with SegmentedPostingReader(postings_file, pointer_dct) as pf:
+        for subquery in subqueries:
+            # PERFORM PHRASAL QUERY SEARCH FOR CURRENT SUBQUERY
+            # a single word is just a phrase of one word
+            cursor = make_phrase_cursor(subquery.split(), pointer_dct, pf)
+
+            # INTERSECT WITH EXISTING RESULTS
+            if cursor is None:  # if no term exists in corpus,
                 intermediate_search_outputs = []
+            elif all_search_outputs:
+                intermediate_search_outputs = boolean_and(all_search_outputs, cursor)
+            else:
+                intermediate_search_outputs = get_all_docs(cursor)
 
-        # EARLY TERMINATION
-        if not intermediate_search_outputs:
-            # if current subquery gives no results, terminate early
-            break
-
-        # INTERSECT WITH EXISTING RESULTS
-        if all_search_outputs:
-            intersected = boolean_and(intermediate_search_outputs, all_search_outputs)
-            if not intersected:
-                # early termination condition #2 -- if intersect yields nothing
+            # EARLY TERMINATION
+            if not intermediate_search_outputs:
+                # if current subquery gives no results (or the intersection yields nothing), terminate early
                 break
-        else:
-            all_search_outputs += intermediate_search_outputs
+            all_search_outputs = intermediate_search_outputs
 
     return all_search_outputs
 
 
 def search_phrasal_query(phrasal_query: str,
-                         pointer_dct: Dict[Term, int],
+                         pointer_dct: SegmentedDictionary,
                          postings_file: str) -> List[DocId]:
     """
-    Using the PostingReader interface, process a given phrasal query by getting each term's
-    posting list and intersecting the positional indices.
+    Using the PostingReader interface, process a given phrasal query by going through each term's
+    posting list together, and matching up term positions only in docs that have every term (see PhraseCursor).
     :param phrasal_query: The phrase query to search
     :param pointer_dct: A dictionary of terms -> postings list pointer
     :param postings_file: The name of the postings list file
@@ -72,172 +74,568 @@ def search_phrasal_query(phrasal_query: str,
     """
 
     # NOTE! Phrasal queries will come as a single string, so we need to split it
-    # Also, phrasal query terms will contain NO ZONES! They will be temporarily added later
-    phrasal_query = phrasal_query.split()
-
-    with PostingReader(postings_file, pointer_dct) as pf:
-        term_data = {}
-        for query_term in phrasal_query:
-            # we temporarily add zone tags just to extract the relevant posting lists
-            # for example, posting list for "content@test", "title@test", ... will be
-            # condensed into a single posting list and saved in term_data
-            for zone in ("content@", "title@", "court@", "parties@", "section@"):
-                temp_term = zone + query_term
-                if temp_term not in pointer_dct:
-                    continue
-                pf.seek_term(temp_term)
-                while not pf.is_done():
-                    doc_id, _, term_pos = pf.read_entry()
-                    doc_id_to_pos = term_data.get(query_term, {})
-                    term_pos_set = doc_id_to_pos.get(doc_id, set())
-                    term_pos_set.add(term_pos)
-                    doc_id_to_pos[doc_id] = term_pos_set
-                    term_data[query_term] = doc_id_to_pos
-
-    # INTERSECTION OF POSITIONAL INDICES
-    result: Dict[DocId, Set[TermPos]] = dict()
-    for i, query_term in enumerate(phrasal_query):
-        if query_term not in term_data:  # if either term not in corpus or term is a stop word, skip
+    with SegmentedPostingReader(postings_file, pointer_dct) as pf:
+        cursor = make_phrase_cursor(phrasal_query.split(), pointer_dct, pf)
+        if cursor is None:
+            return []
+        return get_all_docs(cursor)
+
+
+def make_phrase_cursor(phrase_terms: List[str],
+                       pointer_dct: SegmentedDictionary,
+                       pf: SegmentedPostingReader) -> Optional[Union[PhraseCursor, UnionCursor]]:
+    """
+    Makes a cursor over the docs containing the given phrase, in any zone.
+    Phrasal query terms contain NO ZONES! We look up the word ID of each word, and the posting lists of the word
+    in every zone (i.e. content, title, ...) and every segment are combined into a single UnionCursor.
+    Terms not in the corpus (e.g. stop words) are skipped, but still count towards the offsets of later terms.
+    The term cursors are ordered from the rarest term (fewest docs) to the most common one, so the rarest term
+    picks the candidate docs and the candidate phrase starts, and the common terms are only checked against them.
+    :param phrase_terms: The terms of the phrase, in order
+    :param pointer_dct: A dictionary of terms -> postings list pointer
+    :param pf: The postings file reader interface
+    :return: The cursor, or None if no term of the phrase is in the corpus
+    """
+    term_cursors: List[Tuple[int, UnionCursor]] = []
+    for offset, query_term in enumerate(phrase_terms):
+        word_id = pointer_dct.get_word_id(query_term)
+        if word_id is None:
             continue
-        if not result:  # if initializing result
-            result.update(term_data[query_term])
-        else:
-            # find documents of the current query term which are present in the result
-            intersecting_docs = result.keys() & term_data[query_term].keys()
-            # find documents which have gap of i
-            new_result = {}
-            for doc_id in intersecting_docs:
-                term_pos_of_doc_set = term_data[query_term][doc_id]
-                # subtract all term pos by i so that can we use set intersection
-                shifted_term_pos_set = {term_pos - i for term_pos in term_pos_of_doc_set}
-                # intersect our existing document term pos set with the current term's shifted term pos set
-                # then, store the results
-                new_term_pos_set = result[doc_id] & shifted_term_pos_set
-                if new_term_pos_set:  # if the intersection with the new doc is not empty, write it to new_results
-                    new_result[doc_id] = new_term_pos_set
-            if not new_result:
-                # early termination
-                result = dict()
-                break
-            result = new_result
-    # We only want the document IDs to be returned
-    result_docs: List[DocId] = list(result.keys())
-    return result_docs
+        term_ids = [word_id * NUM_ZONES + zone for zone in ZONES]
+        zone_cursors = [cursor for term in term_ids for cursor in pf.get_cursors(term)]
+        if zone_cursors:
+            term_cursors.append((offset, UnionCursor(zone_cursors)))
+
+    if not term_cursors:
+        return None
+    if len(term_cursors) == 1:  # no positions to check
+        return term_cursors[0][1]
+    term_cursors.sort(key=lambda term_cursor: term_cursor[1].get_doc_freq())
+    return PhraseCursor(term_cursors)
+
+
+class UnionCursor:
+    """
+    A cursor over the union of several posting lists (e.g. all zones of a word, or all segments of a term),
+    in ascending order of doc ID. Works like PostingCursor.
+    """
+
+    def __init__(self, cursors: List[PostingCursor]):
+        self._cursors: List[PostingCursor] = cursors
+        self._doc: Optional[DocId] = None
+        self._update_doc()
+
+    def _update_doc(self) -> None:
+        docs = [cursor.doc() for cursor in self._cursors if cursor.doc() is not None]
+        self._doc = min(docs) if docs else None
+
+    def doc(self) -> Optional[DocId]:
+        return self._doc
+
+    def next(self) -> Optional[DocId]:
+        for cursor in self._cursors:
+            if cursor.doc() == self._doc:
+                cursor.next()
+        self._update_doc()
+        return self._doc
+
+    def skip_to(self, target: DocId) -> Optional[DocId]:
+        for cursor in self._cursors:
+            cursor.skip_to(target)
+        self._update_doc()
+        return self._doc
+
+    def term_freq(self) -> TermFreq:
+        """
+        :return: The term frequency of the current doc, across all posting lists
+        """
+        return sum(cursor.term_freq() for cursor in self._cursors if cursor.doc() == self._doc)
+
+    def get_doc_freq(self) -> DocFreq:
+        """
+        :return: The total doc frequency of all posting lists (an upper bound on the number of docs of the union)
+        """
+        return sum(cursor.get_doc_freq() for cursor in self._cursors)
+
+    def positions(self) -> array:
+        """
+        :return: The sorted array of term positions of the current doc, across all posting lists
+        """
+        term_pos_arrays = [cursor.positions() for cursor in self._cursors if cursor.doc() == self._doc]
+        if len(term_pos_arrays) == 1:  # usually a word is only in one zone of a doc
+            return term_pos_arrays[0]
+        return array('L', heapq.merge(*term_pos_arrays))
+
+
+class PhraseCursor:
+    """
+    A cursor over the docs that contain a phrase, in ascending order of doc ID. Works like PostingCursor.
+    The first term cursor (the rarest term) proposes each candidate doc, and the other term cursors skip_to it,
+    any of them overshooting making the first one skip ahead in turn. Only once they all land on the same doc
+    are the term positions of that doc decoded and checked.
+    """
 
+    def __init__(self, term_cursors: List[Tuple[int, UnionCursor]]):
+        self._term_cursors: List[Tuple[int, UnionCursor]] = term_cursors  # (offset in phrase, cursor)
+        self._doc: Optional[DocId] = None
+        self._find_match()
+
+    def _find_match(self) -> None:
+        """
+        Moves the term cursors forward until they are all on a doc containing the phrase (or one runs out).
+        """
+        lead_cursor = self._term_cursors[0][1]
+        while True:
+            target = lead_cursor.doc()
+            if target is None:
+                self._doc = None
+                return
+            for _, cursor in self._term_cursors[1:]:
+                doc = cursor.skip_to(target)
+                if doc != target:
+                    break
+            else:
+                if self._has_phrase():
+                    self._doc = target
+                    return
+                lead_cursor.next()
+                continue
+            if doc is None:
+                self._doc = None
+                return
+            lead_cursor.skip_to(doc)
+
+    def _has_phrase(self) -> bool:
+        """
+        Checks if the doc all term cursors are on contains the phrase.
+        Subtracting each term's offset from its positions lines up the positions where the phrase starts.
+        The candidate starts come from the first (rarest) term, and are narrowed down by each other term with
+        a single linear merge of the sorted candidates against its sorted positions.
+        :return: Whether the phrase is in the doc
+        """
+        first_offset, first_cursor = self._term_cursors[0]
+        starts: List[TermPos] = [term_pos - first_offset for term_pos in first_cursor.positions()]
+        for offset, cursor in self._term_cursors[1:]:
+            term_pos_array = cursor.positions()
+            num_pos = len(term_pos_array)
+            i = 0
+            matched_starts: List[TermPos] = []
+            for start in starts:
+                target = start + offset
+                while i < num_pos and term_pos_array[i] < target:
+                    i += 1
+                if i == num_pos:
+                    break
+                if term_pos_array[i] == target:
+                    matched_starts.append(start)
+            if not matched_starts:  # early termination
+                return False
+            starts = matched_starts
+        return True
+
+    def doc(self) -> Optional[DocId]:
+        return self._doc
+
+    def next(self) -> Optional[DocId]:
+        if self._doc is not None:
+            self._term_cursors[0][1].next()
+            self._find_match()
+        return self._doc
+
+    def skip_to(self, target: DocId) -> Optional[DocId]:
+        if self._doc is not None and self._doc < target:
+            self._term_cursors[0][1].skip_to(target)
+            self._find_match()
+        return self._doc
+
+
+def get_all_docs(cursor: Union[PostingCursor, UnionCursor, PhraseCursor]) -> List[DocId]:
+    """
+    Goes through a cursor to the end.
+    :param cursor: The cursor
+    :return: List of all (remaining) doc IDs of the cursor, in ascending order
+    """
+    docs: List[DocId] = []
+    while cursor.doc() is not None:
+        docs.append(cursor.doc())
+        cursor.next()
+    return docs
 
-def search_freetext_query(query_tokens: List[Term],
-                          dictionary: Dict[Term, int],
-                          docs_len_dct: Dict[DocId, DocLength],
+
+def boolean_and(lst: List[DocId], cursor: Union[PostingCursor, UnionCursor, PhraseCursor]) -> List[DocId]:
+    """
+    And operation to find intersect between a sorted list and a cursor WITH skip pointers.
+    The cursor skips straight to each doc in the list, and we stop as soon as it runs out.
+    :param lst: sorted list of IDs
+    :param cursor: cursor over the other list of IDs
+    :return: list of IDs in both lists
+    """
+    intersected: List[DocId] = []
+    for doc_id in lst:
+        cursor_doc = cursor.skip_to(doc_id)
+        if cursor_doc is None:
+            break
+        if cursor_doc == doc_id:
+            intersected.append(doc_id)
+    return intersected
+
+
+def search_freetext_query(query_tokens: List[TermId],
+                          dictionary: SegmentedDictionary,
+                          docs_len_dct: SegmentedDocLengths,
                           postings_file: str,
                           relevant_docs: List[DocId],
-                          champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]]
+                          champion_dct: SegmentedChampionLists,
+                          top_k: Optional[int] = None,
+                          word_weights: Optional[Dict[WordId, float]] = None,
+                          non_relevant_docs: Optional[List[DocId]] = None,
+                          date_docs: Optional[Set[DocId]] = None
                           ) -> List[DocId]:
     """
     Using the PostingReader interface, process a given free text query by calculating scores
     for each document from its posting list, then returning the documents with the highest scores.
-    :param query_tokens: The free text query as a list of tokens
-    :param dictionary: A dictionary of terms to their positions in the postings list
-    :param docs_len_dct: A dictionary of doc ID to doc length
+    :param query_tokens: The free text query as a list of term IDs
+    :param dictionary: The term dictionary, with the positions of the terms in the postings list
+    :param docs_len_dct: The doc lengths, by doc ID and by doc ordinal
     :param postings_file: The name of the postings list file
     :param relevant_docs: The list of relevant document IDs (from the query file)
     :param champion_dct: The champion list as a dictionary
+    :param top_k: If given, only the top k documents are returned
+    :param word_weights: If given, the query weight of each term is scaled by the weight of its word (e.g. to count
+                         expansions for less than the query itself), and words not in here keep their full weight
+    :param non_relevant_docs: The list of document IDs known to be non-relevant, if any
+    :param date_docs: If given, the docs posted within the date range of the query, to boost or filter
+                      (see Config.DATE_RANGE_MODE)
     :return: A list of relevant document IDs
     """
 
     all_query_terms = set(query_tokens)
-    dictionary_terms = set(dictionary.keys())
-    query_terms = list(all_query_terms & dictionary_terms)
+    query_terms = [term for term in all_query_terms if term in dictionary]
     N = len(docs_len_dct)
 
     # CALCULATE QUERY VECTOR
-    query_vector: Vector
-    query_vector = calc_query_vector(postings_file, dictionary, query_terms, N)
+    query_vector: SparseVector
+    query_vector = calc_query_vector(dictionary, query_terms, N, word_weights)
 
     # REFINE QUERY VECTOR W/ ROCCHIO ALGO
+    # unless pruning picks the terms to score, only the query terms are scored, so only those of the centroid count
+    is_pruning = is_query_pruning()
     if Config.RUN_ROCCHIO:
         query_vector = run_rocchio(
-            Config.ALPHA, Config.BETA, champion_dct, relevant_docs, query_vector)
+            Config.ALPHA, Config.BETA, champion_dct, relevant_docs, query_vector,
+            Config.GAMMA, non_relevant_docs, Config.ROCCHIO_MAX_TERMS,
+            None if is_pruning else query_terms, Config.ROCCHIO_STANDARD_FORMULA)
 
     # QUERY PRUNING
-    # We remove all query terms below a certain threshold, set as a fraction of the top weight
-    # This is only helpful when we run query expansion due to the large number of query tokens, so we include that
-    # as a condition here to prevent accidental triggering
-    if Config.RUN_QUERY_PRUNING and Config.RUN_QUERY_EXPANSION:
-        # print(f"avg weight in query: {sum(query_vector.values())/len(query_vector)}")
-        # print(f"total num of weights: {len(query_vector)}")
-        threshold = max(query_vector.values()) / Config.PRUNING_THRESHOLD
-        # print(f"num terms above threshold: {sum([w > threshold for w in query_vector.values()])}")
-        query_vector = {term: weight for term, weight in query_vector.items() if weight >= threshold}
-        query_terms = set(query_vector.keys())
-
-    # CALCULATE DOCUMENT VECTOR
-    doc_vector_dct: Dict[DocId, Vector]
-    doc_vector_dct = calc_doc_vectors(postings_file, dictionary, query_terms)
-
-    # ADDING WEIGHTS TO ZONES
-    def apply_weights_to_vector(vct: Vector) -> Vector:
-        for term in vct:
-            if term.startswith("date"):  # dates and titles should be boosted since they are important
-                vct[term] *= 1.5
-            elif term.startswith("title"):
-                vct[term] *= 1.5
-            elif term.startswith("content"):
-                pass  # multiplier is 1.0
-            else:  # other sections can be ranked lower than the content itself
-                vct[term] *= 0.8
-        return vct
-
-    for docID, vector in doc_vector_dct.items():
-        doc_vector_dct[docID] = apply_weights_to_vector(vector)
-    query_vector = apply_weights_to_vector(query_vector)
-
-    # calculate the final scores for each document
-    doc_scores: List[Tuple[DocId, float]] = []
-    for doc_id in doc_vector_dct.keys():
-        dot_prod = 0.
-        for t in query_terms:
-            d_score = doc_vector_dct[doc_id].get(t, 0.)
-            dot_prod += d_score * query_vector[t]
-        score = dot_prod / docs_len_dct[doc_id]  # normalization
-        doc_scores.append((doc_id, score))
-
-    # sort by ascending document ID first, then by descending score
-    # since Python's sort is stable, we end up with a list sorted by
-    # descending scores and tie-broken by ascending document IDs
-    # return the top 10 in the list
-    doc_scores = sorted(doc_scores, key=lambda x: x[0])
-    doc_scores = sorted(doc_scores, key=lambda x: x[1], reverse=True)
-
-    return [x[0] for x in doc_scores]  # we only want to keep the doc IDs!
-
-
-def get_posting_list(postings_file, pointer_dct, query_term) -> Dict[DocId, Set[TermPos]]:
-    """
-    Gets the posting list of a single term from the postings list file as a dictionary.
-    :param postings_file: The name of the posting file
-    :param pointer_dct: The dictionary of term -> postings file pointer
-    :param query_term: The term to retrieve the posting list of
-    :return: Posting list as a dictionary of doc ID to a set of term positions
-    """
-    with PostingReader(postings_file, pointer_dct) as pf:
-        pf.seek_term(query_term)
-        doc_id_to_pos = {}
-        while not pf.is_done():
-            doc_id, _, term_pos = pf.read_entry()
-            pos_set = doc_id_to_pos.get(doc_id, set())
-            pos_set.add(term_pos)
-            doc_id_to_pos[doc_id] = pos_set
-    return doc_id_to_pos
-
-
-def boolean_and(lst_1: List[DocId], lst_2: List[DocId]):
-    """
-    And operation to find intersect between two lists WITHOUT skip pointers
-    :param lst_1: list of IDs in first list
-    :param lst_2: list of IDs in second list
-    :return: list of IDs in both lists
+    if is_pruning:
+        query_vector = prune_query_vector(query_vector)
+        query_terms = query_vector.terms
+
+    # only the query terms are scored (Rocchio only reweights them), unless pruning has picked the terms to score
+    scoring_vector = query_vector.restrict(query_terms)
+
+    return rank_docs(scoring_vector, docs_len_dct, postings_file, dictionary, top_k, date_docs)
+
+
+def is_query_pruning() -> bool:
+    """
+    Query pruning is only helpful when we run query expansion due to the large number of query tokens, so we include
+    that as a condition here to prevent accidental triggering.
+    :return: Whether query vectors should be pruned (see prune_query_vector)
     """
-    return sorted(list(set(lst_1).intersection(set(lst_2))))
+    return Config.RUN_QUERY_PRUNING and Config.RUN_QUERY_EXPANSION
+
+
+def prune_query_vector(query_vector: SparseVector) -> SparseVector:
+    """
+    We remove all query terms below a certain threshold, set as a fraction of the top weight.
+    Only the terms that are left get scored.
+    :param query_vector: The query vector to prune
+    :return: The pruned query vector
+    """
+    threshold = query_vector.max_weight() / Config.PRUNING_THRESHOLD
+    return query_vector.prune(threshold)
+
+
+def search_freetext_query_with_feedback(query_tokens: List[TermId],
+                                        first_pass_tokens: List[TermId],
+                                        dictionary: SegmentedDictionary,
+                                        docs_len_dct: SegmentedDocLengths,
+                                        postings_file: str,
+                                        champion_dct: SegmentedChampionLists,
+                                        top_k: Optional[int] = None,
+                                        word_weights: Optional[Dict[WordId, float]] = None,
+                                        date_docs: Optional[Set[DocId]] = None
+                                        ) -> List[DocId]:
+    """
+    Process a free text query with pseudo-relevance feedback, for when no relevant docs are given:
+    1. a cheap first pass scores only first_pass_tokens (e.g. the unexpanded query in the content zone), for just
+       the top PRF_FIRST_PASS_TOP_K docs, which MaxScore gets to without scoring most docs
+    2. the top PRF_NUM_DOCS of those are taken as relevant, and Rocchio (with PRF_BETA, as they are only guessed)
+       adds the heaviest terms of their centroid (at most PRF_MAX_TERMS) to the query vector
+    3. the second pass scores the whole refined query vector
+    If query pruning is on, both the query vector and the refined query vector are pruned (see prune_query_vector)
+    before their terms are budgeted and scored, just like without pseudo-relevance feedback.
+    The cost of both passes is bounded up front, by the number of postings they read (i.e. the doc frequencies of
+    the terms they score), to PRF_POSTINGS_BUDGET. Scoring the query itself always has to be paid for, and the first
+    pass only runs if its postings fit in the budget on top of that. Feedback terms are then only added, heaviest
+    first, while their postings still fit. If the first pass doesn't fit, or finds nothing, the query is scored
+    without feedback, which costs the same as searching without pseudo-relevance feedback at all.
+    The time taken is printed, against PRF_LATENCY_BUDGET.
+    :param query_tokens: The free text query as a list of term IDs
+    :param first_pass_tokens: The term IDs to score in the first pass
+    :param dictionary: The term dictionary, with the positions of the terms in the postings list
+    :param docs_len_dct: The doc lengths, by doc ID and by doc ordinal
+    :param postings_file: The name of the postings list file
+    :param champion_dct: The champion list as a dictionary
+    :param top_k: If given, only the top k documents are returned
+    :param word_weights: If given, the query weight of each term is scaled by the weight of its word
+    :param date_docs: If given, the docs posted within the date range of the query, to boost or filter
+    :return: A list of relevant document IDs
+    """
+    start_time = time.perf_counter()
+    is_pruning = is_query_pruning()
+    query_terms = [term for term in set(query_tokens) if term in dictionary]
+    query_vector = calc_query_vector(dictionary, query_terms, len(docs_len_dct), word_weights)
+    if is_pruning:
+        query_vector = prune_query_vector(query_vector)
+        query_terms = query_vector.terms
+
+    first_pass_terms = [term for term in set(first_pass_tokens) if term in dictionary]
+    postings_budget = Config.PRF_POSTINGS_BUDGET - sum(dictionary.get_doc_freq(term) for term in query_terms)
+    first_pass_postings = sum(dictionary.get_doc_freq(term) for term in first_pass_terms)
+
+    # FIRST PASS
+    feedback_docs: List[DocId] = []
+    first_pass_info = "first pass skipped"
+    if first_pass_postings <= postings_budget:
+        postings_budget -= first_pass_postings
+        first_pass_output = search_freetext_query(first_pass_terms, dictionary, docs_len_dct, postings_file, [],
+                                                  champion_dct, Config.PRF_FIRST_PASS_TOP_K)
+        feedback_docs = first_pass_output[:Config.PRF_NUM_DOCS]
+        first_pass_info = f"first pass {(time.perf_counter() - start_time) * 1000:.1f}ms"
+
+    # FEEDBACK
+    num_feedback_terms = 0
+    if feedback_docs:
+        refined_vector = run_rocchio(Config.ALPHA, Config.PRF_BETA, champion_dct, feedback_docs, query_vector,
+                                     max_terms=Config.PRF_MAX_TERMS,
+                                     standard_formula=Config.ROCCHIO_STANDARD_FORMULA)
+        if is_pruning:
+            refined_vector = prune_query_vector(refined_vector)
+        # feedback terms are scored too, not just reweighted, as they are what the query was missing
+        # (query terms that pruning dropped from the refined vector are left out by the restrict below anyway)
+        scored_terms = set(query_terms)
+        for term, _ in sorted(refined_vector, key=lambda pair: (-pair[1], pair[0])):
+            if term not in scored_terms and term in dictionary:
+                doc_freq = dictionary.get_doc_freq(term)
+                if doc_freq <= postings_budget:
+                    postings_budget -= doc_freq
+                    scored_terms.add(term)
+                    num_feedback_terms += 1
+        query_vector = refined_vector.restrict(scored_terms)
+
+    # SECOND PASS
+    search_output = rank_docs(query_vector, docs_len_dct, postings_file, dictionary, top_k, date_docs)
+
+    total_time = time.perf_counter() - start_time
+    print(f"pseudo-relevance feedback: took {total_time * 1000:.1f}ms "
+          f"({'over' if total_time > Config.PRF_LATENCY_BUDGET else 'within'} the "
+          f"{Config.PRF_LATENCY_BUDGET * 1000:.0f}ms budget), {first_pass_info}, "
+          f"{len(feedback_docs)} feedback docs, {num_feedback_terms} feedback terms, "
+          f"{Config.PRF_POSTINGS_BUDGET - postings_budget}/{Config.PRF_POSTINGS_BUDGET} postings at most")
+    return search_output
+
+
+def rank_docs(scoring_vector: SparseVector,
+              docs_len_dct: SegmentedDocLengths,
+              postings_file: str,
+              dictionary: SegmentedDictionary,
+              top_k: Optional[int] = None,
+              date_docs: Optional[Set[DocId]] = None) -> List[DocId]:
+    """
+    Scores every document against the given query vector, and ranks them by their normalized scores.
+    If date docs are given, they are boosted or the other docs are filtered out (see Config.DATE_RANGE_MODE),
+    which MaxScore can't take into account, so it is not used then.
+    :param scoring_vector: The query vector, of just the terms to score
+    :param docs_len_dct: The doc lengths, by doc ID and by doc ordinal
+    :param postings_file: The name of the postings list file
+    :param dictionary: The term dictionary, with the positions of the terms in the postings list
+    :param top_k: If given, only the top k documents are returned
+    :param date_docs: If given, the docs posted within the date range of the query
+    :return: The document IDs, best first
+    """
+    N = len(docs_len_dct)
+
+    # TERM-AT-A-TIME SCORING
+    # each term's contribution is added straight into a flat array of scores, indexed by the doc's ordinal
+    # (its position in the sorted list of doc IDs), so we never build a vector for each document
+    doc_ids = docs_len_dct.doc_ids
+    doc_ordinals: Dict[DocId, int] = docs_len_dct.get_ordinals()
+    doc_lens = docs_len_dct.lengths
+    scores = array('d', bytes(8 * N))
+
+    with SegmentedPostingReader(postings_file, dictionary) as pf:
+        if top_k is not None and Config.RUN_MAX_SCORE and date_docs is None:
+            candidates = accumulate_scores_max_score(scoring_vector, pf, doc_ids, doc_ordinals, doc_lens, scores, top_k)
+        else:
+            candidates = accumulate_scores(scoring_vector, pf, doc_ordinals, scores)
+
+    for i in candidates:
+        scores[i] /= doc_lens[i]  # normalization
+
+    # DATE RANGE
+    if date_docs is not None:
+        if Config.DATE_RANGE_MODE == "filter":
+            candidates = [i for i in candidates if doc_ids[i] in date_docs]
+        else:
+            for i in candidates:
+                if doc_ids[i] in date_docs:
+                    scores[i] += Config.DATE_BOOST
+
+    # rank by descending score, tie-broken by ascending document ID
+    # if we only need the top k, a heap gets us there without sorting every candidate
+    def rank_key(i): return -scores[i], doc_ids[i]
+    if top_k is not None:
+        ranked = heapq.nsmallest(top_k, candidates, key=rank_key)
+    else:
+        ranked = sorted(candidates, key=rank_key)
+
+    return [doc_ids[i] for i in ranked]  # we only want to keep the doc IDs!
+
+
+def accumulate_scores(query_vector: SparseVector,
+                      pf: SegmentedPostingReader,
+                      doc_ordinals: Dict[DocId, int],
+                      scores: array) -> List[int]:
+    """
+    Adds the (unnormalized) contribution of every query term to the score of every doc in its posting list.
+    :param query_vector: The query vector, of just the terms to score with
+    :param pf: The postings file reader interface
+    :param doc_ordinals: The dictionary of doc ID -> doc ordinal
+    :param scores: The array of scores indexed by doc ordinal, updated in place
+    :return: The list of ordinals of docs that appear in at least one posting list
+    """
+    is_candidate = bytearray(len(scores))
+    candidates: List[int] = []
+    for term, term_weight in query_vector:
+        zone_weight = get_zone_weight(term)
+        query_weight = term_weight * zone_weight
+        for doc_id, doc_weight in make_doc_tfidf_generator(term, pf):
+            i = doc_ordinals[doc_id]
+            if not is_candidate[i]:
+                is_candidate[i] = 1
+                candidates.append(i)
+            scores[i] += doc_weight * zone_weight * query_weight
+    return candidates
+
+
+def accumulate_scores_max_score(query_vector: SparseVector,
+                                pf: SegmentedPostingReader,
+                                doc_ids: Sequence[DocId],
+                                doc_ordinals: Dict[DocId, int],
+                                doc_lens: Sequence[DocLength],
+                                scores: array,
+                                top_k: int) -> List[int]:
+    """
+    Like accumulate_scores, but uses the max score of each term (stored in the postings file) to skip docs
+    that cannot make it into the top k. This is the MaxScore strategy for term-at-a-time scoring:
+
+    Terms are processed from the highest to the lowest upper bound on what they can add to a doc's score.
+    Once the upper bounds of all remaining terms add up to less than the current k-th best score, a doc
+    that has not been seen yet can never catch up, so we stop adding new docs and only keep updating the
+    scores of docs already seen, skipping straight to them in the remaining posting lists. Docs that cannot
+    catch up even with every remaining term are dropped too.
+    The scores of the docs that are kept are exact, so the top k (and its order) are the same as without pruning.
+    :param query_vector: The query vector, of just the terms to score with
+    :param pf: The postings file reader interface
+    :param doc_ids: The sorted list of doc IDs, so doc_ids[ordinal] is the doc ID
+    :param doc_ordinals: The dictionary of doc ID -> doc ordinal
+    :param doc_lens: The array of doc lengths indexed by doc ordinal
+    :param scores: The array of scores indexed by doc ordinal, updated in place
+    :param top_k: The number of top docs needed
+    :return: The list of ordinals of docs that could still make it into the top k
+    """
+    # upper bound on how much each term can add to the normalized score of any doc
+    term_bounds: List[Tuple[float, TermId]] = []
+    for term, term_weight in query_vector:
+        zone_weight = get_zone_weight(term)
+        _, max_score = pf.get_term_info(term)
+        term_bounds.append((max(term_weight * zone_weight * zone_weight * max_score, 0.), term))
+    term_bounds = sorted(term_bounds, reverse=True)
+
+    # remaining_bounds[i] is the most that terms i, i+1, ... can add to a doc's score together
+    # we pad it a little so floating point error can never make it smaller than the real total
+    remaining_bounds = [0.] * (len(term_bounds) + 1)
+    for i in range(len(term_bounds) - 1, -1, -1):
+        remaining_bounds[i] = remaining_bounds[i + 1] + term_bounds[i][0] * (1 + MAX_SCORE_EPSILON)
+
+    is_candidate = bytearray(len(scores))
+    candidates: List[int] = []
+    threshold = 0.  # k-th best normalized score so far
+    max_normalized = 0.  # best normalized score so far, which is never below the threshold
+
+    # PHASE 1: any doc in these posting lists could still make it into the top k
+    t = 0
+    while t < len(term_bounds):
+        if len(candidates) >= top_k and remaining_bounds[t] < max_normalized:
+            threshold = heapq.nlargest(top_k, (scores[i] / doc_lens[i] for i in candidates))[-1]
+            if remaining_bounds[t] < threshold:
+                break
+
+        term = term_bounds[t][1]
+        zone_weight = get_zone_weight(term)
+        query_weight = query_vector.get(term) * zone_weight
+        for doc_id, doc_weight in make_doc_tfidf_generator(term, pf):
+            i = doc_ordinals[doc_id]
+            if not is_candidate[i]:
+                is_candidate[i] = 1
+                candidates.append(i)
+            scores[i] += doc_weight * zone_weight * query_weight
+            max_normalized = max(max_normalized, scores[i] / doc_lens[i])
+        t += 1
+
+    if t == len(term_bounds):
+        return candidates
+
+    # PHASE 2: no new docs can make it, so drop the ones that can't catch up and only update the rest
+    kept_candidates = [i for i in candidates if scores[i] / doc_lens[i] + remaining_bounds[t] >= threshold]
+
+    # the remaining posting lists are in doc ID order, just like the ordinals, so instead of reading them
+    # whole, we skip straight to each kept candidate
+    kept_candidates.sort()
+    for _, term in term_bounds[t:]:
+        zone_weight = get_zone_weight(term)
+        query_weight = query_vector.get(term) * zone_weight
+        cursors = pf.get_cursors(term)
+        cursor = cursors[0] if len(cursors) == 1 else UnionCursor(cursors)
+        for i in kept_candidates:
+            doc_id = cursor.skip_to(doc_ids[i])
+            if doc_id is None:
+                break
+            if doc_id == doc_ids[i]:
+                doc_weight = 1 + log10(cursor.term_freq())
+                scores[i] += doc_weight * zone_weight * query_weight
+
+    return kept_candidates
+
+
+def get_zone_weight(term: TermId) -> float:
+    """
+    Gets the multiplier for the zone of a term. The multiplier is applied to both the query
+    and the document weights of the term.
+    :param term: The term ID
+    :return: The zone multiplier
+    """
+    zone = term % NUM_ZONES
+    if zone == DATE_ZONE:  # dates and titles should be boosted since they are important
+        return 1.5
+    elif zone == TITLE_ZONE:
+        return 1.5
+    elif zone == CONTENT_ZONE:
+        return 1.0
+    else:  # other sections can be ranked lower than the content itself
+        return 0.8
 
 
 # TODO: Do we need this function?
@@ -259,84 +657,46 @@ def boolean_and(lst_1: List[DocId], lst_2: List[DocId]):
 #     return list(zip(*list_of_tuple))[index]
 
 
-def calc_query_vector(postings_file: str,
-                      pointer_dct: Dict[Term, int],
-                      query_terms: List[str],
-                      n: int) -> Vector:
+def calc_query_vector(pointer_dct: SegmentedDictionary,
+                      query_terms: List[TermId],
+                      n: int,
+                      word_weights: Optional[Dict[WordId, float]] = None) -> SparseVector:
     """
     Calculates a query vector based on given query terms.
-    Query vector will be in the form of a dictionary of term -> weight.
-    :param postings_file: The name of the postings file
-    :param pointer_dct: The dictionary of term -> postings file pointer
+    Query vector will be in the form of a SparseVector of term -> weight.
+    :param pointer_dct: The term dictionary
     :param query_terms: The list of query terms
     :param n: The total number of documents
+    :param word_weights: If given, the weight of each term is scaled by the weight of its word
     :return: The query vector
     """
     query_vector: Vector = dict()
 
-    with PostingReader(postings_file, pointer_dct) as pf:
-        for term in query_terms:
-            query_vector[term] = calc_query_tfidf(
-                term, query_terms, n, pf)
-
-    return query_vector
+    for term in query_terms:
+        query_vector[term] = calc_query_tfidf(
+            term, query_terms, n, pointer_dct)
+        if word_weights is not None:
+            query_vector[term] *= word_weights.get(term // NUM_ZONES, 1.)
 
+    return SparseVector.from_dict(query_vector)
 
-def calc_doc_vectors(postings_file: str,
-                     pointer_dct: Dict[Term, int],
-                     query_terms: List[str]) -> Dict[DocId, Vector]:
-    """
-    Calculates a doc vectors based on given query terms.
-    Document vectors will be in the form of a dictionary of (doc ID, term) -> weight.
-    :param postings_file: The name of the postings file
-    :param pointer_dct: The dictionary of term -> postings file pointer
-    :param query_terms: The set of query terms
-    :return: The document vector dictionary
-    """
-    doc_score_dct: Dict[Term, Dict[DocId, TermWeight]] = dict()
-    doc_vector_dct: Dict[DocId, Vector]
 
-    with PostingReader(postings_file, pointer_dct) as pf:
-        for query_term in query_terms:
-            doc_score_dct[query_term] = get_doc_tfidf_dict(query_term, pf)
-
-    doc_vector_dct = invert_nested_dict(doc_score_dct)
-    return doc_vector_dct
-
-
-def invert_nested_dict(original: Dict) -> Dict:
-    """
-    Simple utility function.
-    If a dictionary is originally dct[a][b] = c, this function inverts it to become dct[b][a] = c instead.
-    :param original: Original dictionary, should be nested by one layer
-    :return: Inverted dictionary as described
-    """
-    flipped = dict()
-    for key, nested_dct in original.items():
-        for subkey, val in nested_dct.items():
-            if subkey not in flipped:
-                flipped[subkey] = {key: val}
-            else:
-                flipped[subkey][key] = val
-    return flipped
-
-
-def calc_query_tfidf(term: Term,
-                     query_terms: List[Term],
+def calc_query_tfidf(term: TermId,
+                     query_terms: List[TermId],
                      n: int,
-                     pf: PostingReader) -> float:
+                     pointer_dct: SegmentedDictionary) -> float:
     """
     Calculates the tf-idf weight of a term in a query.
-    Takes in the posting file reader, N (total number of docs), and the list of tokens in the query.
+    Takes in the term dictionary, N (total number of docs), and the list of tokens in the query.
     Returns a SINGLE tf-idf weight for that term and query.
+    The doc frequency is kept in the dictionary, so the postings file is not touched.
     :param term: The term itself
     :param query_terms: List of tokens representing the query
     :param n: Total number of documents
-    :param pf: The postings file reader interface
+    :param pointer_dct: The term dictionary
     :return: The calculated weight
     """
-    pf.seek_term(term)
-    df = pf.get_doc_freq()  # document frequency of term
+    df = pointer_dct.get_doc_freq(term)  # document frequency of term
     idf = log10(n / df)  # inverse document freq of term
 
     term_freq = query_terms.count(term)
@@ -345,27 +705,20 @@ def calc_query_tfidf(term: Term,
     return weight
 
 
-def get_doc_tfidf_dict(term: str,
-                       pf: PostingReader) -> Dict[DocId, float]:
+def make_doc_tfidf_generator(term: TermId,
+                              pf: SegmentedPostingReader) -> Iterator[Tuple[DocId, float]]:
     """
-    Calculates the tf-idf weight of a term, for all docs listed in its
-    posting list.
-    Takes in the posting file reader and N (total number of docs).
-    Returns a dictionary of doc ID -> tf-idf weight for that term/doc.
+    Generator for the tf weight (1 + log(tf)) of a term, for all docs listed in its posting list.
+    Takes in the posting file reader, and generates (doc ID, tf weight) for that term/doc.
+    Only the term frequencies are needed, so the term positions are never decoded.
     :param term: The term itself
     :param pf: The postings file reader interface
-    :return: The dictionary of calculated weights for each doc ID
+    :return: A generator object of (doc ID, tf weight) tuples
     """
-    pf.seek_term(term)
+    pf.seek_term(term, read_pos=False)
 
-    weight_dct: Dict[DocId, float] = dict()
-    prev_doc = 0
-    while pf.get_num_docs_remaining() > 0:
+    while not pf.is_done():
+        # since we read directly from posting list,
+        # term freq will never be 0, so we can ignore that case
         doc_id, term_freq, _ = pf.read_entry()
-        if doc_id != prev_doc:
-            # since we read directly from posting list,
-            # term freq will never be 0, so we can ignore that case
-            weight_dct[doc_id] = 1 + log10(term_freq)
-            prev_doc = doc_id
-
-    return weight_dct
+        yield doc_id, 1 + log10(term_freq)
@@ -0,0 +1,486 @@
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import log10
+from typing import Any, List
+from InputOutput import PostingReader, PostingCursor, TermDictionary, DocLengths, ChampionLists, DocStore, \
+    DateIndex
+from SparseVector import SparseVector
+from Types import *
+
+import Config
+
+# INDEX SEGMENTS
+# The index is made of one or more segments. Each segment is a complete index of some of the documents, with its
+# own dictionary, postings, lengths, champion and doc store files, and no doc is in more than one segment.
+# A full build writes a single segment. Indexing a delta CSV adds a new segment instead of rebuilding everything,
+# and merging folds all the segments back into one. The segments manifest lists the live segments, and searching
+# reads all of them, working out idf from the doc frequencies and number of docs of all segments together.
+
+
+# === SEGMENTS MANIFEST ===
+
+def get_segment_file(file: str, segment: SegmentId) -> str:
+    """
+    Segment 0 uses the file names as given, and any other segment puts its number before the extension,
+    e.g. segment 3 of "postings.txt" is "postings.3.txt".
+    :param file: The file name, as given for segment 0
+    :param segment: The segment ID
+    :return: The file name for the segment
+    """
+    if segment == 0:
+        return file
+    root, ext = os.path.splitext(file)
+    return f"{root}.{segment}{ext}"
+
+
+def read_manifest() -> Dict[str, Any]:
+    """
+    Reads the segments manifest, a JSON file of:
+        {"segments": [<segment ID>, ...], "next_segment": <segment ID>}
+    The live segments are listed oldest first, so after a merge the merged segment comes first.
+    next_segment is the ID the next new segment gets. Without a manifest, the index is just segment 0.
+    :return: The manifest
+    """
+    try:
+        with open(Config.SEGMENTS_FILE, "r") as mf:
+            return json.load(mf)
+    except FileNotFoundError:
+        return {"segments": [0], "next_segment": 1}
+
+
+def read_segments() -> List[SegmentId]:
+    """
+    :return: The IDs of the live segments, oldest first
+    """
+    return read_manifest()["segments"]
+
+
+@contextmanager
+def lock_file(file: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    Holds an exclusive lock on a lock file for the duration of a with block.
+    :param file: The name of the lock file (created if it does not exist)
+    :param blocking: Whether to wait for the lock, rather than give up if someone else holds it
+    :return: A context manager giving whether the lock was acquired (always True if blocking)
+    """
+    with open(file, "w") as lock_fp:
+        try:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+
+@contextmanager
+def update_manifest() -> Iterator[Dict[str, Any]]:
+    """
+    Locks the segments manifest, so indexing and merging can safely update it at the same time.
+    The manifest can be changed inside the with block, and is written back when the block ends.
+    The new manifest replaces the old one in a single rename, so searchers never see half of it.
+    :return: A context manager giving the manifest
+    """
+    with lock_file(Config.SEGMENTS_FILE + ".lock"):
+        manifest = read_manifest()
+        yield manifest
+        temp_file = Config.SEGMENTS_FILE + ".tmp"
+        with open(temp_file, "w") as mf:
+            json.dump(manifest, mf)
+        os.replace(temp_file, Config.SEGMENTS_FILE)
+
+
+def delete_segment_files(dict_file: str, postings_file: str, segment: SegmentId) -> None:
+    """
+    Deletes all the files of a segment that is no longer live. Searchers that still have them open keep reading
+    the old files until they reload.
+    :param dict_file: The name of the dictionary file (of segment 0)
+    :param postings_file: The name of the postings file (of segment 0)
+    :param segment: The segment ID
+    """
+    for file in (dict_file, postings_file, Config.LENGTHS_FILE, Config.CHAMPION_FILE, Config.DOCSTORE_FILE,
+                 Config.DATES_FILE):
+        segment_file = get_segment_file(file, segment)
+        if os.path.exists(segment_file):
+            os.remove(segment_file)
+
+
+# === READING ALL SEGMENTS ===
+
+class SegmentedDictionary:
+    """
+    Works like a TermDictionary over all the segments together, with term IDs that mean the same in every segment.
+    A word keeps its word ID from the first segment, and words only found in later segments get the next free word
+    IDs, the first time they are looked up. With a single segment, term IDs are the same as in its dictionary file.
+    Doc frequencies are the totals over all segments.
+    """
+
+    def __init__(self, file: str, segments: List[SegmentId]):
+        self.segments: List[SegmentId] = segments
+        self.dictionaries: List[TermDictionary] = [TermDictionary(get_segment_file(file, segment))
+                                                   for segment in segments]
+        self._num_first_words: int = self.dictionaries[0].get_num_words()
+        self._extra_word_ids: Dict[str, WordId] = {}  # words not in the first segment -> word ID
+        self._extra_words: List[str] = []             # word ID - self._num_first_words -> word
+        # term ID -> term ID in each segment (None if not in it), and the other way round
+        self._local_term_ids: List[Dict[TermId, Optional[TermId]]] = [{} for _ in segments]
+        self._term_ids: List[Dict[TermId, TermId]] = [{} for _ in segments]
+        self._doc_freqs: Dict[TermId, DocFreq] = {}
+
+    def __contains__(self, term_id: TermId) -> bool:
+        return any(self.get_local_term_id(i, term_id) is not None for i in range(len(self.segments)))
+
+    def get_doc_freq(self, term_id: TermId) -> DocFreq:
+        """
+        :param term_id: The desired term ID, which must be in the dictionary
+        :return: The document frequency of the term, over all segments
+        """
+        doc_freq = self._doc_freqs.get(term_id)
+        if doc_freq is None:
+            doc_freq = 0
+            for i, dictionary in enumerate(self.dictionaries):
+                local_term_id = self.get_local_term_id(i, term_id)
+                if local_term_id is not None:
+                    doc_freq += dictionary.get_doc_freq(local_term_id)
+            assert doc_freq > 0, "Term not found in dictionary!"
+            self._doc_freqs[term_id] = doc_freq
+        return doc_freq
+
+    def get_word_id(self, word: str) -> Optional[WordId]:
+        """
+        :param word: The desired word
+        :return: The word ID of the word, or None if it is not in any segment (in any zone)
+        """
+        word_id = self.dictionaries[0].get_word_id(word)
+        if word_id is not None:
+            return word_id
+        word_id = self._extra_word_ids.get(word)
+        if word_id is not None:
+            return word_id
+        if any(dictionary.get_word_id(word) is not None for dictionary in self.dictionaries[1:]):
+            word_id = self._extra_word_ids[word] = self._num_first_words + len(self._extra_words)
+            self._extra_words.append(word)
+            return word_id
+        return None
+
+    def get_term_id(self, word: str, zone: ZoneId) -> Optional[TermId]:
+        """
+        :param word: The desired word
+        :param zone: The desired zone
+        :return: The term ID of the word in that zone, or None if it is not in any segment
+        """
+        word_id = self.get_word_id(word)
+        if word_id is None:
+            return None
+        term_id = word_id * NUM_ZONES + zone
+        return term_id if term_id in self else None
+
+    def get_word(self, word_id: WordId) -> str:
+        """
+        :param word_id: The ID of a word
+        :return: The word with that ID
+        """
+        if word_id < self._num_first_words:
+            return self.dictionaries[0].get_word(word_id)
+        return self._extra_words[word_id - self._num_first_words]
+
+    def get_term(self, term_id: TermId) -> Term:
+        """
+        Turns a term ID back into a readable term, like "title@appeal". Mostly useful for debugging.
+        :param term_id: The ID of a term
+        :return: The term with that ID
+        """
+        word_id, zone = divmod(term_id, NUM_ZONES)
+        return ZONE_NAMES[zone] + "@" + self.get_word(word_id)
+
+    def get_local_term_id(self, i: int, term_id: TermId) -> Optional[TermId]:
+        """
+        :param i: The index of the segment (in self.segments)
+        :param term_id: The term ID
+        :return: The ID of the same term in the segment's own dictionary, or None if it is not in the segment
+        """
+        if i == 0:
+            return term_id if term_id in self.dictionaries[0] else None
+        local_term_ids = self._local_term_ids[i]
+        if term_id not in local_term_ids:
+            word_id, zone = divmod(term_id, NUM_ZONES)
+            local_term_ids[term_id] = self.dictionaries[i].get_term_id(self.get_word(word_id), zone)
+        return local_term_ids[term_id]
+
+    def get_term_id_from_local(self, i: int, local_term_id: TermId) -> TermId:
+        """
+        :param i: The index of the segment (in self.segments)
+        :param local_term_id: The ID of a term in the segment's own dictionary
+        :return: The term ID of the same term
+        """
+        if i == 0:
+            return local_term_id
+        term_ids = self._term_ids[i]
+        if local_term_id not in term_ids:
+            local_word_id, zone = divmod(local_term_id, NUM_ZONES)
+            word_id = self.get_word_id(self.dictionaries[i].get_word(local_word_id))
+            term_ids[local_term_id] = word_id * NUM_ZONES + zone
+        return term_ids[local_term_id]
+
+    def close(self) -> None:
+        for dictionary in self.dictionaries:
+            dictionary.close()
+
+
+class SegmentedPostingReader:
+    """
+    Works like a PostingReader over all the segments together, for term IDs of a SegmentedDictionary.
+    Seeking to a term reads its posting list in every segment it is in, one segment after another, so entries come
+    out in ascending order of doc ID within each segment, but not overall. For going through docs in order, get the
+    cursors of a term in every segment with get_cursors, and go through them together (e.g. with a UnionCursor).
+    Should be used with a context manager, just like PostingReader.
+    """
+
+    def __init__(self, file: str, dct: SegmentedDictionary):
+        self._dct: SegmentedDictionary = dct
+        self._readers: List[PostingReader] = [PostingReader(get_segment_file(file, segment), dictionary)
+                                              for segment, dictionary in zip(dct.segments, dct.dictionaries)]
+        self._seeked_readers: List[PostingReader] = []  # readers of the segments the current term is in
+        self._current: int = 0                          # index of the reader being read in self._seeked_readers
+
+    def seek_term(self, term: TermId, read_pos: bool = True) -> None:
+        """
+        Seeks to the desired term in every segment it is in (see PostingReader.seek_term).
+        :param term: The desired term ID
+        :param read_pos: Whether to read the term positions
+        """
+        self._seeked_readers = []
+        self._current = 0
+        for i, reader in enumerate(self._readers):
+            local_term = self._dct.get_local_term_id(i, term)
+            if local_term is not None:
+                reader.seek_term(local_term, read_pos)
+                self._seeked_readers.append(reader)
+        assert self._seeked_readers, "Term not found in dictionary!"
+
+    def get_term_info(self, term: TermId) -> Tuple[DocFreq, float]:
+        """
+        Reads just the headers of a term's posting lists (see PostingReader.get_term_info).
+        :param term: The desired term ID
+        :return: Tuple of the document frequency and max score of the term, over all segments
+        """
+        doc_freq, max_score = 0, 0.
+        for i, reader in enumerate(self._readers):
+            local_term = self._dct.get_local_term_id(i, term)
+            if local_term is not None:
+                segment_doc_freq, segment_max_score = reader.get_term_info(local_term)
+                doc_freq += segment_doc_freq
+                max_score = max(max_score, segment_max_score)
+        assert doc_freq > 0, "Term not found in dictionary!"
+        return doc_freq, max_score
+
+    def get_cursors(self, term: TermId) -> List[PostingCursor]:
+        """
+        Gets a cursor over the posting list of a term in every segment it is in (see PostingReader.get_cursor).
+        :param term: The desired term ID
+        :return: The list of cursors, which is empty if the term is not in any segment
+        """
+        cursors: List[PostingCursor] = []
+        for i, reader in enumerate(self._readers):
+            local_term = self._dct.get_local_term_id(i, term)
+            if local_term is not None:
+                cursors.append(reader.get_cursor(local_term))
+        return cursors
+
+    def read_entry(self) -> Tuple[DocId, TermFreq, TermPos]:
+        """
+        Reads the next entry of the current term, moving on to the next segment once a segment runs out
+        (see PostingReader.read_entry).
+        :return: Tuple of document ID, term frequency, term position
+        """
+        while self._seeked_readers[self._current].is_done():
+            self._current += 1
+        return self._seeked_readers[self._current].read_entry()
+
+    def is_done(self):
+        return all(reader.is_done() for reader in self._seeked_readers[self._current:])
+
+    def __enter__(self):
+        for reader in self._readers:
+            reader.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # parameters here are required by Python, we won't use them
+        for reader in self._readers:
+            reader.__exit__(exc_type, exc_value, exc_traceback)
+
+
+class SegmentedDocLengths:
+    """
+    Works like DocLengths over all the segments together. Each doc has an ordinal, its position in the sorted list
+    of doc IDs of all segments, so doc_ids[ordinal] and lengths[ordinal] give a doc's ID and length.
+    With a single segment, these are just the arrays of its memory-mapped lengths file. Otherwise, they are merged
+    into arrays in memory.
+    """
+
+    def __init__(self, file: str, segments: List[SegmentId]):
+        self.segment_docs_lens: List[DocLengths] = [DocLengths(get_segment_file(file, segment))
+                                                    for segment in segments]
+        if len(segments) == 1:
+            self.doc_ids = self.segment_docs_lens[0].doc_ids
+            self.lengths = self.segment_docs_lens[0].lengths
+        else:
+            docs = sorted((doc_id, doc_len) for docs_len in self.segment_docs_lens
+                          for doc_id, doc_len in zip(docs_len.doc_ids, docs_len.lengths))
+            self.doc_ids = array("I", (doc_id for doc_id, _ in docs))
+            self.lengths = array("d", (doc_len for _, doc_len in docs))
+        self._ordinals: Optional[Dict[DocId, int]] = None
+
+    def get_segment_index(self, doc_id: DocId) -> Optional[int]:
+        """
+        :param doc_id: The doc ID
+        :return: The index of the segment (in the list of segments) the doc is in, or None if it is in none
+        """
+        for i, docs_len in enumerate(self.segment_docs_lens):
+            if doc_id in docs_len:
+                return i
+        return None
+
+    def get_ordinal(self, doc_id: DocId) -> Optional[int]:
+        """
+        :param doc_id: The doc ID
+        :return: The ordinal of the doc, or None if it is not in the collection
+        """
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+    def get_ordinals(self) -> Dict[DocId, int]:
+        """
+        Gets a dictionary of doc ID -> ordinal, for when many docs need to be looked up quickly.
+        It is only built once, on the first call.
+        :return: The dictionary of doc ID -> ordinal
+        """
+        if self._ordinals is None:
+            self._ordinals = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        return self._ordinals
+
+    def __contains__(self, doc_id: DocId) -> bool:
+        return self.get_ordinal(doc_id) is not None
+
+    def __getitem__(self, doc_id: DocId) -> DocLength:
+        i = self.get_ordinal(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        return self.lengths[i]
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> Iterator[DocId]:
+        return iter(self.doc_ids)
+
+    def close(self) -> None:
+        for docs_len in self.segment_docs_lens:
+            docs_len.close()
+
+
+class SegmentedChampionLists:
+    """
+    Works like ChampionLists over all the segments together, with term IDs of a SegmentedDictionary.
+    The champion files only store the normalized tf weights of the terms, and the idf is applied when a champion list
+    is read, using the doc frequencies and number of docs of all segments. So champion lists of older segments stay
+    correct as more segments are added, without ever being rewritten.
+    """
+
+    def __init__(self,
+                 file: str,
+                 segments: List[SegmentId],
+                 docs_len: SegmentedDocLengths,
+                 dct: SegmentedDictionary):
+        self._docs_len: SegmentedDocLengths = docs_len
+        self._dct: SegmentedDictionary = dct
+        self._champion_lists: List[ChampionLists] = [ChampionLists(get_segment_file(file, segment), segment_docs_len)
+                                                     for segment, segment_docs_len
+                                                     in zip(segments, docs_len.segment_docs_lens)]
+
+    def __contains__(self, doc_id: DocId) -> bool:
+        return doc_id in self._docs_len
+
+    def __getitem__(self, doc_id: DocId) -> List[Tuple[TermId, TermWeight]]:
+        i = self._docs_len.get_segment_index(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        N = len(self._docs_len)
+        champion_list: List[Tuple[TermId, TermWeight]] = []
+        for local_term, tf_weight in self._champion_lists[i][doc_id]:
+            term = self._dct.get_term_id_from_local(i, local_term)
+            champion_list.append((term, tf_weight * log10(N / self._dct.get_doc_freq(term))))
+        return champion_list
+
+    def get_vector(self, doc_id: DocId) -> SparseVector:
+        """
+        :param doc_id: The doc ID
+        :return: The champion list of the doc as a SparseVector
+        """
+        # champion lists are sorted by local term ID, which is only the same order as the term IDs in the first segment
+        is_sorted = self._docs_len.get_segment_index(doc_id) == 0
+        return SparseVector.from_pairs(self[doc_id], is_sorted)
+
+    def close(self) -> None:
+        for champion_lists in self._champion_lists:
+            champion_lists.close()
+
+
+class SegmentedDocStore:
+    """
+    Works like DocStore over all the segments together, i.e. a read-only Dict[DocId, List[str]] of doc ID -> row
+    of the input CSV file the doc was indexed from. Each segment's doc store only holds where its docs are,
+    so getting a doc reads just its row with a single seek.
+    """
+
+    def __init__(self, file: str, segments: List[SegmentId], docs_len: SegmentedDocLengths):
+        self._docs_len: SegmentedDocLengths = docs_len
+        self._doc_stores: List[DocStore] = [DocStore(get_segment_file(file, segment)) for segment in segments]
+
+    def __contains__(self, doc_id: DocId) -> bool:
+        return doc_id in self._docs_len
+
+    def __getitem__(self, doc_id: DocId) -> List[str]:
+        i = self._docs_len.get_segment_index(doc_id)
+        if i is None:
+            raise KeyError(doc_id)
+        return self._doc_stores[i][doc_id]
+
+    def close(self) -> None:
+        for doc_store in self._doc_stores:
+            doc_store.close()
+
+
+class SegmentedDateIndex:
+    """
+    Works like DateIndex over all the segments together, for finding the docs posted within a date range.
+    """
+
+    def __init__(self, file: str, segments: List[SegmentId]):
+        self._date_indexes: List[DateIndex] = [DateIndex(get_segment_file(file, segment)) for segment in segments]
+
+    def get_doc_ids(self, start_date: int, end_date: int) -> List[DocId]:
+        """
+        :param start_date: The first date of the range, as an ordinal (see date.toordinal)
+        :param end_date: The last date of the range (inclusive), as an ordinal
+        :return: The doc IDs of the docs posted within the range, from every segment
+        """
+        doc_ids: List[DocId] = []
+        for date_index in self._date_indexes:
+            doc_ids.extend(date_index.get_doc_ids(start_date, end_date))
+        return doc_ids
+
+    def close(self) -> None:
+        for date_index in self._date_indexes:
+            date_index.close()
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import repeat
+from typing import Iterable, List
+from Types import *
+
+# SPARSE VECTORS
+# Query vectors, champion lists and centroids are all sparse vectors of term ID -> weight. Instead of dictionaries,
+# they are kept as a sorted array of term IDs and a matching array of weights, so adding two vectors is a single
+# linear merge, and summing many vectors (e.g. for a centroid) is a single k-way merge.
+
+
+class SparseVector:
+    """
+    A sparse vector of term weights, as an array of term IDs in ascending order and an array of their weights.
+    Vectors are never modified in place, every operation gives a new vector.
+    Iterating over a vector gives its (term ID, weight) pairs in ascending order of term ID.
+    """
+
+    __slots__ = ("terms", "weights")
+
+    def __init__(self, terms: Optional[array] = None, weights: Optional[array] = None):
+        self.terms: array = terms if terms is not None else array("I")
+        self.weights: array = weights if weights is not None else array("d")
+
+    @staticmethod
+    def from_pairs(pairs: Iterable[Tuple[TermId, TermWeight]], is_sorted: bool = False) -> SparseVector:
+        """
+        :param pairs: The (term ID, weight) pairs, with no term ID repeated
+        :param is_sorted: Whether the pairs are already in ascending order of term ID
+        :return: The vector of the pairs
+        """
+        if not is_sorted:
+            pairs = sorted(pairs)
+        vector = SparseVector()
+        for term, weight in pairs:
+            vector.terms.append(term)
+            vector.weights.append(weight)
+        return vector
+
+    @staticmethod
+    def from_dict(vector: Vector) -> SparseVector:
+        """
+        :param vector: The dictionary of term ID -> weight
+        :return: The same vector as a SparseVector
+        """
+        return SparseVector.from_pairs(vector.items())
+
+    def to_dict(self) -> Vector:
+        return dict(zip(self.terms, self.weights))
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __iter__(self) -> Iterator[Tuple[TermId, TermWeight]]:
+        return zip(self.terms, self.weights)
+
+    def __contains__(self, term: TermId) -> bool:
+        i = bisect_left(self.terms, term)
+        return i < len(self.terms) and self.terms[i] == term
+
+    def get(self, term: TermId, default: TermWeight = 0.) -> TermWeight:
+        """
+        :param term: The term ID
+        :param default: The weight to give if the term is not in the vector
+        :return: The weight of the term
+        """
+        i = bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return self.weights[i]
+        return default
+
+    def max_weight(self) -> TermWeight:
+        """
+        :return: The highest weight in the vector (0 if it is empty)
+        """
+        return max(self.weights, default=0.)
+
+    def scale(self, factor: float) -> SparseVector:
+        """
+        :param factor: The factor to multiply every weight by
+        :return: The scaled vector
+        """
+        return SparseVector(array("I", self.terms), array("d", (weight * factor for weight in self.weights)))
+
+    def add(self, other: SparseVector, other_factor: float = 1.) -> SparseVector:
+        """
+        Adds another vector (multiplied by a factor) to this one, in a single linear merge of the two.
+        :param other: The vector to add
+        :param other_factor: The factor to multiply the other vector's weights by first, e.g. -1 to subtract it
+        :return: The sum of the vectors
+        """
+        terms, weights = array("I"), array("d")
+        self_terms, self_weights, other_terms, other_weights = self.terms, self.weights, other.terms, other.weights
+        i = j = 0
+        while i < len(self_terms) and j < len(other_terms):
+            if self_terms[i] < other_terms[j]:
+                terms.append(self_terms[i])
+                weights.append(self_weights[i])
+                i += 1
+            elif self_terms[i] > other_terms[j]:
+                terms.append(other_terms[j])
+                weights.append(other_weights[j] * other_factor)
+                j += 1
+            else:
+                terms.append(self_terms[i])
+                weights.append(self_weights[i] + other_weights[j] * other_factor)
+                i += 1
+                j += 1
+        terms.extend(self_terms[i:])
+        weights.extend(self_weights[i:])
+        terms.extend(other_terms[j:])
+        weights.extend(weight * other_factor for weight in other_weights[j:])
+        return SparseVector(terms, weights)
+
+    @staticmethod
+    def mean(vectors: List[SparseVector], count: Optional[int] = None) -> SparseVector:
+        """
+        Sums up many vectors in a single k-way merge, then divides by their count.
+        The weights of each term are added in the order of the vectors given.
+        :param vectors: The vectors to average
+        :param count: The number to divide the sum by, if not the number of vectors (e.g. to count missing vectors)
+        :return: The mean vector
+        """
+        count = len(vectors) if count is None else count
+        if count == 0:
+            return SparseVector()
+        terms, weights = array("I"), array("d")
+        merged = heapq.merge(*(zip(vector.terms, repeat(i), vector.weights) for i, vector in enumerate(vectors)))
+        for term, _, weight in merged:
+            if terms and terms[-1] == term:
+                weights[-1] += weight
+            else:
+                terms.append(term)
+                weights.append(weight)
+        for i in range(len(weights)):
+            weights[i] /= count
+        return SparseVector(terms, weights)
+
+    def top_n(self, n: int) -> SparseVector:
+        """
+        :param n: The number of terms to keep
+        :return: The vector of just the n terms with the highest weights (ties going to the lower term ID)
+        """
+        if len(self.terms) <= n:
+            return self
+        kept = sorted(heapq.nsmallest(n, range(len(self.terms)), key=lambda i: (-self.weights[i], self.terms[i])))
+        return SparseVector(array("I", (self.terms[i] for i in kept)), array("d", (self.weights[i] for i in kept)))
+
+    def prune(self, min_weight: TermWeight) -> SparseVector:
+        """
+        :param min_weight: The lowest weight to keep
+        :return: The vector of just the terms with at least the given weight
+        """
+        kept = [i for i, weight in enumerate(self.weights) if weight >= min_weight]
+        return SparseVector(array("I", (self.terms[i] for i in kept)), array("d", (self.weights[i] for i in kept)))
+
+    def drop_non_positive(self) -> SparseVector:
+        """
+        :return: The vector of just the terms with a weight above 0 (e.g. after subtracting another vector)
+        """
+        kept = [i for i, weight in enumerate(self.weights) if weight > 0]
+        return SparseVector(array("I", (self.terms[i] for i in kept)), array("d", (self.weights[i] for i in kept)))
+
+    def restrict(self, terms: Iterable[TermId]) -> SparseVector:
+        """
+        :param terms: The terms to keep
+        :return: The vector of just the given terms that are in this vector
+        """
+        return SparseVector.from_pairs(((term, self.get(term)) for term in sorted(set(terms)) if term in self),
+                                       is_sorted=True)
@@ -3,25 +3,163 @@ from __future__ import annotations
 import ctypes as ct
 
 import csv
+import getopt
+import multiprocessing
 import nltk
+import os
+import re
 import string
+import sys
+import time
 import Config
 
+from collections import Counter, deque
+from functools import lru_cache
 from Types import *
-from typing import List, Set
+from typing import FrozenSet, List, NamedTuple, Set
 
 STEMMER = nltk.stem.porter.PorterStemmer()
 csv.field_size_limit(int(ct.c_ulong(-1).value // 2))  # found a fix from StackOverflow for field size too small
 
 
-def make_doc_read_generator(in_file: str, stop_words_file: str) -> TermInfoTupleGenerator:
+@lru_cache(maxsize=Config.STEM_CACHE_SIZE)
+def stem(token: str) -> str:
     """
-    Generator function for the next (term, term_pos, doc_length, doc_id) tuple.
+    Stems a token, remembering the stems of recently seen tokens. Legal text is very repetitive, so most tokens
+    have been stemmed before. The cache is shared by everything in the process, i.e. the whole indexing run
+    (or each tokenizer worker) and every query. Use stem.cache_info() to see how well it is doing.
+    :param token: The token to be stemmed
+    :return: The stemmed token
+    """
+    return STEMMER.stem(token)
+
+
+def format_stem_cache_info(hits: int, misses: int, size: int) -> str:
+    """
+    :param hits: The number of stems found in the cache
+    :param misses: The number of stems not found in the cache
+    :param size: The number of stems in the cache
+    :return: A one-line summary of the stem cache statistics
+    """
+    hit_rate = hits / (hits + misses) if hits + misses else 0
+    return f"stem cache: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate), {size} entries"
+
+
+class CourtKeywords(NamedTuple):
+    """
+    The parsing config of a court (see Config.PARSING_CONFIG), with the keywords stemmed and put into sets.
+    """
+    section_num_words: int
+    section_keywords: FrozenSet[str]
+    parties_num_words: int
+    parties_keywords: FrozenSet[str]
+
+
+def compile_court_keywords() -> Dict[str, CourtKeywords]:
+    """
+    Stems the keywords of every court in Config.PARSING_CONFIG, so create_zones doesn't redo it for every document.
+    :return: Dictionary of court name -> CourtKeywords
+    """
+    return {court: CourtKeywords(court_field['num_words'],
+                                 frozenset(stem(tok) for tok in court_field['section'].split(', ')),
+                                 court_field['parties_num_words'],
+                                 frozenset(stem(tok) for tok in court_field['parties'].split(', ')))
+            for court, court_field in Config.PARSING_CONFIG.items()}
+
+
+COURT_KEYWORDS: Dict[str, CourtKeywords] = compile_court_keywords()
+
+# REGEX TOKENIZER
+# A single regex that splits (lowercased) text the same way as nltk.word_tokenize, i.e. Punkt sentence splitting
+# followed by the Treebank word tokenizer, but without ever building the sentences. Roughly:
+# - whitespace, brackets, quotes and most symbols always split words, as do "--" and ".."
+# - commas and colons stay inside numbers (1,000 or 10:30), and single periods stay inside words (s.24 or u.s)
+# - a word-final period is a sentence end and is split off, except after a number or an initial that is followed
+#   by a lowercase word (Punkt does not start a sentence there), e.g. "1,000. the" keeps the "1,000."
+# - the clitics 's 'm 'd 'll 're 've and n't are split off the end of words
+# - fancy quotes and dashes are tokens of their own
+# - words made up of only (ASCII) punctuation are skipped, like nltk_word_tokenize drops them after splitting
+#   (a skipped word's suffixes are all punctuation too, so skipping never changes where the next word starts)
+# Punkt's abbreviation heuristics are not copied, so e.g. "mr." before a lowercase word can come out differently.
+_SPLIT_CHARS = "\\s()\\[\\]{}<>\"`;@#$%&?!*«»“”‘’„‒-―"
+_CLOSING_CHARS = "\\]\\)}>\"'»”’"
+_FINAL_PERIOD = rf"\.(?=[{_CLOSING_CHARS}]*(?:\s|$)|[;:@*?!(\[{{])"
+_WORD_END = rf"(?=[{_SPLIT_CHARS}]|[,:](?!\d)|--|\.\.|{_FINAL_PERIOD}|''|$)"
+_CLITIC = rf"(?:'(?:s|m|d|ll|re|ve)|n't){_WORD_END}"
+_WORD_CHAR = (rf"(?!(?:'(?:s|m|d|ll|re|ve)?|n't){_WORD_END})"  # a clitic (or trailing ') starts a new token
+              rf"(?:[^{_SPLIT_CHARS},:.'\-]"
+              rf"|(?<!-)-(?!-)"
+              rf"|[,:](?=\d)"
+              rf"|(?<!\.)(?!{_FINAL_PERIOD})\.(?!\.)"
+              rf"|(?<=\w)'(?!')"
+              rf"|(?<!\w)(?<!')'(?=(?:re|ve|ll|m|t|s|d|n)\b))")
+_NOT_ONLY_PUNCT = rf"(?=(?:{_WORD_CHAR})*?(?![{re.escape(string.punctuation)}])(?:{_WORD_CHAR}))"
+_NUMBER_OR_INITIAL = rf"(?<![^\s(\[{{`\"])(?:-?[.,]?\d[\d,.:\-]*|[^\W\d_])\.(?=[;:]|\s+[;:,.!?]|\s+[^\W\d_])"
+TOKEN_REGEX = re.compile(rf"{_NUMBER_OR_INITIAL}|[«»“”‘’„‒-―]"
+                         rf"|{_CLITIC}|{_NOT_ONLY_PUNCT}(?:{_WORD_CHAR})+")
+
+# words that the Treebank word tokenizer splits in two
+SPLIT_CONTRACTIONS: Dict[str, List[str]] = {
+    "cannot": ["can", "not"], "d'ye": ["d", "'ye"], "gimme": ["gim", "me"], "gonna": ["gon", "na"],
+    "gotta": ["got", "ta"], "lemme": ["lem", "me"], "more'n": ["more", "'n"], "wanna": ["wan", "na"],
+    "'tis": ["'t", "is"], "'twas": ["'t", "was"],
+}
+
+
+def is_not_only_punct(tok: str) -> bool:
+    """
+    :param tok: The token to check
+    :return: Whether the token has any character that is not punctuation
+    """
+    return any(char not in string.punctuation for char in tok)
+
+
+def nltk_word_tokenize(doc_text: str) -> List[str]:
+    """
+    Case-folds and splits text with nltk.word_tokenize, dropping tokens that are purely punctuation.
+    :param doc_text: The text to be split
+    :return: List of (unstemmed) tokens
+    """
+    tokens = nltk.tokenize.word_tokenize(doc_text.lower())
+    return [tok for tok in tokens if is_not_only_punct(tok)]
+
+
+def regex_word_tokenize(doc_text: str) -> List[str]:
+    """
+    Case-folds and splits text with TOKEN_REGEX, which already skips tokens that are purely punctuation.
+    Gives the same tokens as nltk_word_tokenize (besides the abbreviations noted above TOKEN_REGEX), much faster.
+    :param doc_text: The text to be split
+    :return: List of (unstemmed) tokens
+    """
+    tokens = []
+    for tok in TOKEN_REGEX.findall(doc_text.lower()):
+        if tok in SPLIT_CONTRACTIONS:
+            tokens += SPLIT_CONTRACTIONS[tok]
+        else:
+            tokens.append(tok)
+    return tokens
+
+
+def make_doc_read_generator(in_file: str,
+                            stop_words_file: str,
+                            num_workers: int = 1,
+                            batch_size: int = 32,
+                            skip_doc_ids: Optional[Set[DocId]] = None,
+                            doc_locations: Optional[Dict[DocId, Tuple[str, int, int]]] = None
+                            ) -> TermInfoTupleGenerator:
+    """
+    Generator function for the next (word, zone, term_pos, doc_length, doc_id) tuple.
     Call this function to make the generator first, then use next() to generate the next tuple.
     Skips over stop words.
-    Yields (None, None, None, None) when done.
+    Yields (None, None, None, None, None) when done.
+    If num_workers is more than 1, documents are tokenized in batches by a pool of worker processes.
+    Tuples are still generated in the same order as the input file, so the output is exactly the same.
     :param in_file: The name of the input file
     :param stop_words_file: The name of the stop words file.
+    :param num_workers: The number of worker processes to tokenize documents with
+    :param batch_size: The number of documents sent to a worker at once
+    :param skip_doc_ids: Doc IDs to skip over, e.g. those already indexed in other segments
+    :param doc_locations: If given, filled with where each doc is in the input file (see make_row_read_generator)
     :return: A generator object for the term information tuple (see above)
     """
 
@@ -29,105 +167,233 @@ def make_doc_read_generator(in_file: str, stop_words_file: str) -> TermInfoTuple
     with open(stop_words_file, 'r') as f:
         stopwords = set(f.read().split())
 
-    already_read: Set[DocId] = set()
-    with open(in_file, mode='r', encoding='utf-8', newline='') as doc:
-        doc_reader = csv.reader(doc)
+    rows = make_row_read_generator(in_file, skip_doc_ids, doc_locations)
+    if num_workers > 1:
+        doc_tokens_generator = tokenize_rows_in_parallel(rows, stopwords, num_workers, batch_size)
+    else:
+        doc_tokens_generator = (tokenize_row(row, stopwords) for row in rows)
+
+    for doc_id, tokens in doc_tokens_generator:
+        doc_length = len(tokens)
+
+        # since we are using a generator, we only count the number of tokens once per file
+        for term_pos, (zone, word) in enumerate(tokens):
+            yield word, zone, term_pos, doc_length, doc_id
+
+    if num_workers <= 1:  # otherwise, the workers' caches are reported by tokenize_rows_in_parallel
+        cache_info = stem.cache_info()
+        print(format_stem_cache_info(cache_info.hits, cache_info.misses, cache_info.currsize))
+    yield None, None, None, None, None
+
+
+class ByteOffsetLines:
+    """
+    Iterates over the lines of a file opened in binary mode as strings, keeping count of the byte offset in the
+    file where the next line starts. csv.reader only takes as many lines as it needs for each row, so the offset
+    before and after reading a row gives exactly where the row is in the file.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.offset: int = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self._f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')  # a newline byte is never part of a multi-byte UTF-8 character
+
+
+def make_row_read_generator(in_file: str,
+                            skip_doc_ids: Optional[Set[DocId]] = None,
+                            doc_locations: Optional[Dict[DocId, Tuple[str, int, int]]] = None
+                            ) -> Iterator[List[str]]:
+    """
+    Generator function for the next row of the input CSV file.
+    Skips the header row, as well as any duplicate doc IDs.
+    :param in_file: The name of the input file
+    :param skip_doc_ids: Doc IDs to skip over, as if they were duplicates
+    :param doc_locations: If given, filled with doc ID -> (in_file, byte offset, byte length) of each row yielded,
+                          for the doc store (see InputOutput.write_doc_store)
+    :return: A generator object for the rows, each as a list of [doc_id, title, content, date_posted, court]
+    """
+    already_read: Set[DocId] = set(skip_doc_ids) if skip_doc_ids else set()
+    with open(in_file, mode='rb') as doc:
+        lines = ByteOffsetLines(doc)
+        doc_reader = csv.reader(lines)
+        row_end = 0
         for i, row in enumerate(doc_reader):
+            row_start, row_end = row_end, lines.offset
+
             if i == 0:
                 continue  # we skip the first row (headers)
             elif i % 50 == 0:
                 print("progress:", i)
 
-            doc_id, title, content, date_posted, court = row
-
             # since duplicates exist in the corpus, here we skip doc IDs already processed
-            if int(doc_id) in already_read:
+            doc_id = int(row[0])
+            if doc_id in already_read:
                 continue
             else:
-                already_read.add(int(doc_id))
+                already_read.add(doc_id)
 
-            title_tokens = tokenize(title, "title", stopwords)
-            date_tokens = tokenize(date_posted, "date", stopwords)
-            court_tokens = tokenize(court, "court", stopwords)
+            if doc_locations is not None:
+                doc_locations[doc_id] = (in_file, row_start, row_end - row_start)
+            yield row
 
-            # when zone is "content", perform extra parsing
-            # for this, the name of the court is required so pass it in as a param
-            content_tokens = tokenize(content, "content", stopwords, court=court)
 
-            tokens = title_tokens + content_tokens + date_tokens + court_tokens
-            doc_length = len(tokens)
+def tokenize_row(row: List[str], stop_words: Set[str]) -> Tuple[DocId, List[Tuple[ZoneId, str]]]:
+    """
+    Tokenizes every zone of a single row of the input file.
+    :param row: The row as a list of [doc_id, title, content, date_posted, court]
+    :param stop_words: The set of stop words to be used
+    :return: Tuple of the doc ID and the list of all its (zone, token) pairs
+    """
+    doc_id, title, content, date_posted, court = row
+
+    title_tokens = tokenize(title, TITLE_ZONE, stop_words)
+    date_tokens = tokenize(date_posted, DATE_ZONE, stop_words)
+    court_tokens = tokenize(court, COURT_ZONE, stop_words)
+
+    # when zone is content, perform extra parsing
+    # for this, the name of the court is required so pass it in as a param
+    content_tokens = tokenize(content, CONTENT_ZONE, stop_words, court=court)
+
+    tokens = title_tokens + content_tokens + date_tokens + court_tokens
+
+    # for this assignment, we can assume that document names are integers without exception
+    return int(doc_id), tokens
+
+
+# stop words for tokenize_batch, set once in each worker process by init_tokenize_worker
+_worker_stop_words: Set[str] = set()
+
+
+def init_tokenize_worker(stop_words: Set[str]) -> None:
+    """
+    Initializer for the tokenizer worker processes, so the stop words are only sent once per worker.
+    :param stop_words: The set of stop words to be used
+    """
+    global _worker_stop_words
+    _worker_stop_words = stop_words
 
-            # for this assignment, we can assume that document names are integers without exception
-            # since we are using a generator, we only count the number of tokens once per file
-            for term_pos, term in enumerate(tokens):
-                yield term, term_pos, doc_length, int(doc_id)
-    yield None, None, None, None
+
+def tokenize_batch(rows: List[List[str]]
+                   ) -> Tuple[int, Tuple[int, int, int], List[Tuple[DocId, List[Tuple[ZoneId, str]]]]]:
+    """
+    Tokenizes a batch of rows. Runs in the tokenizer worker processes.
+    Also sends back the worker's stem cache statistics so far, since each worker has its own cache.
+    :param rows: The batch of rows
+    :return: Tuple of the worker's process ID, its stem cache (hits, misses, size),
+             and the list of (doc ID, tokens) tuples in the same order as the rows
+    """
+    doc_tokens = [tokenize_row(row, _worker_stop_words) for row in rows]
+    cache_info = stem.cache_info()
+    return os.getpid(), (cache_info.hits, cache_info.misses, cache_info.currsize), doc_tokens
+
+
+def tokenize_rows_in_parallel(rows: Iterator[List[str]],
+                              stop_words: Set[str],
+                              num_workers: int,
+                              batch_size: int) -> Iterator[Tuple[DocId, List[Tuple[ZoneId, str]]]]:
+    """
+    Fans rows out to a pool of worker processes in batches, and generates the (doc ID, tokens)
+    tuples back in the same order as the rows.
+    Only a bounded number of batches are in flight at any time, so we never read far ahead of
+    the indexer (Pool.imap would happily read the whole input file into its task queue).
+    :param rows: The rows to be tokenized
+    :param stop_words: The set of stop words to be used
+    :param num_workers: The number of worker processes
+    :param batch_size: The number of rows in each batch
+    :return: A generator object for the (doc ID, tokens) tuples
+    """
+    max_in_flight = 2 * num_workers
+    pending = deque()
+    worker_cache_infos: Dict[int, Tuple[int, int, int]] = {}  # latest stem cache statistics of each worker
+
+    def get_batch_result(async_result):
+        pid, worker_cache_infos[pid], doc_tokens = async_result.get()
+        return doc_tokens
+
+    with multiprocessing.Pool(processes=num_workers,
+                              initializer=init_tokenize_worker,
+                              initargs=(stop_words,)) as pool:
+        batch: List[List[str]] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                pending.append(pool.apply_async(tokenize_batch, (batch,)))
+                batch = []
+            if len(pending) >= max_in_flight:
+                yield from get_batch_result(pending.popleft())
+        if batch:
+            pending.append(pool.apply_async(tokenize_batch, (batch,)))
+        while pending:
+            yield from get_batch_result(pending.popleft())
+
+    hits, misses, size = map(sum, zip(*worker_cache_infos.values())) if worker_cache_infos else (0, 0, 0)
+    print(format_stem_cache_info(hits, misses, size) + f" across {len(worker_cache_infos)} workers")
 
 
 def tokenize(doc_text: str,
-             zone: str,
+             zone: ZoneId,
              stop_words: Set[str],
-             court: Optional[str] = None) -> List[str]:
+             court: Optional[str] = None) -> List[Tuple[ZoneId, str]]:
     """
     Takes in document text and tokenizes.
     Also does post-tokenization cleaning like stemming.
     :param doc_text: The text to be tokenized
     :param zone: The zone the text is associated with
     :param stop_words: The set of stop words to be used
-    :param court: The name of the court (only included when zone is "content")
-    :return: List of tokens
+    :param court: The name of the court (only included when zone is content)
+    :return: List of (zone, token) pairs
     """
 
-    # case folding
-    doc_text = doc_text.lower()
-
-    # tokenize and stem
-    tokens = nltk.tokenize.word_tokenize(doc_text)
-    tokens = [STEMMER.stem(tok) for tok in tokens]
+    # case folding, splitting and removing tokens that are purely punctuation
+    if Config.TOKENIZER_BACKEND == "regex":
+        tokens = regex_word_tokenize(doc_text)
+    else:
+        tokens = nltk_word_tokenize(doc_text)
 
-    # remove tokens that are purely punctuation
-    def is_not_only_punct(tok): return any(char not in string.punctuation for char in tok)
-    tokens = [tok for tok in tokens if is_not_only_punct(tok)]
+    # stemming
+    tokens = [stem(tok) for tok in tokens]
 
     # remove stopwords from the tokens and add delimiter for zones
     tokens = [word for word in tokens if word not in stop_words]
 
-    # each token will have the zone appended to the front using the @ symbol
-    # for example, "title@token", "content@token"
-    if zone == "content":
-        tokens = create_zones(tokens, court)
-    else:
-        tokens = [zone + '@' + token for token in tokens]
-
-    return tokens
+    # each token is paired with its zone
+    # content is split up further into the section and parties zones
+    if zone == CONTENT_ZONE:
+        return create_zones(tokens, court)
+    return [(zone, token) for token in tokens]
 
 
-def create_zones(tokens: List[Term], court: str) -> List[Term]:
+def create_zones(tokens: List[str], court: str) -> List[Tuple[ZoneId, str]]:
     """
     Given a list of raw terms, parse them with the specific parser for its court and
-    tag the content with more accurate tags.
+    tag the content with more accurate zones.
     :param tokens: The list of input terms
     :param court: The name of the court as a string
-    :return: The list of tagged terms
+    :return: The list of (zone, term) pairs
     """
     
     # handle the case where we have not created a special parsing config for the court
     # this is only the case for the less frequently occurring courts
-    if court not in Config.PARSING_CONFIG:
-        return ["content@" + tok for tok in tokens]
-    court_field = Config.PARSING_CONFIG[court]
-    
-    # find number of words for that specific court
-    section_num_words = court_field['num_words']
-    section_keywords = [STEMMER.stem(tok) for tok in court_field['section'].split(', ')]
-    parties_num_words = court_field['parties_num_words']
-    parties_keywords = [STEMMER.stem(tok) for tok in court_field['parties'].split(', ')]
+    if court not in COURT_KEYWORDS:
+        return [(CONTENT_ZONE, tok) for tok in tokens]
+
+    # find number of words and the (already stemmed) keywords for that specific court
+    section_num_words, section_keywords, parties_num_words, parties_keywords = COURT_KEYWORDS[court]
     
     term_list = []
     
     # go through each token and tag it!
     # upon encountering a token that's in either keyword set, start a run of
-    # "section@" or "parties@" tagging for the specified duration
+    # section or parties tagging for the specified duration
     remaining_section = 0
     remaining_parties = 0
     for tok in tokens:
@@ -138,12 +404,12 @@ def create_zones(tokens: List[Term], court: str) -> List[Term]:
                 remaining_parties = parties_num_words
         if remaining_section:
             remaining_section -= 1
-            term_list += ["section@" + tok]
+            term_list.append((SECTION_ZONE, tok))
         elif remaining_parties:
             remaining_section -= 1
-            term_list += ["parties@" + tok]
+            term_list.append((PARTIES_ZONE, tok))
         else:
-            term_list += ["content@" + tok]
+            term_list.append((CONTENT_ZONE, tok))
             
     return term_list
 
@@ -154,7 +420,11 @@ def clean_query_token(token: str) -> str:
     :param token: The token to be case-folded and stemmed
     :return: Case-folded and stemmed token
     """
-    return STEMMER.stem(token.lower())
+    return stem(token.lower())
+
+
+# words, runs of whitespace and "quoted phrases"
+QUERY_TOKEN_REGEX = re.compile(r'\w+|\s+|"[^"]+"')
 
 
 def tokenize_query(query: str) -> List[str]:
@@ -165,8 +435,7 @@ def tokenize_query(query: str) -> List[str]:
     :param query: The string to process
     :return: A list of processed tokens
     """
-    tokenizer = nltk.RegexpTokenizer(r'\w+|\s+|"[^"]+"')
-    tokens = tokenizer.tokenize(query)
+    tokens = QUERY_TOKEN_REGEX.findall(query)
     result = []
     for token in tokens:
         token = token.strip().strip('"')
@@ -175,8 +444,96 @@ def tokenize_query(query: str) -> List[str]:
         elif token == "AND":
             result.append(token)
         elif ' ' in token:  # if the token is a phrase,
-            stemmed_phrase = ' '.join([STEMMER.stem(subtoken.strip().casefold()) for subtoken in token.split()])
+            stemmed_phrase = ' '.join([stem(subtoken.strip().casefold()) for subtoken in token.split()])
             result.append(stemmed_phrase)
         else:  # if the token is a single word
-            result.append(STEMMER.stem(token.strip().casefold()))
+            result.append(stem(token.strip().casefold()))
     return result
+
+
+def check_tokenizer_parity(in_file: str,
+                           max_docs: Optional[int] = None,
+                           threshold: float = Config.TOKENIZER_PARITY_THRESHOLD) -> bool:
+    """
+    Splits every zone of the input file with both the nltk and regex tokenizer backends, and prints
+    how often they disagree, the tokens they disagree on most and the time each backend took.
+    The agreement is the fraction of tokens (from both backends) that the other backend gives too.
+    :param in_file: The name of the input file
+    :param max_docs: The maximum number of documents to check (None checks every document)
+    :param threshold: The lowest agreement that passes. At 1, every document has to be tokenized exactly the same
+    :return: Whether the backends agree closely enough
+    """
+    nltk_time = regex_time = 0.0
+    num_docs = num_different_docs = num_tokens = num_different_tokens = 0
+    only_nltk: Counter = Counter()
+    only_regex: Counter = Counter()
+
+    for row in make_row_read_generator(in_file):
+        if max_docs is not None and num_docs == max_docs:
+            break
+        num_docs += 1
+
+        texts = row[1:]  # title, content, date_posted, court
+        start = time.perf_counter()
+        nltk_tokens = [nltk_word_tokenize(text) for text in texts]
+        nltk_time += time.perf_counter() - start
+        start = time.perf_counter()
+        regex_tokens = [regex_word_tokenize(text) for text in texts]
+        regex_time += time.perf_counter() - start
+
+        nltk_counts = Counter(tok for tokens in nltk_tokens for tok in tokens)
+        regex_counts = Counter(tok for tokens in regex_tokens for tok in tokens)
+        num_tokens += sum(nltk_counts.values()) + sum(regex_counts.values())
+        if nltk_tokens != regex_tokens:
+            num_different_docs += 1
+            only_nltk.update(nltk_counts - regex_counts)
+            only_regex.update(regex_counts - nltk_counts)
+            num_different_tokens += sum((nltk_counts - regex_counts).values())
+            num_different_tokens += sum((regex_counts - nltk_counts).values())
+
+    agreement = 1 - num_different_tokens / num_tokens if num_tokens else 1.0
+    print(f"{num_different_docs} of {num_docs} documents tokenized differently, "
+          f"{num_different_tokens} of {num_tokens} tokens ({agreement:.4%} agreement)")
+    print("only from nltk:", only_nltk.most_common(20))
+    print("only from regex:", only_regex.most_common(20))
+    print(f"nltk: {nltk_time:.2f}s, regex: {regex_time:.2f}s")
+
+    # tokens can also differ just in order, which the agreement does not count
+    is_parity = num_different_docs == 0 if threshold >= 1 else agreement >= threshold
+    print(f"tokenizer parity {'passed' if is_parity else 'FAILED'} (threshold {threshold:.4%} agreement)")
+    return is_parity
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -i dataset-file [-n max-docs] [-t threshold]")
+
+
+# python3 Tokenizer.py -i dataset.csv [-n max_docs] [-t threshold]
+# exits with status 1 if the tokenizer backends do not agree closely enough
+if __name__ == "__main__":
+    input_file = None
+    max_num_docs = None
+    parity_threshold = Config.TOKENIZER_PARITY_THRESHOLD
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "i:n:t:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "-i":  # input file
+            input_file = a
+        elif o == "-n":  # maximum number of documents
+            max_num_docs = int(a)
+        elif o == "-t":  # lowest agreement that passes
+            parity_threshold = float(a)
+        else:
+            assert False, "unhandled option"
+
+    if input_file is None:
+        usage()
+        sys.exit(2)
+
+    if not check_tokenizer_parity(input_file, max_num_docs, parity_threshold):
+        sys.exit(1)
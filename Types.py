@@ -9,7 +9,29 @@ TermFreq = int
 TermPos = int
 TermWeight = float
 
-Vector = Dict[Term, TermWeight]
+# every term is a word in a zone, e.g. "appeal" in the title
+# words and zones are both numbered, and the term ID of a word in a zone is (word ID * NUM_ZONES + zone ID)
+WordId = int
+ZoneId = int
+TermId = int
 
-TermInfoTuple = Tuple[Optional[str], Optional[int], Optional[int], Optional[int]]
+Vector = Dict[TermId, TermWeight]
+
+# the words a query token expands to, as (words from the legal thesaurus, words from WordNet)
+ExpansionTuple = Tuple[Tuple[str, ...], Tuple[str, ...]]
+
+# the index is split into segments, each a complete index of some of the documents (see Segments.py)
+SegmentId = int
+
+TermInfoTuple = Tuple[Optional[str], Optional[ZoneId], Optional[int], Optional[int], Optional[int]]
 TermInfoTupleGenerator = Iterator[TermInfoTuple]
+
+# ZONES
+CONTENT_ZONE: ZoneId = 0
+TITLE_ZONE: ZoneId = 1
+DATE_ZONE: ZoneId = 2
+COURT_ZONE: ZoneId = 3
+PARTIES_ZONE: ZoneId = 4
+SECTION_ZONE: ZoneId = 5
+ZONE_NAMES: Tuple[str, ...] = ("content", "title", "date", "court", "parties", "section")  # by zone ID
+NUM_ZONES: int = len(ZONE_NAMES)
@@ -2,41 +2,104 @@
 from __future__ import annotations
 
 import getopt
+import heapq
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+from contextlib import ExitStack
+from itertools import groupby
 from math import log10
-from typing import List
+from typing import List, Set
 import multiprocessing
-import functools
 
 # SELF-WRITTEN MODULES
-from InputOutput import write_block
+from InputOutput import PostingReader, TermDictionary, DocLengths, DocStore, DateIndex, \
+    write_partial_block, merge_blocks, write_postings, write_doc_lengths, write_champion_chunk, write_champion_lists, \
+    write_doc_store, write_date_index
+from ExpansionTable import build_expansion_table
+from QueryRefinement import get_date_ordinal
+from Segments import get_segment_file, read_segments, update_manifest, lock_file, delete_segment_files
 from Tokenizer import make_doc_read_generator
 from Types import *
 import Config
 
+# rough estimates of how many bytes each new entry in the in-memory dictionary takes up
+# (the int object and list slot for a position, the list and dict slot for a new doc, the str and dict for a new term)
+# these are only used to decide when a SPIMI block should be flushed to disk
+EST_POSITION_BYTES: int = 36
+EST_POSTING_BYTES: int = 150
+EST_TERM_BYTES: int = 300
+# and the same for each entry in a champion list heap (the tuple, its two floats and int, and the list slot)
+# used to keep the champion lists of each chunk of docs within the SPIMI memory budget
+EST_CHAMPION_ENTRY_BYTES: int = 150
 
-def build_index(in_file: str, out_dict: str, out_postings: str) -> None:
+
+def build_index(in_file: str,
+                out_dict: str,
+                out_postings: str,
+                out_lengths: str = Config.LENGTHS_FILE,
+                out_champion: str = Config.CHAMPION_FILE,
+                out_docstore: str = Config.DOCSTORE_FILE,
+                out_dates: str = Config.DATES_FILE,
+                skip_doc_ids: Optional[Set[DocId]] = None) -> int:
     """
     Build index from documents stored in the input directory,
-    then output the dictionary file and postings file
+    then output the dictionary file and postings file (and the lengths, champion, doc store and dates files)
+    :param in_file: The name of the input file
+    :param out_dict: The desired name of the output dictionary file
+    :param out_postings: The desired name of the output postings file
+    :param out_lengths: The desired name of the output lengths file
+    :param out_champion: The desired name of the output champion file
+    :param out_docstore: The desired name of the output doc store file
+    :param out_dates: The desired name of the output dates file
+    :param skip_doc_ids: Doc IDs to leave out, e.g. those already indexed in other segments
+    :return: The number of documents indexed (no files are written if there are none)
     """
     print("indexing...")
 
     # we have a main dictionary mapping term and doc ID to term frequency
     # this is "main" because it directly mirrors the structure of our posting lists
-    dictionary: Dict[Term, Dict[DocId, List[TermPos]]] = dict()
+    # terms are keyed by term ID, made from the word ID and zone ID (see Types.py)
+    dictionary: Dict[TermId, Dict[DocId, List[TermPos]]] = dict()
+
+    # words get their word IDs in order of first appearance
+    word_ids: Dict[str, WordId] = dict()
+    words: List[str] = []  # word ID -> word
 
     # we want to capture all document IDs and each document's length
     # we can do that using a dictionary mapping doc_id to doc_length
     docs_len_dct: Dict[DocId, DocLength] = {}
 
+    # the doc store keeps where each document's row is in the input file, so it can be read again later
+    doc_locations: Dict[DocId, Tuple[str, int, int]] = {}
+
+    # the date each document was posted (as an ordinal), for the dates file
+    doc_dates: Dict[DocId, int] = {}
+
     # we also want a more short-lived counter to count the frequency of each term for each document
     # term_freq_counter will get reset between documents, using current_doc to keep track
-    term_freq_counter: Dict[Term, TermFreq] = dict()
+    term_freq_counter: Dict[TermId, TermFreq] = dict()
     current_doc: Optional[DocId] = None
 
+    # when running SPIMI, the dictionary above only holds the current block
+    # once its estimated size goes over the memory budget, we flush it to a sorted block file on disk
+    # blocks are only flushed between documents, so a document never gets split across two blocks
+    est_block_bytes = 0
+    block_files: List[str] = []
+    block_dir: Optional[str] = None
+    if Config.RUN_SPIMI:
+        block_dir = tempfile.mkdtemp(prefix="spimi_", dir=os.path.dirname(os.path.abspath(out_postings)))
+
     # we use a generator to easily get the next term and relevant information from the given input dataset
-    term_info_generator: TermInfoTupleGenerator = make_doc_read_generator(in_file, Config.STOP_WORDS_FILE)
+    term_info_generator: TermInfoTupleGenerator
+    term_info_generator = make_doc_read_generator(in_file,
+                                                  Config.STOP_WORDS_FILE,
+                                                  Config.TOKENIZER_WORKERS,
+                                                  Config.TOKENIZER_BATCH_SIZE,
+                                                  skip_doc_ids,
+                                                  doc_locations)
     while True:
         generated = next(term_info_generator)
         # if we have run out of terms, we stop building index
@@ -47,11 +110,23 @@ def build_index(in_file: str, out_dict: str, out_postings: str) -> None:
             doc_length = 0
             for count in term_freq_counter.values():
                 doc_length += (1 + log10(count)) ** 2
-            docs_len_dct[current_doc] = doc_length ** 0.5
+            if current_doc is not None:
+                docs_len_dct[current_doc] = doc_length ** 0.5
             break
 
         # otherwise, we proceed as normal!
-        term, term_pos, doc_length, doc_id = generated
+        word, zone, term_pos, doc_length, doc_id = generated
+        word_id = word_ids.get(word)
+        if word_id is None:
+            word_id = word_ids[word] = len(words)
+            words.append(word)
+        term = word_id * NUM_ZONES + zone
+
+        # the first date in a document's date zone is when it was posted (the time after it is left out)
+        if zone == DATE_ZONE and doc_id not in doc_dates:
+            date = get_date_ordinal(word)
+            if date is not None:
+                doc_dates[doc_id] = date
 
         # if we encounter a new document, update docs_len_dct with the calculated doc length and reset term_freq_counter
         if current_doc != doc_id:
@@ -65,6 +140,12 @@ def build_index(in_file: str, out_dict: str, out_postings: str) -> None:
             current_doc = doc_id
             term_freq_counter = dict()
 
+            # flush the current block if it has grown past the memory budget
+            if Config.RUN_SPIMI and est_block_bytes >= Config.SPIMI_MEMORY_BUDGET:
+                block_files.append(flush_block(dictionary, docs_len_dct, block_dir, len(block_files)))
+                dictionary = dict()
+                est_block_bytes = 0
+
         # count occurrences of each term in each document
         if term in term_freq_counter:
             term_freq_counter[term] += 1
@@ -77,74 +158,408 @@ def build_index(in_file: str, out_dict: str, out_postings: str) -> None:
             # one posting_list is held for each term
             if doc_id in dictionary[term]:
                 dictionary[term][doc_id].append(term_pos)
+                est_block_bytes += EST_POSITION_BYTES
             else:
                 dictionary[term][doc_id] = [term_pos]
+                est_block_bytes += EST_POSTING_BYTES
         else:
             dictionary[term] = {doc_id: [term_pos]}
+            est_block_bytes += EST_TERM_BYTES
+
+    if not docs_len_dct:
+        print("no documents to index")
+        if Config.RUN_SPIMI:
+            shutil.rmtree(block_dir)
+        return 0
+
+    # we write the final posting list and dictionary to disk
+    if Config.RUN_SPIMI:
+        # flush the last block, then k-way merge all blocks straight into the final postings file
+        block_files.append(flush_block(dictionary, docs_len_dct, block_dir, len(block_files)))
+        dictionary = dict()
+        print(f"merging {len(block_files)} blocks...")
+        pointer_dct = write_postings(merge_blocks(block_files),
+                                     words,
+                                     docs_len_dct,
+                                     out_dict,
+                                     out_postings,
+                                     Config.WRITE_POS)
+        shutil.rmtree(block_dir)
+    else:
+        pointer_dct = write_postings(dictionary.items(),
+                                     words,
+                                     docs_len_dct,
+                                     out_dict,
+                                     out_postings,
+                                     Config.WRITE_POS)
+        dictionary = dict()  # the postings file has everything now, so free up the memory
 
     # CALCULATE TOP K SIGNIFICANT TERMS FOR EACH DOCUMENT
+    # this is done in a single pass over the postings file we just wrote, split by doc ID range across workers
+    make_champion_lists(out_postings, pointer_dct, docs_len_dct, out_champion)
+
+    write_doc_lengths(docs_len_dct, out_lengths)
+    write_doc_store(doc_locations, out_docstore)
+    write_date_index(doc_dates, out_dates)
+    print(f"Wrote {len(pointer_dct)} terms into final files")
+    return len(docs_len_dct)
+
+
+def flush_block(dictionary: Dict[TermId, Dict[DocId, List[TermPos]]],
+                docs_len_dct: Dict[DocId, DocLength],
+                block_dir: str,
+                block_num: int) -> str:
+    """
+    Writes the current SPIMI block to a file in the block directory.
+    :param dictionary: The in-memory dictionary of the current block
+    :param docs_len_dct: The dictionary containing the length of documents
+    :param block_dir: The directory to write block files into
+    :param block_num: The number of this block, used to name the file
+    :return: The name of the block file written
+    """
+    block_file = os.path.join(block_dir, f"block_{block_num}")
+    print(f"flushing block {block_num} ({len(dictionary)} terms)")
+    write_partial_block(dictionary, docs_len_dct, block_file)
+    return block_file
+
+
+def make_champion_lists(postings_file: str,
+                        pointer_dct: Dict[TermId, int],
+                        docs_len_dct: Dict[DocId, DocLength],
+                        out_champion: str) -> None:
+    """
+    Calculates the top K terms (by tf-idf weight) for each document, in one pass over the postings, and writes them
+    into the champion file.
+    The docs are split into disjoint ranges of doc IDs that workers process independently. Each worker reads every
+    posting list straight from the postings file (so the OS shares the file between workers, instead of us pickling
+    the whole index into every worker), skips to the start of its range, and keeps a bounded heap of the top K terms
+    for each doc in its range only. Since no doc is split across workers, each worker writes the final champion
+    lists of its docs to a chunk file, and the chunks are joined into the champion file one at a time, in order.
+    When running SPIMI, the ranges are kept small enough for the heaps of every worker to fit in the memory budget,
+    so the champion lists are never all in memory at once.
+    The terms are picked with the idf of this index, but only their normalized tf weights are kept, since the idf
+    changes as segments get added (see SegmentedChampionLists).
+    :param postings_file: The name of the postings file
+    :param pointer_dct: The dictionary of term ID -> postings file pointer
+    :param docs_len_dct: The dictionary containing the length of documents
+    :param out_champion: The desired name of the output champion file
+    :return: None
+    """
     N = len(docs_len_dct)  # total number of docs
 
-    chunk_size = 5000
-    params = [(max(i-chunk_size, 0), i) for i in range(chunk_size, len(docs_len_dct)+chunk_size, chunk_size)]
+    # ranges of doc IDs in ascending order, a few per worker so that faster workers can pick up more ranges
+    doc_ids = sorted(docs_len_dct.keys())
+    num_chunks = Config.CHAMPION_WORKERS * 4
+    if Config.RUN_SPIMI:
+        max_chunk_size = max(1, Config.SPIMI_MEMORY_BUDGET // (Config.CHAMPION_WORKERS * Config.K
+                                                               * EST_CHAMPION_ENTRY_BYTES))
+        num_chunks = max(num_chunks, -(-len(doc_ids) // max_chunk_size))
+    chunk_size = -(-len(doc_ids) // num_chunks)
+    chunk_dir = tempfile.mkdtemp(prefix="champion_", dir=os.path.dirname(os.path.abspath(out_champion)))
+    params = [(os.path.join(chunk_dir, f"chunk_{i // chunk_size}"),
+               [(doc_id, docs_len_dct[doc_id]) for doc_id in doc_ids[i:i + chunk_size]])
+              for i in range(0, len(doc_ids), chunk_size)]
 
-    with multiprocessing.Pool(processes=4) as pool:
-        make_champion_list_chunk_partial = functools.partial(make_champion_list_chunk, N, docs_len_dct, dictionary)
-        results = pool.starmap(make_champion_list_chunk_partial, params)
+    # every worker reads every posting list, in the order they appear in the postings file
+    term_pointers = sorted(pointer_dct.items(), key=lambda x: x[1])
 
-    champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]] = {}
-    for champion_dct_chunk in results:
-        champion_dct.update(champion_dct_chunk)
+    with multiprocessing.Pool(processes=Config.CHAMPION_WORKERS,
+                              initializer=init_champion_worker,
+                              initargs=(postings_file, N, term_pointers)) as pool:
+        # imap gives the chunk files back in the order of params, i.e. in ascending order of doc ID
+        write_champion_lists(pool.imap(make_champion_chunk, params), N, out_champion)
+    print(f"champion lists: joined {len(params)} chunks")
+    shutil.rmtree(chunk_dir)
 
-    # we write the final posting list and dictionary to disk
-    # write positional indices
-    write_block(dictionary,
-                docs_len_dct,
-                champion_dct,
-                out_dict,
-                out_postings,
-                Config.LENGTHS_FILE,
-                Config.CHAMPION_FILE,
-                Config.WRITE_POS)
-
-
-def make_champion_list_chunk(N, docs_len_dct, dictionary, start, end):
-    print("Working on chunk", start, end)
-    champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]] = {}
-    for i, doc_id in enumerate(list(docs_len_dct.keys())[start:end]):
-        if i > 0 and i % 100 == 0:
-            print(f"chunk [{start}:{end}] progress -> {i}/{end-start}")
-        term_weight_list: List[Tuple[Term, TermWeight]] = []
-        for term in dictionary:
-            if doc_id in dictionary[term]:
-                if Config.WRITE_POS:
-                    term_freq = len(dictionary[term][doc_id])
-                else:
-                    term_freq = dictionary[term][doc_id]
-                doc_freq = len(dictionary[term])
-                term_weight = (1 + log10(term_freq)) * log10(N / doc_freq)
-                term_weight /= docs_len_dct[doc_id]  # normalization
-                term_weight_list.append((term, term_weight))
-        # sort by descending weights and keep top K
-        term_weight_list = sorted(term_weight_list, key=lambda x: -x[1])[:Config.K]
-        champion_dct[doc_id] = term_weight_list
-    print(f"chunk [{start}:{end}] done!")
-    return champion_dct
+
+# state of each champion list worker process, set up by init_champion_worker
+_worker_postings_file: str = ""
+_worker_num_docs: int = 0
+_worker_pointer_dct: Dict[TermId, int] = {}  # in the order the terms appear in the postings file
+
+
+def init_champion_worker(postings_file: str, N: int, term_pointers: List[Tuple[TermId, int]]) -> None:
+    """
+    Initializer for the champion list worker processes, so the (term ID, pointer) pairs are only sent once per worker.
+    :param postings_file: The name of the postings file
+    :param N: The total number of docs
+    :param term_pointers: The (term ID, pointer) pairs of every term, in the order they appear in the postings file
+    """
+    global _worker_postings_file, _worker_num_docs, _worker_pointer_dct
+    _worker_postings_file = postings_file
+    _worker_num_docs = N
+    _worker_pointer_dct = dict(term_pointers)
+
+
+def make_champion_chunk(params: Tuple[str, List[Tuple[DocId, DocLength]]]) -> str:
+    """
+    Calculates the champion lists of a range of docs, and writes them to a chunk file.
+    Runs in the champion list worker processes.
+    Goes through every posting list with a PostingCursor, using its skip pointers to jump to the start of the range,
+    and keeps a min-heap of the top K (tf-idf weight, term ID, tf weight) tuples for each doc in the range.
+    Weights are only normalized by the doc length at the end, since that does not change the order within a doc.
+    :param params: Tuple of the chunk file name and the (doc ID, doc length) pairs of the docs in the range,
+    sorted by doc ID
+    :return: The name of the chunk file written
+    """
+    out_chunk, doc_lengths = params
+    first_doc, last_doc = doc_lengths[0][0], doc_lengths[-1][0]
+    champion_heaps: Dict[DocId, List[Tuple[TermWeight, TermId, TermWeight]]] = {}
+    for doc_id, _ in doc_lengths:
+        champion_heaps[doc_id] = []
+
+    with PostingReader(_worker_postings_file, _worker_pointer_dct, use_cache=False) as pf:
+        for term in _worker_pointer_dct:
+            cursor = pf.get_cursor(term)
+            idf = log10(_worker_num_docs / cursor.get_doc_freq())
+            doc_id = cursor.skip_to(first_doc)
+            while doc_id is not None and doc_id <= last_doc:
+                tf_weight = 1 + log10(cursor.term_freq())
+                term_weight = tf_weight * idf
+                heap = champion_heaps[doc_id]
+                if len(heap) < Config.K:
+                    heapq.heappush(heap, (term_weight, term, tf_weight))
+                elif term_weight > heap[0][0]:
+                    heapq.heapreplace(heap, (term_weight, term, tf_weight))
+                doc_id = cursor.next()
+
+    # sort by term ID, so each champion list can be read straight into a SparseVector
+    write_champion_chunk([(doc_id, sorted((term, tf_weight / doc_length)
+                                          for _, term, tf_weight in champion_heaps[doc_id]))
+                          for doc_id, doc_length in doc_lengths],
+                         out_chunk)
+    return out_chunk
+
+
+def rebuild_index(in_file: str, out_dict: str, out_postings: str) -> None:
+    """
+    Builds the whole index from scratch into a new segment, replacing all the segments there were before.
+    Like a merge, the new segment never overwrites files that searchers may still have open: it replaces the old
+    segments in a single update of the manifest (which running searchers notice and reload on), and only then are
+    the old segments deleted. The merge lock is held throughout, so no merge runs at the same time.
+    The first build of a directory (with no manifest or index files yet) is written straight into segment 0.
+    :param in_file: The name of the input file
+    :param out_dict: The desired name of the output dictionary file (of segment 0)
+    :param out_postings: The desired name of the output postings file (of segment 0)
+    """
+    with lock_file(Config.SEGMENTS_FILE + ".merge.lock"):
+        with update_manifest() as manifest:
+            if os.path.exists(Config.SEGMENTS_FILE) or os.path.exists(out_postings):
+                segment = manifest["next_segment"]
+                manifest["next_segment"] += 1
+            else:
+                segment = 0
+
+        num_docs = build_index(in_file,
+                               get_segment_file(out_dict, segment),
+                               get_segment_file(out_postings, segment),
+                               get_segment_file(Config.LENGTHS_FILE, segment),
+                               get_segment_file(Config.CHAMPION_FILE, segment),
+                               get_segment_file(Config.DOCSTORE_FILE, segment),
+                               get_segment_file(Config.DATES_FILE, segment))
+        if num_docs == 0:
+            print("keeping the existing index, as there was nothing to index")
+            return
+
+        with update_manifest() as manifest:
+            old_segments = manifest["segments"]
+            manifest["segments"] = [segment]  # next_segment carries on, so segment IDs are never reused
+        for old_segment in old_segments:
+            if old_segment != segment:
+                delete_segment_files(out_dict, out_postings, old_segment)
+        if Config.RUN_QUERY_EXPANSION:
+            build_expansion_table(out_dict)
+
+
+def add_segment(in_file: str, out_dict: str, out_postings: str) -> None:
+    """
+    Indexes the documents of a delta CSV into a new segment, leaving the existing segments as they are.
+    Documents that are already indexed are skipped. Searching picks up the new segment straight away, and once
+    there are more than Config.MAX_SEGMENTS segments, they get merged in the background.
+    :param in_file: The name of the delta input file
+    :param out_dict: The name of the dictionary file (of segment 0)
+    :param out_postings: The name of the postings file (of segment 0)
+    """
+    indexed_doc_ids: Set[DocId] = set()
+    for segment in read_segments():
+        with DocLengths(get_segment_file(Config.LENGTHS_FILE, segment)) as docs_len:
+            indexed_doc_ids.update(docs_len.doc_ids)
+
+    # reserve the segment ID first, so nothing else (e.g. a merge) can take it while we index
+    with update_manifest() as manifest:
+        segment = manifest["next_segment"]
+        manifest["next_segment"] += 1
+
+    print(f"indexing new documents into segment {segment}...")
+    num_docs = build_index(in_file,
+                           get_segment_file(out_dict, segment),
+                           get_segment_file(out_postings, segment),
+                           get_segment_file(Config.LENGTHS_FILE, segment),
+                           get_segment_file(Config.CHAMPION_FILE, segment),
+                           get_segment_file(Config.DOCSTORE_FILE, segment),
+                           get_segment_file(Config.DATES_FILE, segment),
+                           indexed_doc_ids)
+    if num_docs == 0:
+        return
+
+    if Config.RUN_QUERY_EXPANSION:
+        # the new segment may have words the table does not know yet, and searchers reload the table as soon as they
+        # see the new segment in the manifest, so the table has to know them before the segment is added
+        build_expansion_table(out_dict, segments=read_segments() + [segment])
+
+    with update_manifest() as manifest:
+        manifest["segments"].append(segment)
+        num_segments = len(manifest["segments"])
+    print(f"added segment {segment} with {num_docs} documents, {num_segments} segments in total")
+
+    if num_segments > Config.MAX_SEGMENTS:
+        start_background_merge(out_dict, out_postings)
+
+
+def start_background_merge(out_dict: str, out_postings: str) -> None:
+    """
+    Runs merge_segments in a separate process that carries on after this one exits.
+    Searching keeps using the existing segments until the merged segment is ready.
+    :param out_dict: The name of the dictionary file (of segment 0)
+    :param out_postings: The name of the postings file (of segment 0)
+    """
+    print("merging segments in the background...")
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "-m", "-d", out_dict, "-p", out_postings],
+                     start_new_session=True)
+
+
+def merge_segments(out_dict: str, out_postings: str) -> None:
+    """
+    Merges all the live segments into a single new segment, which is exactly the index a full build of all their
+    documents would give (champion lists included, since they are recalculated with the idf of all documents).
+    The merged segment replaces the segments it was made from in a single update of the manifest, and any segments
+    added in the meantime are left as they are. Only one merge runs at a time.
+    :param out_dict: The name of the dictionary file (of segment 0)
+    :param out_postings: The name of the postings file (of segment 0)
+    """
+    with lock_file(Config.SEGMENTS_FILE + ".merge.lock", blocking=False) as is_locked:
+        if not is_locked:
+            print("another merge is already running")
+            return
+
+        segments = read_segments()
+        if len(segments) < 2:
+            print("nothing to merge")
+            return
+
+        with update_manifest() as manifest:
+            merged_segment = manifest["next_segment"]
+            manifest["next_segment"] += 1
+        print(f"merging segments {segments} into segment {merged_segment}...")
+
+        merged_dict = get_segment_file(out_dict, merged_segment)
+        merged_postings = get_segment_file(out_postings, merged_segment)
+
+        docs_len_dct: Dict[DocId, DocLength] = {}
+        doc_locations: Dict[DocId, Tuple[str, int, int]] = {}
+        doc_dates: Dict[DocId, int] = {}
+        for segment in segments:
+            with DocLengths(get_segment_file(Config.LENGTHS_FILE, segment)) as docs_len:
+                docs_len_dct.update(zip(docs_len.doc_ids, docs_len.lengths))
+            with DocStore(get_segment_file(Config.DOCSTORE_FILE, segment)) as doc_store:
+                doc_locations.update((doc_id, doc_store.get_location(doc_id)) for doc_id in doc_store)
+            with DateIndex(get_segment_file(Config.DATES_FILE, segment)) as date_index:
+                doc_dates.update((doc_id, date) for date, doc_id in date_index)
+
+        with ExitStack() as stack:
+            dictionaries = [stack.enter_context(TermDictionary(get_segment_file(out_dict, segment)))
+                            for segment in segments]
+            readers = [stack.enter_context(PostingReader(get_segment_file(out_postings, segment), dictionary))
+                       for segment, dictionary in zip(segments, dictionaries)]
+            write_pos = all(reader.has_positions() for reader in readers)
+            words = merge_segment_words(dictionaries)
+            pointer_dct = write_postings(merge_segment_postings(dictionaries, readers, words, write_pos),
+                                         words,
+                                         docs_len_dct,
+                                         merged_dict,
+                                         merged_postings,
+                                         write_pos)
+
+        make_champion_lists(merged_postings,
+                            pointer_dct,
+                            docs_len_dct,
+                            get_segment_file(Config.CHAMPION_FILE, merged_segment))
+        write_doc_lengths(docs_len_dct, get_segment_file(Config.LENGTHS_FILE, merged_segment))
+        write_doc_store(doc_locations, get_segment_file(Config.DOCSTORE_FILE, merged_segment))
+        write_date_index(doc_dates, get_segment_file(Config.DATES_FILE, merged_segment))
+
+        with update_manifest() as manifest:
+            manifest["segments"] = [merged_segment] + [segment for segment in manifest["segments"]
+                                                       if segment not in segments]
+        for segment in segments:
+            delete_segment_files(out_dict, out_postings, segment)
+        if Config.RUN_QUERY_EXPANSION:
+            build_expansion_table(out_dict)  # the merged segment may have words the table does not know yet
+        print(f"merged {len(segments)} segments into segment {merged_segment} ({len(docs_len_dct)} documents)")
+
+
+def merge_segment_words(dictionaries: List[TermDictionary]) -> List[str]:
+    """
+    :param dictionaries: The dictionaries of the segments
+    :return: The sorted list of every word in any of the segments, so the index of a word is its merged word ID
+    """
+    words: Set[str] = set()
+    for dictionary in dictionaries:
+        words.update(dictionary.get_word(word_id) for word_id in range(dictionary.get_num_words()))
+    return sorted(words, key=lambda word: word.encode("utf-8"))
+
+
+def merge_segment_postings(dictionaries: List[TermDictionary],
+                           readers: List[PostingReader],
+                           words: List[str],
+                           write_pos: bool) -> Iterator[Tuple[TermId, Dict[DocId, List[TermPos]]]]:
+    """
+    K-way merges the posting lists of all segments into a single stream of (term ID, posting list) pairs,
+    in ascending order of merged term ID, just like merge_blocks does for SPIMI blocks.
+    The term IDs of every segment are in the order of their words, just like the merged term IDs, so each
+    segment's dictionary can be read in order. Only the posting lists of the current term are held in memory.
+    :param dictionaries: The dictionaries of the segments
+    :param readers: The posting list readers of the segments
+    :param words: The sorted list of words of all segments (see merge_segment_words)
+    :param write_pos: Whether the term positions are kept (otherwise, only the term frequencies are)
+    :return: A generator object for the merged (term ID, posting list) pairs
+    """
+    word_ids: Dict[str, WordId] = {word: word_id for word_id, word in enumerate(words)}
+
+    def make_segment_term_generator(i: int) -> Iterator[Tuple[TermId, int, TermId]]:
+        for local_term in dictionaries[i]:
+            local_word_id, zone = divmod(local_term, NUM_ZONES)
+            yield word_ids[dictionaries[i].get_word(local_word_id)] * NUM_ZONES + zone, i, local_term
+
+    merged = heapq.merge(*(make_segment_term_generator(i) for i in range(len(dictionaries))))
+    for term, entries in groupby(merged, key=lambda entry: entry[0]):
+        posting_list: Dict[DocId, List[TermPos]] = dict()
+        for _, i, local_term in entries:
+            cursor = readers[i].get_cursor(local_term)
+            while cursor.doc() is not None:
+                # without positions, only the length of the list matters (it is the term frequency)
+                posting_list[cursor.doc()] = cursor.positions() if write_pos else [0] * cursor.term_freq()
+                cursor.next()
+        yield term, posting_list
 
 
 def usage():
     print(
         "usage: "
         + sys.argv[0]
-        + " -i directory-of-documents -d dictionary-file -p postings-file -l lengths-file"
+        + " -i directory-of-documents -d dictionary-file -p postings-file [-a]\n"
+        + "       " + sys.argv[0] + " -m -d dictionary-file -p postings-file\n"
+        + "  -a: add the documents to the index as a new segment, instead of rebuilding the whole index\n"
+        + "  -m: merge all segments of the index into one"
     )
 
 
 if __name__ == "__main__":
     input_directory = output_file_dictionary = output_file_postings = output_file_lengths = None
+    append_segment = merge_all_segments = False
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "i:d:p:")
+        opts, args = getopt.getopt(sys.argv[1:], "i:d:p:am")
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -156,15 +571,24 @@ if __name__ == "__main__":
             output_file_dictionary = a
         elif o == "-p":  # postings file
             output_file_postings = a
+        elif o == "-a":  # add a segment
+            append_segment = True
+        elif o == "-m":  # merge segments
+            merge_all_segments = True
         else:
             assert False, "unhandled option"
 
     if (
-            input_directory is None
+            (input_directory is None and not merge_all_segments)
             or output_file_postings is None
             or output_file_dictionary is None
     ):
         usage()
         sys.exit(2)
 
-    build_index(input_directory, output_file_dictionary, output_file_postings)
+    if merge_all_segments:
+        merge_segments(output_file_dictionary, output_file_postings)
+    elif append_segment:
+        add_segment(input_directory, output_file_dictionary, output_file_postings)
+    else:
+        rebuild_index(input_directory, output_file_dictionary, output_file_postings)
@@ -1,42 +1,281 @@
 #!/usr/bin/python3
+import contextlib
+import multiprocessing
+import os
 import pickle
 import argparse
+import sys
 
-from typing import List
-from Tokenizer import tokenize_query
-from QueryRefinement import expand_query, tag_query_with_zones, extract_date
-from Searcher import search_freetext_query, search_boolean_query
+from typing import List, NamedTuple, Optional, Set
+from Tokenizer import tokenize_query, stem, format_stem_cache_info
+from InputOutput import POSTING_LIST_CACHE
+from QueryRefinement import expand_query, expand_query_weighted, tag_query_with_zones, extract_date, \
+    get_date_ordinal
+from Searcher import search_freetext_query, search_freetext_query_with_feedback, search_boolean_query
+from ResultCache import ResultCache, IndexVersion, get_index_version, make_result_cache
+from Segments import SegmentedDictionary, SegmentedDocLengths, SegmentedChampionLists, SegmentedDocStore, \
+    SegmentedDateIndex, read_segments
 from Types import *
 import Config
 
 
+class SearchData(NamedTuple):
+    """
+    Everything loaded from disk that searching needs, besides the postings file itself.
+    Loaded once by load_search_data, then shared by every query.
+    """
+    pointer_dct: SegmentedDictionary
+    docs_len: SegmentedDocLengths
+    champion_dct: SegmentedChampionLists
+    expansion_table: Dict[str, ExpansionTuple]
+    doc_store: SegmentedDocStore  # the text of any doc, e.g. for snippets or feedback
+    date_index: SegmentedDateIndex  # the docs posted within any date range
+    segments: List[SegmentId]  # the segments that were live when loaded
+    index_version: IndexVersion  # the version of the index when loaded (see ResultCache.get_index_version)
+
+    def close(self) -> None:
+        """
+        Closes every file opened by load_search_data. The search data must not be used afterwards.
+        """
+        for segmented in (self.pointer_dct, self.docs_len, self.champion_dct, self.doc_store, self.date_index):
+            segmented.close()
+
+
+def load_search_data(dict_file: str, postings_file: str) -> SearchData:
+    """
+    Reads the dictionary, lengths, champion, doc store, dates and (if query expansion is on) expansion table files,
+    of every segment listed in the segments manifest.
+    :param dict_file: The name of the dictionary file (of segment 0)
+    :param postings_file: The name of the postings file (of segment 0)
+    :return: The loaded SearchData
+    """
+    # READ UTILITY FILES
+    # these files are memory-mapped rather than loaded, and stay open for as long as we search
+    # the index version is taken before anything is opened, so if the index changes while we load,
+    # the version we record is the older one, and the next check reloads again
+    segments = read_segments()
+    index_version = get_index_version(postings_file, segments)
+    pointer_dct = SegmentedDictionary(dict_file, segments)
+    docs_len = SegmentedDocLengths(Config.LENGTHS_FILE, segments)
+    champion_dct = SegmentedChampionLists(Config.CHAMPION_FILE, segments, docs_len, pointer_dct)
+    doc_store = SegmentedDocStore(Config.DOCSTORE_FILE, segments, docs_len)
+    date_index = SegmentedDateIndex(Config.DATES_FILE, segments)
+    expansion_table: Dict[str, ExpansionTuple] = {}
+
+    if Config.RUN_QUERY_EXPANSION:
+        with open(Config.EXPANSION_TABLE_FILE, "rb") as ef:
+            expansion_table = pickle.load(ef)
+
+    return SearchData(pointer_dct, docs_len, champion_dct, expansion_table, doc_store, date_index, segments,
+                      index_version)
+
+
+def refresh_search_data(dict_file: str, postings_file: str, search_data: SearchData) -> SearchData:
+    """
+    Reloads the search data if the index has changed since it was loaded, i.e. segments were added or merged,
+    or the files of a segment were rewritten. Checking only takes a stat of each postings file.
+    :param dict_file: The name of the dictionary file (of segment 0)
+    :param postings_file: The name of the postings file (of segment 0)
+    :param search_data: The search data currently loaded, which is closed if it gets replaced
+    :return: The search data to use, either the same one or a freshly loaded one
+    """
+    segments = read_segments()
+    if segments == search_data.segments and \
+            get_index_version(postings_file, segments) == search_data.index_version:
+        return search_data
+    print("index changed, reloading search data...")
+    new_search_data = load_search_data(dict_file, postings_file)
+    search_data.close()  # otherwise the files of merged (and deleted) segments stay mapped until we exit
+    return new_search_data
+
+
 def run_search(dict_file: str, postings_file: str, queries_file: str, results_file: str):
     """
     using the given dictionary file, postings file, and optionally 
-    thesaurus pickle file, perform searching on the given queries 
+    expansion table pickle file, perform searching on the given queries 
     file and output the results to the results file
     """
     print("running search on the queries...")
 
-    # READ UTILITY FILES
-    pointer_dct: Dict[Term, int]
-    docs_len: Dict[DocId, DocLength]
-    champion_dct: Dict[DocId, List[Tuple[Term, TermWeight]]]
-
-    with open(dict_file, 'rb') as df,\
-         open(Config.LENGTHS_FILE, 'rb') as lf,\
-         open(Config.CHAMPION_FILE, "rb") as cf:
-        pointer_dct = pickle.load(df)
-        docs_len = pickle.load(lf)
-        champion_dct = pickle.load(cf)
-
-    # READ QUERY FILE
-    query_tokens: List[str]
+    search_data = load_search_data(dict_file, postings_file)
+    run_query_file(queries_file, results_file, postings_file, search_data)
+
+
+def run_query_file(queries_file: str,
+                   results_file: str,
+                   postings_file: str,
+                   search_data: SearchData,
+                   result_cache: Optional[ResultCache] = None) -> None:
+    """
+    Reads a single query file, runs its query and writes the results file.
+    :param queries_file: The name of the query file
+    :param results_file: The name of the results file to write
+    :param postings_file: The name of the postings file
+    :param search_data: The loaded dictionary, lengths, champion lists and expansion table
+    :param result_cache: The result cache to use, if any
+    """
+    query, relevant_docs = read_query_file(queries_file)
+    search_output = process_query(query, relevant_docs, postings_file, search_data, result_cache)
+    write_results_file(results_file, search_output)
+
+
+def read_query_file(queries_file: str) -> Tuple[str, List[DocId]]:
+    """
+    :param queries_file: The name of the query file
+    :return: Tuple of the query (the first line) and the relevant doc IDs (one per line after it)
+    """
     relevant_docs: List[DocId] = []
     with open(queries_file, "r") as qf:
         query = qf.readline()
         while relevant_doc := qf.readline().strip():
             relevant_docs.append(int(relevant_doc))
+    return query, relevant_docs
+
+
+def write_results_file(results_file: str, search_output: List[DocId]) -> None:
+    """
+    :param results_file: The name of the results file to write
+    :param search_output: The doc IDs found, best first
+    """
+    output = " ".join(map(str, search_output))
+    print("docs found:", len(search_output))
+    with open(results_file, "w") as rf:
+        rf.write(output)
+
+
+def run_batch_search(dict_file: str,
+                     postings_file: str,
+                     jobs: List[Tuple[str, str]],
+                     num_workers: int = 1) -> None:
+    """
+    Runs many query files, loading the dictionary, lengths, champion and expansion table files only once
+    (once per worker process, if running in parallel). Writes one results file per query file.
+    Results are looked up in (and added to) the result cache by this process, so workers only get the queries
+    that are not cached.
+    :param dict_file: The name of the dictionary file
+    :param postings_file: The name of the postings file
+    :param jobs: List of (query file, results file) pairs
+    :param num_workers: The number of worker processes to run queries with (1 runs them in this process)
+    """
+    print(f"running search on {len(jobs)} query files...")
+    result_cache = make_result_cache()
+
+    if num_workers <= 1:
+        search_data = load_search_data(dict_file, postings_file)
+        for queries_file, results_file in jobs:
+            search_data = refresh_search_data(dict_file, postings_file, search_data)
+            run_query_file(queries_file, results_file, postings_file, search_data, result_cache)
+        print(POSTING_LIST_CACHE.format_info())
+    else:
+        # answer whatever we can from the result cache, and send the rest to the workers
+        uncached_jobs: List[Tuple[str, str]] = []
+        uncached_keys = []
+        if result_cache is not None:
+            result_cache.check_index_version(get_index_version(postings_file, read_segments()))
+        for queries_file, results_file in jobs:
+            if result_cache is None:
+                uncached_jobs.append((queries_file, results_file))
+                continue
+            query, relevant_docs = read_query_file(queries_file)
+            cache_key = result_cache.make_key(tokenize_query(query), extract_date(query), relevant_docs)
+            search_output = result_cache.get(cache_key)
+            if search_output is None:
+                uncached_jobs.append((queries_file, results_file))
+                uncached_keys.append(cache_key)
+            else:
+                write_results_file(results_file, search_output)
+
+        if uncached_jobs:
+            with multiprocessing.Pool(processes=num_workers,
+                                      initializer=init_batch_worker,
+                                      initargs=(dict_file, postings_file)) as pool:
+                job_outputs = pool.starmap(run_batch_job, uncached_jobs, chunksize=1)
+            if result_cache is not None:
+                # results are only cached if the worker searched the same version of the index the cache is for
+                for cache_key, (index_version, search_output) in zip(uncached_keys, job_outputs):
+                    if result_cache.is_index_version(index_version):
+                        result_cache.put(cache_key, search_output)
+
+    if result_cache is not None:
+        print(result_cache.format_info())
+        result_cache.save()
+
+
+# search data for run_batch_job, loaded once in each worker process by init_batch_worker
+_worker_postings_file: str = ""
+_worker_search_data: Optional[SearchData] = None
+
+
+def init_batch_worker(dict_file: str, postings_file: str) -> None:
+    """
+    Initializer for the batch search worker processes, so each worker loads the search data only once.
+    :param dict_file: The name of the dictionary file
+    :param postings_file: The name of the postings file
+    """
+    global _worker_postings_file, _worker_search_data
+    _worker_postings_file = postings_file
+    _worker_search_data = load_search_data(dict_file, postings_file)
+
+
+def run_batch_job(queries_file: str, results_file: str) -> Tuple[IndexVersion, List[DocId]]:
+    """
+    Runs a single query file in a batch search worker process.
+    :param queries_file: The name of the query file
+    :param results_file: The name of the results file to write
+    :return: Tuple of the version of the index searched and the doc IDs found, so they can be added to the
+             result cache
+    """
+    query, relevant_docs = read_query_file(queries_file)
+    search_output = process_query(query, relevant_docs, _worker_postings_file, _worker_search_data)
+    write_results_file(results_file, search_output)
+    return _worker_search_data.index_version, search_output
+
+
+def read_batch_jobs(manifest_file: Optional[str],
+                    queries_dir: Optional[str],
+                    results_dir: Optional[str]) -> List[Tuple[str, str]]:
+    """
+    Gets the (query file, results file) pairs for a batch search, either from a manifest file
+    (one "<query file> <results file>" pair per line) or from every file in a directory of query files
+    (with results written to a file of the same name in the results directory).
+    :param manifest_file: The name of the manifest file, if any
+    :param queries_dir: The directory of query files, if any
+    :param results_dir: The directory to write results files into, when using queries_dir
+    :return: List of (query file, results file) pairs
+    """
+    jobs: List[Tuple[str, str]] = []
+    if manifest_file is not None:
+        with open(manifest_file, "r") as mf:
+            for line in mf:
+                if line.strip():
+                    queries_file, results_file = line.split()
+                    jobs.append((queries_file, results_file))
+    else:
+        os.makedirs(results_dir, exist_ok=True)
+        for filename in sorted(os.listdir(queries_dir)):
+            queries_file = os.path.join(queries_dir, filename)
+            if os.path.isfile(queries_file):
+                jobs.append((queries_file, os.path.join(results_dir, filename)))
+    return jobs
+
+
+def process_query(query: str,
+                  relevant_docs: List[DocId],
+                  postings_file: str,
+                  search_data: SearchData,
+                  result_cache: Optional[ResultCache] = None) -> List[DocId]:
+    """
+    Runs a single query (boolean, or free text with query expansion and relevance feedback).
+    If the same query (with the same relevant docs) has been run before on the same index, the cached results
+    are returned straight away.
+    :param query: The query string (the first line of a query file)
+    :param relevant_docs: The list of relevant doc IDs given with the query
+    :param postings_file: The name of the postings file
+    :param search_data: The loaded dictionary, lengths, champion lists and expansion table
+    :param result_cache: The result cache to use, if any
+    :return: The list of doc IDs found, best first
+    """
+    pointer_dct, docs_len, champion_dct, expansion_table, _, date_index, _, _ = search_data
 
     # QUERY PROCESSING
     # extract a single date from the query, if it exists
@@ -46,6 +285,16 @@ def run_search(dict_file: str, postings_file: str, queries_file: str, results_fi
     # tokenize the query
     query_tokens: List[str] = tokenize_query(query)
 
+    # CHECK RESULT CACHE
+    if result_cache is not None:
+        # the cache is for the version of the index that was loaded, which is what the results come from
+        result_cache.check_index_version(search_data.index_version)
+        cache_key = result_cache.make_key(query_tokens, extracted_dates, relevant_docs)
+        cached_output = result_cache.get(cache_key)
+        if cached_output is not None:
+            print("found query in result cache")
+            return cached_output
+
     # handle case where it is a phrasal query and boolean query
     is_boolean_query = 'AND' in query_tokens
 
@@ -71,24 +320,67 @@ def run_search(dict_file: str, postings_file: str, queries_file: str, results_fi
             else:
                 all_tokens += [tok]
 
+        # the pseudo-relevance feedback first pass only looks at the unexpanded query, in the content zone
+        unexpanded_tokens = all_tokens
+
         # QUERY EXPANSION
-        if Config.RUN_QUERY_EXPANSION:
-            with open(Config.THESAURUS_FILENAME, "rb") as tf:
-                thesaurus = pickle.load(tf)
-            all_tokens = expand_query(all_tokens, thesaurus)
+        # weighted expansion keeps the query tokens, and adds a limited number of down-weighted expansions
+        word_weights: Optional[Dict[WordId, float]] = None
+        if Config.RUN_QUERY_EXPANSION and Config.QUERY_EXPANSION_MODE == "weighted":
+            token_weights = expand_query_weighted(all_tokens, expansion_table, pointer_dct, len(docs_len),
+                                                  Config.EXPANSION_BUDGET,
+                                                  Config.EXPANSION_THESAURUS_WEIGHT,
+                                                  Config.EXPANSION_WORDNET_WEIGHT)
+            all_tokens = list(token_weights)
+            word_weights = {}
+            for token, weight in token_weights.items():
+                word_id = pointer_dct.get_word_id(token)
+                if word_id is not None:
+                    word_weights[word_id] = weight
+        elif Config.RUN_QUERY_EXPANSION:
+            all_tokens = expand_query(all_tokens, expansion_table)
 
         # TAGGING QUERY WITH ZONES
-        all_tokens = sum(tag_query_with_zones(all_tokens), [])  # flatten list
-        all_tokens += ["date@" + date for date in extracted_dates]  # add in any dates extracted
+        query_terms: List[TermId] = sum(tag_query_with_zones(all_tokens, pointer_dct), [])  # flatten list
+        for date in extracted_dates:  # add in any dates extracted
+            date_term = pointer_dct.get_term_id(date, DATE_ZONE)
+            if date_term is not None:
+                query_terms.append(date_term)
+
+        # DATE RANGE
+        # the docs posted within DATE_RANGE_DAYS days of any date in the query, straight from the dates file
+        date_docs: Optional[Set[DocId]] = None
+        if Config.DATE_RANGE_MODE != "off" and extracted_dates:
+            date_docs = set()
+            for date in extracted_dates:
+                date_ordinal = get_date_ordinal(date)
+                if date_ordinal is not None:
+                    date_docs.update(date_index.get_doc_ids(date_ordinal - Config.DATE_RANGE_DAYS,
+                                                            date_ordinal + Config.DATE_RANGE_DAYS))
 
         # SEARCHING
         search_output: List[DocId]
-        search_output = search_freetext_query(all_tokens,
-                                              pointer_dct,
-                                              docs_len,
-                                              postings_file,
-                                              relevant_docs,
-                                              champion_dct)
+        if Config.RUN_PSEUDO_RELEVANCE_FEEDBACK and not relevant_docs:
+            first_pass_terms: List[TermId] = tag_query_with_zones(unexpanded_tokens, pointer_dct)[0]  # content zone
+            search_output = search_freetext_query_with_feedback(query_terms,
+                                                                first_pass_terms,
+                                                                pointer_dct,
+                                                                docs_len,
+                                                                postings_file,
+                                                                champion_dct,
+                                                                Config.FREE_TEXT_TOP_K,
+                                                                word_weights,
+                                                                date_docs)
+        else:
+            search_output = search_freetext_query(query_terms,
+                                                  pointer_dct,
+                                                  docs_len,
+                                                  postings_file,
+                                                  relevant_docs,
+                                                  champion_dct,
+                                                  Config.FREE_TEXT_TOP_K,
+                                                  word_weights,
+                                                  date_docs=date_docs)
 
     # DEBUG PRINTS
     # true_pos = sum([rd in search_output for rd in relevant_docs])
@@ -103,19 +395,87 @@ def run_search(dict_file: str, postings_file: str, queries_file: str, results_fi
     # print("Positions of results:", [1+find_item(search_output, rd) for rd in relevant_docs])
     # print(f"Precision: {precision}, Recall: {recall}, F2: {f2_score}")
 
-    output = " ".join(map(str, search_output))
-    print("docs found:", len(search_output))
-    with open(results_file, "w") as rf:
-        rf.write(output)
+    if result_cache is not None:
+        result_cache.put(cache_key, search_output)
+    return search_output
+
+
+def run_server(dict_file: str, postings_file: str):
+    """
+    Loads everything once, then answers queries from stdin until EOF. Blank lines are skipped.
+    Each request is a single line of the query, optionally followed by a tab and the
+    space-separated relevant doc IDs:
+        <query>\t<doc_id> <doc_id> ...
+    Each response is a single line of the space-separated doc IDs found, in the same format as
+    the results file of run_search. A request that fails (e.g. a relevant doc ID that isn't a number) gets an
+    empty response line, with the error printed to stderr, and the server carries on.
+    Progress prints go to stderr so they don't mix with responses.
+    If the index changes while the server is running (see refresh_search_data), it reloads before the next query.
+    Results are cached (see ResultCache), and the cache is saved when the server exits, however it exits.
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        print("loading search data...")
+        search_data = load_search_data(dict_file, postings_file)
+        result_cache = make_result_cache()
+        print("ready for queries")
+
+    try:
+        for line in sys.stdin:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+
+            search_output: List[DocId] = []
+            with contextlib.redirect_stdout(sys.stderr):
+                try:
+                    query, _, relevant_docs_str = line.partition("\t")
+                    relevant_docs: List[DocId] = [int(doc_id) for doc_id in relevant_docs_str.split()]
+                    search_data = refresh_search_data(dict_file, postings_file, search_data)
+                    search_output = process_query(query, relevant_docs, postings_file, search_data, result_cache)
+                    print("docs found:", len(search_output))
+                except Exception as e:
+                    print(f"could not answer request {line!r}: {type(e).__name__}: {e}")
+
+            sys.stdout.write(" ".join(map(str, search_output)) + "\n")
+            sys.stdout.flush()
+    finally:
+        # the stem and posting list caches live as long as the server, so this shows how well they are sized
+        cache_info = stem.cache_info()
+        print(format_stem_cache_info(cache_info.hits, cache_info.misses, cache_info.currsize), file=sys.stderr)
+        print(POSTING_LIST_CACHE.format_info(), file=sys.stderr)
+        if result_cache is not None:
+            print(result_cache.format_info(), file=sys.stderr)
+            result_cache.save()
 
 
 # python3 search.py -d dictionary.txt -p postings.txt -q queries/q1.txt -o results.txt
+# python3 search.py -d dictionary.txt -p postings.txt --server
+# python3 search.py -d dictionary.txt -p postings.txt --batch queries/ -o results/ --workers 4
+# python3 search.py -d dictionary.txt -p postings.txt --manifest manifest.txt --workers 4
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-d', dest='dictionary_file', required=True)
     arg_parser.add_argument('-p', dest='postings_file', required=True)
-    arg_parser.add_argument('-q', dest='queries_file', required=True)
-    arg_parser.add_argument('-o', dest='output_file', required=True)
+    arg_parser.add_argument('-q', dest='queries_file')
+    arg_parser.add_argument('-o', dest='output_file')
+    arg_parser.add_argument('--server', action='store_true',
+                            help='answer queries from stdin, one per line, until EOF')
+    arg_parser.add_argument('--batch', dest='queries_dir',
+                            help='run every query file in this directory, writing results into the -o directory')
+    arg_parser.add_argument('--manifest', dest='manifest_file',
+                            help='run every "<query file> <results file>" pair listed in this file')
+    arg_parser.add_argument('--workers', dest='num_workers', type=int, default=1,
+                            help='number of worker processes for --batch/--manifest')
     args = arg_parser.parse_args()
 
-    run_search(args.dictionary_file, args.postings_file, args.queries_file, args.output_file)
+    if args.server:
+        run_server(args.dictionary_file, args.postings_file)
+    elif args.manifest_file is not None or args.queries_dir is not None:
+        if args.manifest_file is None and args.output_file is None:
+            arg_parser.error("-o (the results directory) is required with --batch")
+        batch_jobs = read_batch_jobs(args.manifest_file, args.queries_dir, args.output_file)
+        run_batch_search(args.dictionary_file, args.postings_file, batch_jobs, args.num_workers)
+    elif args.queries_file is None or args.output_file is None:
+        arg_parser.error("-q and -o are required unless running with --server")
+    else:
+        run_search(args.dictionary_file, args.postings_file, args.queries_file, args.output_file)